@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Invoice generator benchmark
+
+Renders and stores invoices for a synthetic, skewed dataset against an SQLite
+database and an in-memory S3 stand-in, and reports invoices/sec, per-invoice
+latency, per-stage timings and peak memory. No Postgres, AWS or .env needed.
+
+--engine-parity instead renders every invoice with both WeasyPrint and
+--engine, compares the PDFs (benchmarks/parity.py) and reports the
+per-invoice render time of each engine. It first checks both engines against
+the hand-built invoices in benchmarks/fixtures.py, and exits 1 on any mismatch.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_invoices import ROLES, render_invoice, render_invoice_batch, store_invoice
+from invoice_generator.pdf_generator import ENGINES, PDFGenerator
+from invoice_generator.pipeline import InvoicePipeline
+from invoice_generator.proration import prorate_role
+from invoice_generator.metrics import metrics, STAGES, percentile
+from benchmarks.parity import check_fixtures, compare_invoices
+from benchmarks.synthetic import generate_dataset
+from invoice_generator.storage import LocalDirectoryStorage, ArchiveStorage
+from benchmarks.standins import SQLiteDatabaseManager, InMemoryS3Uploader
+
+
+def parse_args(argv=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Benchmark invoice generation on synthetic data')
+    parser.add_argument('--entities', type=int, default=100,
+                        help='Businesses/investors per role (default: 100)')
+    parser.add_argument('--min-rows', type=int, default=1,
+                        help='Fewest records per entity (default: 1)')
+    parser.add_argument('--max-rows', type=int, default=500,
+                        help='Most records per entity (default: 500)')
+    parser.add_argument('--skew', type=float, default=1.16,
+                        help='Pareto shape of records per entity; smaller is more skewed (default: 1.16)')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Random seed for the dataset (default: 42)')
+    parser.add_argument('--roles', nargs='+', choices=list(ROLES), default=list(ROLES),
+                        help='Roles to benchmark (default: all)')
+    parser.add_argument('--upload-threads', type=int, default=4,
+                        help='Store threads overlapping upload with rendering; 0 stores inline (default: 4)')
+    parser.add_argument('--render-batch', type=int, default=1,
+                        help='Render up to this many small invoices per WeasyPrint document (default: 1)')
+    parser.add_argument('--engine', choices=ENGINES, default='weasyprint',
+                        help='PDF render engine, as generate_invoices.py --engine (default: weasyprint)')
+    parser.add_argument('--engine-parity', action='store_true',
+                        help='Render every invoice with WeasyPrint and --engine, compare the PDFs and '
+                             'time both engines instead of running the store benchmark')
+    parser.add_argument('--optimize-pdf', action='store_true',
+                        help='Shrink PDFs before upload, as generate_invoices.py --optimize-pdf')
+    parser.add_argument('--s3-latency-ms', type=float, default=0,
+                        help='Simulated latency per S3 upload in milliseconds (default: 0)')
+    parser.add_argument('--storage', choices=['memory', 'local', 'archive'], default='memory',
+                        help='Store PDFs in memory (default), in a local directory or in one .zip/.tar archive')
+    parser.add_argument('--storage-path',
+                        help='Directory (--storage local) or archive file (--storage archive)')
+    parser.add_argument('--database', default=':memory:',
+                        help='SQLite file for the stand-in database (default: in memory)')
+    parser.add_argument('--output',
+                        help='Write the results as JSON to this file')
+    args = parser.parse_args(argv)
+    if args.storage != 'memory' and not args.storage_path:
+        parser.error(f'--storage {args.storage} requires --storage-path')
+    if args.engine_parity and args.engine == 'weasyprint':
+        parser.error('--engine-parity compares WeasyPrint with another engine; pass --engine too')
+    return args
+
+
+def run_benchmark(args) -> dict:
+    """Load the dataset, run every role through render + store and return the results"""
+    load_start = time.perf_counter()
+    dataset = generate_dataset(args.entities, args.min_rows, args.max_rows, args.skew, args.seed, args.roles)
+    db = SQLiteDatabaseManager(args.database)
+    db.connect()
+    db.load(dataset)
+    load_seconds = time.perf_counter() - load_start
+
+    template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'invoice_generator', 'templates')
+    pdf_gen = PDFGenerator(template_dir, optimize=args.optimize_pdf, engine=args.engine)
+    if args.storage == 'local':
+        s3 = LocalDirectoryStorage(args.storage_path)
+    elif args.storage == 'archive':
+        s3 = ArchiveStorage(args.storage_path)
+    else:
+        s3 = InMemoryS3Uploader(latency=args.s3_latency_ms / 1000)
+    invoice_date = datetime(2026, 2, 1)
+
+    # (role, name) -> render start, and per-invoice latency from render start to stored
+    started = {}
+    latencies = []
+    record_counts = []
+    failed = []
+    lock = threading.Lock()
+
+    def store(invoice):
+        store_invoice(db, s3, invoice)
+        with lock:
+            latencies.append(time.perf_counter() - started[(invoice.role, invoice.business_name)])
+
+    def on_result(invoice, ok):
+        if not ok:
+            failed.append((invoice.role, invoice.business_name))
+
+    metrics.reset()
+    run_start = time.perf_counter()
+    pipeline = InvoicePipeline(store, on_result, max_pending=args.upload_threads * 2,
+                               workers=args.upload_threads) if args.upload_threads else None
+    if pipeline:
+        pipeline.start()
+    def submit(invoice):
+        if pipeline:
+            pipeline.submit(invoice)
+        else:
+            store(invoice)
+
+    try:
+        for role in args.roles:
+            groups = db.get_all_role_records(role, invoice_date)
+            with metrics.stage('prorate'):
+                prorations = prorate_role(role, groups, invoice_date)
+            batch = []
+            for name, records in groups.items():
+                started[(role, name)] = time.perf_counter()
+                record_counts.append(len(records))
+                if args.render_batch > 1 and pdf_gen.batchable(records):
+                    batch.append((name, records, None, prorations[name]))
+                    if len(batch) >= args.render_batch:
+                        for invoice in render_invoice_batch(pdf_gen, role, batch, invoice_date):
+                            submit(invoice)
+                        batch = []
+                    continue
+                submit(render_invoice(pdf_gen, role, name, records, invoice_date, lines=prorations[name]))
+            if batch:
+                for invoice in render_invoice_batch(pdf_gen, role, batch, invoice_date):
+                    submit(invoice)
+    finally:
+        if pipeline:
+            pipeline.close()
+        s3.close()
+    wall_seconds = time.perf_counter() - run_start
+    db.close()
+
+    latencies.sort()
+    record_counts.sort()
+    invoices = len(latencies)
+    summary = metrics.summary()
+    return {
+        'parameters': vars(args),
+        'dataset': {
+            'rows': {table: len(rows) for table, rows in dataset.items()},
+            'entities': len(record_counts),
+            'records_per_entity': {
+                'min': record_counts[0] if record_counts else 0,
+                'p50': percentile(record_counts, 0.50),
+                'p95': percentile(record_counts, 0.95),
+                'max': record_counts[-1] if record_counts else 0
+            },
+            'load_seconds': load_seconds
+        },
+        'invoices': invoices,
+        'failed': len(failed),
+        'wall_seconds': wall_seconds,
+        'invoices_per_second': invoices / wall_seconds if wall_seconds else 0.0,
+        'latency_seconds': {
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'max': latencies[-1] if latencies else 0.0
+        },
+        **summary
+    }
+
+
+def run_engine_parity(args) -> dict:
+    """Check both engines against the fixtures, then render every invoice with each, compare and time them"""
+    dataset = generate_dataset(args.entities, args.min_rows, args.max_rows, args.skew, args.seed, args.roles)
+    db = SQLiteDatabaseManager(args.database)
+    db.connect()
+    db.load(dataset)
+
+    template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'invoice_generator', 'templates')
+    generators = {engine: PDFGenerator(template_dir, optimize=args.optimize_pdf, engine=engine)
+                  for engine in ('weasyprint', args.engine)}
+    invoice_date = datetime(2026, 2, 1)
+    fixture_mismatches = check_fixtures(generators)
+
+    seconds = {engine: [] for engine in generators}
+    mismatches = []
+    for role in args.roles:
+        groups = db.get_all_role_records(role, invoice_date)
+        prorations = prorate_role(role, groups, invoice_date)
+        for name, records in groups.items():
+            invoices = {}
+            for engine, pdf_gen in generators.items():
+                start = time.perf_counter()
+                invoices[engine] = render_invoice(pdf_gen, role, name, records, invoice_date,
+                                                  lines=prorations[name])
+                seconds[engine].append(time.perf_counter() - start)
+            differences = compare_invoices(invoices['weasyprint'], invoices[args.engine], records)
+            if differences:
+                mismatches.append({'role': role, 'name': name, 'records': len(records),
+                                   'differences': differences})
+    db.close()
+
+    engines = {}
+    for engine, samples in seconds.items():
+        total = sum(samples)
+        samples.sort()
+        engines[engine] = {
+            'seconds': total,
+            'per_invoice_seconds': {
+                'mean': total / len(samples) if samples else 0.0,
+                'p50': percentile(samples, 0.50),
+                'p95': percentile(samples, 0.95),
+                'max': samples[-1] if samples else 0.0
+            }
+        }
+    candidate_seconds = engines[args.engine]['seconds']
+    return {
+        'parameters': vars(args),
+        'invoices': len(seconds['weasyprint']),
+        'engines': engines,
+        'speedup': engines['weasyprint']['seconds'] / candidate_seconds if candidate_seconds else 0.0,
+        'mismatches': mismatches,
+        'fixture_mismatches': fixture_mismatches
+    }
+
+
+def print_parity_results(results: dict):
+    """Print a human-readable parity summary"""
+    candidate = results['parameters']['engine']
+    print(f"Invoices:    {results['invoices']} rendered with weasyprint and {candidate}")
+    print("Render (mean / p50 / p95 / max ms per invoice):")
+    for engine, timing in results['engines'].items():
+        per_invoice = timing['per_invoice_seconds']
+        print(f"  {engine:<15} {per_invoice['mean'] * 1000:8.2f} / {per_invoice['p50'] * 1000:8.2f} / "
+              f"{per_invoice['p95'] * 1000:8.2f} / {per_invoice['max'] * 1000:8.2f}")
+    print(f"Speedup:     {results['speedup']:.1f}x")
+    print(f"Fixtures:    {len(results['fixture_mismatches'])} wrong")
+    print(f"Mismatches:  {len(results['mismatches'])}")
+    for mismatch in results['fixture_mismatches'] + results['mismatches']:
+        print(f"  {mismatch['role']} {mismatch['name']} ({mismatch['records']} records):")
+        for difference in mismatch['differences']:
+            print(f"    {difference}")
+
+
+def print_results(results: dict):
+    """Print a human-readable summary"""
+    dataset = results['dataset']
+    per_entity = dataset['records_per_entity']
+    latency = results['latency_seconds']
+    print(f"Dataset:     {dataset['entities']} entities, {sum(dataset['rows'].values())} rows "
+          f"(records/entity min {per_entity['min']}, p50 {per_entity['p50']}, p95 {per_entity['p95']}, "
+          f"max {per_entity['max']}), loaded in {dataset['load_seconds']:.2f}s")
+    print(f"Invoices:    {results['invoices']} in {results['wall_seconds']:.2f}s "
+          f"= {results['invoices_per_second']:.2f} invoices/sec ({results['failed']} failed)")
+    print(f"Latency:     p50 {latency['p50'] * 1000:.1f}ms, p95 {latency['p95'] * 1000:.1f}ms, "
+          f"max {latency['max'] * 1000:.1f}ms")
+    print("Stages (p50 / p95 / max ms):")
+    for name in STAGES:
+        timing = results['stages'].get(name)
+        if timing:
+            print(f"  {name:<15} {timing['p50'] * 1000:8.2f} / {timing['p95'] * 1000:8.2f} / "
+                  f"{timing['max'] * 1000:8.2f}  ({timing['count']} samples)")
+    pages = results['distributions'].get('pdf_pages')
+    if pages:
+        print(f"PDF pages:   p50 {pages['p50']}, p95 {pages['p95']}, max {pages['max']}")
+    print(f"Uploaded:    {results['counters'].get('bytes_uploaded', 0) / 1048576:.1f} MiB")
+    print(f"Peak RSS:    {results['peak_rss_bytes'] / 1048576:.0f} MiB")
+
+
+def main(argv=None):
+    """Main execution function"""
+    args = parse_args(argv)
+    # Keep per-invoice log lines out of the timings and the output
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.engine_parity:
+        results = run_engine_parity(args)
+        print_parity_results(results)
+    else:
+        results = run_benchmark(args)
+        print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True, default=str)
+        print(f"Results written to {args.output}")
+    if args.engine_parity and (results['mismatches'] or results['fixture_mismatches']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Hand-built invoices with known totals, for the render engine parity check
+
+Each fixture's total was worked out by hand from the rules in
+invoice_generator/proration.py, not computed by the code under test; its page
+count is the layout's, which every engine must reproduce. Invoices
+are dated FIXTURE_INVOICE_DATE, so they cover January 2026 (31 days). Every
+record has its own loan_amount, which is how the check counts the line items
+a PDF shows.
+
+A fixture's `excluded` rows belong to the same entity but aren't invoiced on
+FIXTURE_INVOICE_DATE, by the Node generator's selection rules (see the role
+filters in invoice_generator/database.py); fixture_tables() loads them into the
+source tables alongside the invoiced ones.
+"""
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, List, NamedTuple, Tuple
+
+from invoice_generator.records import BusinessRecord, InvestorRecord, CapInvestorRecord, Record
+
+from .synthetic import ROLE_TABLES
+
+FIXTURE_INVOICE_DATE = datetime(2026, 2, 1)
+
+# Invoiced in an earlier month, so never a first-month row
+EARLIER_INVOICE = datetime(2025, 12, 1)
+
+
+class ParityFixture(NamedTuple):
+    """One invoice and what a reader should find in its PDF"""
+    role: str
+    name: str
+    records: List[Record]
+    # Amount invoiced: the sum of the (prorated) line amounts
+    total: Decimal
+    # Pages in the PDF, footer included
+    pages: int
+    # Days in each prorated row's "Prorated N days" note, in row order
+    prorated_days: Tuple[int, ...] = ()
+    # The entity's rows that aren't on this invoice
+    excluded: Tuple[Record, ...] = ()
+
+
+def _client_rows(name: str, count: int) -> List[BusinessRecord]:
+    # Interest payments $1,001.00 .. $1,000.00 + count, loans $201,000.00 .. $200,000.00 + 1,000 * count
+    return [BusinessRecord(f'fixture-funded-{i}', name, f'{i} Parity Street', Decimal(200000 + 1000 * i),
+                           Decimal(1000 + i), datetime(2025, 6, 15), EARLIER_INVOICE)
+            for i in range(1, count + 1)]
+
+
+FIXTURES = [
+    # A borrower with one loan: the full monthly payment. Loans closed in the covered month or
+    # the invoice month are first billed two months after closing
+    ParityFixture('client', 'Parity Single Loan LLC', [
+        BusinessRecord('fixture-funded-single', 'Parity Single Loan LLC', '1 Harbor Way', Decimal('250000.00'),
+                       Decimal('2083.33'), datetime(2025, 6, 15), EARLIER_INVOICE)
+    ], Decimal('2083.33'), 1, excluded=(
+        BusinessRecord('fixture-funded-closed-covered', 'Parity Single Loan LLC', '2 Harbor Way',
+                       Decimal('240000.00'), Decimal('2000.00'), datetime(2026, 1, 8), None),
+        BusinessRecord('fixture-funded-closed-invoice-month', 'Parity Single Loan LLC', '3 Harbor Way',
+                       Decimal('230000.00'), Decimal('1916.67'), datetime(2026, 2, 3), None)
+    )),
+    # 30 loans, 30 * 1,000 + (1 + ... + 30) = 30,465. The template puts 12 rows on the first
+    # page and 18 on the second, but only 11 and 17 fit, so rows 12 and 30 each flow onto a page
+    ParityFixture('client', 'Parity Many Loans LLC', _client_rows('Parity Many Loans LLC', 30),
+                  Decimal('30465.00'), 4),
+    # Investor amounts come prorated from the sheet, so first/last month rows are only flagged:
+    # 812.50 + 580.00 + 400.00, flagged for 31 - 10 + 1 = 22 days and 20 days. The summary and
+    # prorated rows push the footer onto a second page
+    ParityFixture('investor', 'Parity Investor', [
+        InvestorRecord('fixture-promissory-full', 'Parity Investor', 'PAR-1', datetime(2025, 3, 1), None,
+                       Decimal('97500.00'), Decimal('10.00'), Decimal('812.50'), EARLIER_INVOICE),
+        InvestorRecord('fixture-promissory-first', 'Parity Investor', 'PAR-2', datetime(2026, 1, 10), None,
+                       Decimal('60000.00'), Decimal('11.60'), Decimal('580.00'), None),
+        InvestorRecord('fixture-promissory-last', 'Parity Investor', 'PAR-3', datetime(2025, 4, 1),
+                       datetime(2026, 1, 20), Decimal('48000.00'), Decimal('10.00'), Decimal('400.00'),
+                       EARLIER_INVOICE)
+    ], Decimal('1792.50'), 2, (22, 20)),
+    # A closed loan paid off mid-month gets its last, flagged month: 700.00 + 350.00, flagged for
+    # 14 days. Loans funded in the invoice month or after the invoice date, and a loan paid off
+    # before the covered month, aren't invoiced
+    ParityFixture('investor', 'Parity Investor Payoffs', [
+        InvestorRecord('fixture-promissory-open', 'Parity Investor Payoffs', 'PAY-1', datetime(2025, 5, 1), None,
+                       Decimal('84000.00'), Decimal('10.00'), Decimal('700.00'), EARLIER_INVOICE),
+        InvestorRecord('fixture-promissory-paid-off', 'Parity Investor Payoffs', 'PAY-2', datetime(2025, 2, 1),
+                       datetime(2026, 1, 14), Decimal('42000.00'), Decimal('10.00'), Decimal('350.00'),
+                       EARLIER_INVOICE)
+    ], Decimal('1050.00'), 1, (14,), excluded=(
+        InvestorRecord('fixture-promissory-invoice-month', 'Parity Investor Payoffs', 'PAY-3',
+                       datetime(2026, 2, 1), None, Decimal('36000.00'), Decimal('10.00'), Decimal('300.00'), None),
+        InvestorRecord('fixture-promissory-future', 'Parity Investor Payoffs', 'PAY-4', datetime(2026, 3, 10),
+                       None, Decimal('30000.00'), Decimal('10.00'), Decimal('250.00'), None),
+        InvestorRecord('fixture-promissory-paid-off-earlier', 'Parity Investor Payoffs', 'PAY-5',
+                       datetime(2024, 6, 1), datetime(2025, 12, 20), Decimal('24000.00'), Decimal('10.00'),
+                       Decimal('200.00'), EARLIER_INVOICE)
+    )),
+    # Cap investor amounts are prorated over a 30-day month:
+    # 1,500.00 full + 900.00 / 30 * 15 (funded the 17th) + 1,000.00 / 30 * 12 (paid off the 12th)
+    # + 1,234.56 / 30 * 7 = 288.064, rounded to 288.06 (paid off the 7th) = 2,638.06. The footer
+    # flows onto a second page. A future-funded loan and one paid off in December aren't invoiced
+    ParityFixture('capinvestor', 'Parity Cap Investor', [
+        CapInvestorRecord('fixture-capinvestor-full', 'Parity Cap Investor', '10 Full Month Rd',
+                          datetime(2025, 1, 5), None, Decimal('180000.00'), Decimal('10.00'),
+                          Decimal('1500.00'), EARLIER_INVOICE),
+        CapInvestorRecord('fixture-capinvestor-first', 'Parity Cap Investor', '20 First Month Rd',
+                          datetime(2026, 1, 17), None, Decimal('108000.00'), Decimal('10.00'),
+                          Decimal('900.00'), None),
+        CapInvestorRecord('fixture-capinvestor-last', 'Parity Cap Investor', '30 Last Month Rd',
+                          datetime(2024, 9, 1), datetime(2026, 1, 12), Decimal('120000.00'), Decimal('10.00'),
+                          Decimal('1000.00'), EARLIER_INVOICE),
+        CapInvestorRecord('fixture-capinvestor-rounded', 'Parity Cap Investor', '40 Rounding Ln',
+                          datetime(2024, 9, 1), datetime(2026, 1, 7), Decimal('150000.00'), Decimal('9.88'),
+                          Decimal('1234.56'), EARLIER_INVOICE)
+    ], Decimal('2638.06'), 2, (15, 12, 7), excluded=(
+        CapInvestorRecord('fixture-capinvestor-future', 'Parity Cap Investor', '60 Future Ave',
+                          datetime(2026, 2, 10), None, Decimal('96000.00'), Decimal('10.00'),
+                          Decimal('800.00'), None),
+        CapInvestorRecord('fixture-capinvestor-paid-off-earlier', 'Parity Cap Investor', '70 Paid Off Pl',
+                          datetime(2024, 9, 1), datetime(2025, 12, 28), Decimal('84000.00'), Decimal('10.00'),
+                          Decimal('700.00'), EARLIER_INVOICE)
+    )),
+    # Funded the 5th and paid off the 25th of the same month: the last month wins, so as in the
+    # Node generator's calculateLastMonthProration the row covers the payoff day's 25 days,
+    # 600.00 / 30 * 25 = 500.00, not the 20 days between funding and payoff
+    ParityFixture('capinvestor', 'Parity Same Month Payoff', [
+        CapInvestorRecord('fixture-capinvestor-same-month', 'Parity Same Month Payoff', '50 Short Term Ct',
+                          datetime(2026, 1, 5), datetime(2026, 1, 25), Decimal('72000.00'), Decimal('10.00'),
+                          Decimal('600.00'), None)
+    ], Decimal('500.00'), 1, (25,))
+]
+
+
+def fixture_tables(fixtures: List[ParityFixture] = None) -> Dict[str, List[Dict]]:
+    """
+    Source table rows for the fixtures' records, invoiced and excluded, as generate_dataset() returns them
+
+    Loans with a payoff date are closed ('closed', or 'Paid Off' for cap
+    investors); the others are active ('active', 'Funded').
+    """
+    tables = {}
+    for fixture in fixtures or FIXTURES:
+        table = ROLE_TABLES[fixture.role][0]
+        for record in [*fixture.records, *fixture.excluded]:
+            row = record._asdict()
+            if table == 'promissory':
+                row['status'] = 'closed' if record.payoff_date else 'active'
+            elif table == 'capinvestor':
+                row['loan_status'] = 'Paid Off' if record.payoff_date else 'Funded'
+            tables.setdefault(table, []).append(row)
+    return tables
@@ -0,0 +1,165 @@
+"""
+Render engine parity check (benchmark_invoices.py --engine-parity)
+
+Renders each invoice with WeasyPrint, the reference engine, and with another
+engine, and compares what a reader gets from the two PDFs: the page count,
+the words of the whole document as a multiset (so line wrapping and drawing
+order don't matter, and case is ignored since both engines apply the
+stylesheet's text-transform themselves), the invoice total, the number of
+line items shown and the page the total lands on (the footer may flow onto a
+page of its own).
+
+Agreement alone would pass two engines that are wrong in the same way, so
+check_fixtures also renders the hand-built invoices in benchmarks/fixtures.py
+and checks each engine's PDF against their known totals, line items and pages.
+"""
+import io
+import re
+from collections import Counter
+from typing import Dict, List
+
+from generate_invoices import render_invoice
+from benchmarks.fixtures import FIXTURES, FIXTURE_INVOICE_DATE, ParityFixture
+from invoice_generator.pdf_generator import PDFGenerator, format_currency
+from invoice_generator.pipeline import RenderedInvoice
+from invoice_generator.records import Record
+
+# Words listed per side when the documents' words differ
+MAX_LISTED_WORDS = 10
+
+PRORATION_NOTE = re.compile(r'Prorated (\d+) days', re.IGNORECASE)
+
+
+def extract_pages(pdf_content: bytes) -> List[str]:
+    """Text of each page, as extracted by pypdf"""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise RuntimeError("--engine-parity needs the 'pypdf' package: "
+                           "pip3 install -r requirements-reportlab.txt")
+    return [page.extract_text() or '' for page in PdfReader(io.BytesIO(pdf_content)).pages]
+
+
+def _words(pages: List[str]) -> Counter:
+    return Counter(word.casefold() for page in pages for word in page.split())
+
+
+def _total_page(pages: List[str], total: str):
+    """Number of the last page showing `total`, or None"""
+    for number in range(len(pages), 0, -1):
+        if total in pages[number - 1]:
+            return number
+    return None
+
+
+def _line_items(pages: List[str], records: List[Record]) -> int:
+    """How many of `records` the document shows a row for, found by their loan amounts"""
+    text = '\n'.join(pages)
+    return sum(1 for record in records if format_currency(record.loan_amount) in text)
+
+
+def _listed(words: Counter) -> str:
+    listed = sorted(words.elements())
+    more = f" (+{len(listed) - MAX_LISTED_WORDS} more)" if len(listed) > MAX_LISTED_WORDS else ''
+    return ' '.join(listed[:MAX_LISTED_WORDS]) + more
+
+
+def compare_invoices(reference: RenderedInvoice, candidate: RenderedInvoice,
+                     records: List[Record] = None) -> List[str]:
+    """
+    Differences a reader would see between two renders of the same invoice
+
+    Args:
+        records: The invoice's records, to also compare how many line items
+            each render shows
+
+    Returns:
+        List of human-readable differences; empty when the renders match
+    """
+    reference_pages = extract_pages(reference.pdf_content)
+    candidate_pages = extract_pages(candidate.pdf_content)
+    differences = []
+    if len(reference_pages) != len(candidate_pages):
+        differences.append(f"{len(reference_pages)} pages, {len(candidate_pages)} with the candidate engine")
+    if reference.total_amount != candidate.total_amount:
+        differences.append(f"Total {format_currency(reference.total_amount)}, "
+                           f"{format_currency(candidate.total_amount)} with the candidate engine")
+    if records is not None:
+        reference_items = _line_items(reference_pages, records)
+        candidate_items = _line_items(candidate_pages, records)
+        if reference_items != candidate_items:
+            differences.append(f"{reference_items} line items, {candidate_items} with the candidate engine")
+
+    total = format_currency(reference.total_amount)
+    reference_total_page = _total_page(reference_pages, total)
+    candidate_total_page = _total_page(candidate_pages, total)
+    if reference_total_page is None or candidate_total_page is None:
+        for engine, page in (('reference', reference_total_page), ('candidate', candidate_total_page)):
+            if page is None:
+                differences.append(f"Total {total} missing with the {engine} engine")
+    elif reference_total_page != candidate_total_page:
+        differences.append(f"Total {total} on page {reference_total_page}, "
+                           f"page {candidate_total_page} with the candidate engine")
+
+    reference_words = _words(reference_pages)
+    candidate_words = _words(candidate_pages)
+    if reference_words != candidate_words:
+        missing = reference_words - candidate_words
+        extra = candidate_words - reference_words
+        if missing:
+            differences.append(f"Words missing with the candidate engine: {_listed(missing)}")
+        if extra:
+            differences.append(f"Extra words with the candidate engine: {_listed(extra)}")
+    return differences
+
+
+def check_invoice(invoice: RenderedInvoice, fixture: ParityFixture) -> List[str]:
+    """
+    Differences between one render of a fixture and what the fixture expects
+
+    Returns:
+        List of human-readable differences; empty when the render is right
+    """
+    pages = extract_pages(invoice.pdf_content)
+    differences = []
+    expected_total = format_currency(fixture.total)
+    if invoice.total_amount != fixture.total:
+        differences.append(f"Total {format_currency(invoice.total_amount)}, expected {expected_total}")
+    if _total_page(pages, expected_total) is None:
+        differences.append(f"Total {expected_total} not shown")
+    line_items = _line_items(pages, fixture.records)
+    if line_items != len(fixture.records):
+        differences.append(f"{line_items} line items shown, expected {len(fixture.records)}")
+    if len(pages) != fixture.pages:
+        differences.append(f"{len(pages)} pages, expected {fixture.pages}")
+    prorated_days = sorted(int(days) for days in PRORATION_NOTE.findall('\n'.join(pages)))
+    if prorated_days != sorted(fixture.prorated_days):
+        differences.append(f"Prorated days {prorated_days}, expected {sorted(fixture.prorated_days)}")
+    return differences
+
+
+def check_fixtures(generators: Dict[str, PDFGenerator], reference: str = 'weasyprint') -> List[Dict]:
+    """
+    Render every fixture with each engine; check each PDF against its fixture
+    and every other engine's PDF against `reference`'s
+
+    Returns:
+        One {'role', 'name', 'records', 'differences'} entry per fixture that
+        failed; empty when every engine is right and they all agree
+    """
+    mismatches = []
+    for fixture in FIXTURES:
+        differences = []
+        invoices = {}
+        for engine, pdf_gen in generators.items():
+            invoices[engine] = render_invoice(pdf_gen, fixture.role, fixture.name, fixture.records,
+                                              FIXTURE_INVOICE_DATE)
+            differences.extend(f"{engine}: {difference}" for difference in check_invoice(invoices[engine], fixture))
+        for engine, invoice in invoices.items():
+            if engine != reference and reference in invoices:
+                differences.extend(f"{engine} vs {reference}: {difference}" for difference in
+                                   compare_invoices(invoices[reference], invoice, fixture.records))
+        if differences:
+            mismatches.append({'role': fixture.role, 'name': fixture.name, 'records': len(fixture.records),
+                               'differences': differences})
+    return mismatches
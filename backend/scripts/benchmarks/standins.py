@@ -0,0 +1,199 @@
+"""
+Local stand-ins for DatabaseManager and S3Uploader
+
+Both time the same metrics stages as the real classes, so benchmark reports
+line up with production run reports.
+"""
+import re
+import time
+import sqlite3
+import threading
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import groupby
+from operator import attrgetter
+from typing import Dict, Iterator, List, Tuple
+
+from invoice_generator.database import DatabaseManager, ROLE_QUERIES, record_query_params
+from invoice_generator.storage import StorageBackend
+from invoice_generator.metrics import metrics
+from invoice_generator.proration import InvoiceLines
+from invoice_generator.records import Record, ROLE_RECORD_TYPES
+
+from .synthetic import TABLE_COLUMNS
+
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_adapter(datetime, datetime.isoformat)
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_converter('DECIMAL', lambda value: Decimal(value.decode()))
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+
+INVOICES_TABLE = """
+    CREATE TABLE invoices (
+        id INTEGER PRIMARY KEY,
+        business_name TEXT NOT NULL,
+        role TEXT NOT NULL,
+        invoice_date TEXT NOT NULL,
+        file_name TEXT NOT NULL,
+        s3_key TEXT NOT NULL,
+        s3_url TEXT NOT NULL,
+        total_amount DECIMAL,
+        record_count INTEGER,
+        source_fingerprint TEXT,
+        created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (business_name, role, invoice_date)
+    )
+"""
+
+LINE_ITEMS_TABLE = """
+    CREATE TABLE invoice_line_items (
+        invoice_id INTEGER NOT NULL,
+        loan_table TEXT NOT NULL,
+        loan_id TEXT NOT NULL,
+        loan_identifier TEXT,
+        original_amount DECIMAL NOT NULL,
+        prorated_amount DECIMAL NOT NULL,
+        is_prorated INTEGER NOT NULL,
+        proration_type TEXT,
+        period_start_date TEXT NOT NULL,
+        period_end_date TEXT NOT NULL,
+        days_in_period INTEGER NOT NULL,
+        total_days_in_month INTEGER NOT NULL
+    )
+"""
+
+
+def sqlite_query(query: str) -> str:
+    """A psycopg2 query in SQLite's dialect: :name parameters, and LIKE (case-insensitive there) for ILIKE"""
+    return re.sub(r'%\((\w+)\)s', r':\1', query).replace(' ILIKE ', ' LIKE ')
+
+
+def _dict_factory(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLiteDatabaseManager(DatabaseManager):
+    """
+    DatabaseManager over an SQLite database, loaded from generate_dataset()
+
+    Runs the production record queries, translated by sqlite_query; records
+    come back as the same row types as DatabaseManager's, with Decimal and
+    datetime values.
+    """
+
+    def __init__(self, path: str = ':memory:'):
+        super().__init__(path)
+
+    def connect(self):
+        """Open the database and create the invoice tables"""
+        self.conn = sqlite3.connect(self.database_url, detect_types=sqlite3.PARSE_DECLTYPES,
+                                    check_same_thread=False)
+        self.conn.row_factory = _dict_factory
+        self.conn.execute(INVOICES_TABLE)
+        self.conn.execute(LINE_ITEMS_TABLE)
+        return self.conn
+
+    def load(self, dataset: Dict[str, List[Dict]]):
+        """Create and fill the source tables"""
+        for table, rows in dataset.items():
+            columns = TABLE_COLUMNS[table]
+            self.conn.execute(f"CREATE TABLE {table} ({', '.join(f'{c} {t}' for c, t in columns.items())})")
+            self.conn.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                [tuple(row.get(column) for column in columns) for row in rows]
+            )
+        self.conn.commit()
+
+    def _record_cursor(self, role: str) -> sqlite3.Cursor:
+        """Cursor returning the role's row type instead of dicts"""
+        make = ROLE_RECORD_TYPES[role]._make
+        cursor = self.conn.cursor()
+        cursor.row_factory = lambda cursor, row: make(row)
+        return cursor
+
+    def get_all_role_records(self, role: str, invoice_date) -> Dict[str, List[Record]]:
+        query, key = ROLE_QUERIES[role]
+        with metrics.stage('db_fetch'):
+            cursor = self._record_cursor(role).execute(sqlite_query(query), record_query_params(invoice_date))
+            return self._group_records(cursor.fetchall(), key)
+
+    def iter_role_record_groups(self, role: str, invoice_date,
+                                itersize: int = 2000) -> Iterator[Tuple[str, List[Record]]]:
+        query, key = ROLE_QUERIES[role]
+        with metrics.stage('db_fetch'):
+            cursor = self._record_cursor(role).execute(sqlite_query(query), record_query_params(invoice_date))
+            cursor.arraysize = itersize
+        groups = groupby(cursor, key=attrgetter(key))
+        while True:
+            with metrics.stage('db_fetch'):
+                try:
+                    name, rows = next(groups)
+                    records = list(rows)
+                except StopIteration:
+                    break
+            yield name, records
+
+    def get_invoice_fingerprints(self, role: str, invoice_date: date) -> Dict[str, str]:
+        rows = self.conn.execute("""
+            SELECT business_name, source_fingerprint
+            FROM invoices
+            WHERE role = ?
+            AND invoice_date = ?
+            AND source_fingerprint IS NOT NULL
+        """, (role, invoice_date.isoformat())).fetchall()
+        return {row['business_name']: row['source_fingerprint'] for row in rows}
+
+    def save_invoice_record(self, business_name: str, role: str, invoice_date: date,
+                            file_name: str, s3_key: str, s3_url: str,
+                            total_amount: float, record_count: int, source_fingerprint: str = None,
+                            line_items: InvoiceLines = None):
+        with metrics.stage('metadata_save'), self._write_lock:
+            cursor = self.conn.execute("""
+                INSERT INTO invoices
+                (business_name, role, invoice_date, file_name, s3_key, s3_url, total_amount, record_count,
+                 source_fingerprint)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (business_name, role, invoice_date)
+                DO UPDATE SET
+                    file_name = excluded.file_name,
+                    s3_key = excluded.s3_key,
+                    s3_url = excluded.s3_url,
+                    total_amount = excluded.total_amount,
+                    record_count = excluded.record_count,
+                    source_fingerprint = excluded.source_fingerprint,
+                    updated_at = CURRENT_TIMESTAMP
+                RETURNING id
+            """, (business_name, role, invoice_date, file_name, s3_key, s3_url, total_amount, record_count,
+                  source_fingerprint))
+            invoice_id = cursor.fetchone()['id']
+            if line_items is not None:
+                self.conn.execute("DELETE FROM invoice_line_items WHERE invoice_id = ?", (invoice_id,))
+                self.conn.executemany(
+                    "INSERT INTO invoice_line_items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(invoice_id, line_items.loan_table) + row for row in line_items.rows()]
+                )
+            self.conn.commit()
+
+
+class InMemoryS3Uploader(StorageBackend):
+    """Storage backend that keeps objects in a dict, with optional simulated request latency"""
+
+    def __init__(self, bucket_name: str = 'benchmark-invoices', latency: float = 0.0):
+        """
+        Args:
+            latency: Seconds each upload sleeps, to stand in for the S3 round trip
+        """
+        self.bucket_name = bucket_name
+        self.latency = latency
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def upload_pdf(self, pdf_content: bytes, s3_key: str, record_count: int = None) -> str:
+        with metrics.stage('s3_upload'):
+            if self.latency:
+                time.sleep(self.latency)
+            with self._lock:
+                self.objects[s3_key] = pdf_content
+        metrics.increment('bytes_uploaded', len(pdf_content))
+        return f"memory://{self.bucket_name}/{s3_key}"
@@ -0,0 +1,145 @@
+"""
+Synthetic funded / promissory / capinvestor rows for benchmarking
+"""
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Dict, List
+
+CENT = Decimal('0.01')
+
+# Column -> SQL type for each table, mirroring the Sequelize models
+TABLE_COLUMNS = {
+    'funded': {
+        'id': 'TEXT', 'business_name': 'TEXT', 'project_address': 'TEXT',
+        'construction_cost': 'DECIMAL', 'construction_left_in_escrow': 'DECIMAL',
+        'loan_amount': 'DECIMAL', 'interest_rate': 'DECIMAL', 'interest_payment': 'DECIMAL',
+        'maturity_date': 'TIMESTAMP', 'closing_date': 'TIMESTAMP', 'last_seen_at': 'TIMESTAMP',
+        'email': 'TEXT', 'first_name': 'TEXT', 'last_name': 'TEXT',
+        'first_invoice_generated_at': 'TIMESTAMP', 'created_at': 'TIMESTAMP', 'updated_at': 'TIMESTAMP'
+    },
+    'promissory': {
+        'id': 'TEXT', 'status': 'TEXT', 'investor_name': 'TEXT', 'investor_email': 'TEXT',
+        'asset_id': 'TEXT', 'type': 'TEXT', 'fund_date': 'TIMESTAMP', 'maturity_date': 'TIMESTAMP',
+        'loan_amount': 'DECIMAL', 'payoff_date': 'TIMESTAMP', 'interest_rate': 'DECIMAL',
+        'capital_pay': 'DECIMAL', 'year_to_date': 'DECIMAL', 'last_seen_at': 'TIMESTAMP',
+        'first_invoice_generated_at': 'TIMESTAMP', 'created_at': 'TIMESTAMP', 'updated_at': 'TIMESTAMP'
+    },
+    'capinvestor': {
+        'id': 'TEXT', 'property_address': 'TEXT', 'investor_name': 'TEXT',
+        'loan_amount': 'DECIMAL', 'interest_rate': 'DECIMAL', 'payment': 'DECIMAL',
+        'fund_date': 'TIMESTAMP', 'payoff_date': 'TIMESTAMP', 'loan_status': 'TEXT',
+        'last_seen_at': 'TIMESTAMP', 'first_invoice_generated_at': 'TIMESTAMP', 'year_to_date': 'DECIMAL',
+        'created_at': 'TIMESTAMP', 'updated_at': 'TIMESTAMP'
+    }
+}
+
+# Role -> (table, entity name column, entity name prefix)
+ROLE_TABLES = {
+    'client': ('funded', 'business_name', 'Synthetic Business'),
+    'investor': ('promissory', 'investor_name', 'Synthetic Investor'),
+    'capinvestor': ('capinvestor', 'investor_name', 'Synthetic Capital')
+}
+
+STREETS = ('Ocean Ave', 'Main St', 'Harbor Dr', 'Palm Way', 'Bay Blvd', 'Dune Rd', 'Pier Ln', 'Coral Ct')
+
+
+def entity_sizes(entities: int, min_rows: int = 1, max_rows: int = 500, skew: float = 1.16,
+                 rng: random.Random = None) -> List[int]:
+    """
+    Rows per entity drawn from a Pareto distribution clipped to [min_rows, max_rows]
+
+    A smaller `skew` gives a heavier tail (1.16 is roughly 80/20). The first
+    entity always gets min_rows and the second max_rows so both extremes of
+    split_records_into_pages are exercised; the list is then shuffled.
+    """
+    rng = rng or random.Random()
+    sizes = [min(max_rows, int(min_rows * rng.paretovariate(skew))) for _ in range(entities)]
+    if entities > 0:
+        sizes[0] = min_rows
+    if entities > 1:
+        sizes[1] = max_rows
+    rng.shuffle(sizes)
+    return sizes
+
+
+def _money(rng: random.Random, low: int, high: int) -> Decimal:
+    return Decimal(rng.randrange(low, high, 500))
+
+
+def _rate(rng: random.Random) -> Decimal:
+    return Decimal(rng.randrange(800, 1400, 25)) / 100
+
+
+def _date(rng: random.Random, now: datetime, min_days: int, max_days: int) -> datetime:
+    return now - timedelta(days=rng.randint(min_days, max_days))
+
+
+def _row(table: str, name: str, index: int, rng: random.Random, now: datetime) -> Dict:
+    loan_amount = _money(rng, 50000, 1000000)
+    rate = _rate(rng)
+    monthly = (loan_amount * rate / 100 / 12).quantize(CENT)
+    # ~5% closed before the covered month (filtered out by the queries), ~5% closed
+    # during it (the month `now` falls in), billed for their last month
+    closed = rng.random() < 0.05
+    paid_off = rng.random() < 0.05
+    payoff = (_date(rng, now, 60, 360) if closed
+              else now.replace(day=1) + timedelta(days=rng.randint(0, 27)) if paid_off else None)
+    address = f"{rng.randint(1, 9999)} {rng.choice(STREETS)} #{index}"
+    row = {'id': str(uuid.UUID(int=rng.getrandbits(128))), 'last_seen_at': now,
+           'first_invoice_generated_at': None, 'created_at': now, 'updated_at': now}
+
+    if table == 'funded':
+        cost = _money(rng, 20000, 400000)
+        row.update({
+            'business_name': name, 'project_address': address,
+            'construction_cost': cost, 'construction_left_in_escrow': (cost / 2).quantize(CENT),
+            'loan_amount': loan_amount, 'interest_rate': rate, 'interest_payment': monthly,
+            'maturity_date': now + timedelta(days=rng.randint(30, 720)),
+            'closing_date': _date(rng, now, 1, 720), 'email': 'billing@example.com',
+            'first_name': 'Synthetic', 'last_name': f'Borrower {index}'
+        })
+    elif table == 'promissory':
+        row.update({
+            'status': 'closed' if closed or paid_off else rng.choice(('active', 'Active')), 'investor_name': name,
+            'investor_email': 'investor@example.com', 'asset_id': f'A-{index:06d}', 'type': 'note',
+            'fund_date': _date(rng, now, 1, 720), 'maturity_date': now + timedelta(days=rng.randint(30, 720)),
+            'loan_amount': loan_amount, 'payoff_date': payoff, 'interest_rate': rate,
+            'capital_pay': monthly, 'year_to_date': monthly * now.month
+        })
+    else:
+        row.update({
+            'property_address': address, 'investor_name': name, 'loan_amount': loan_amount,
+            'interest_rate': rate, 'payment': monthly, 'fund_date': _date(rng, now, 1, 720),
+            'payoff_date': payoff, 'loan_status': 'Paid Off' if closed or paid_off else 'Funded',
+            'year_to_date': monthly * now.month
+        })
+    return row
+
+
+def generate_dataset(entities: int = 100, min_rows: int = 1, max_rows: int = 500, skew: float = 1.16,
+                     seed: int = 42, roles=None) -> Dict[str, List[Dict]]:
+    """
+    Build reproducible rows for each table
+
+    Args:
+        entities: Businesses/investors per role
+        min_rows / max_rows / skew: Rows-per-entity distribution, see entity_sizes
+        seed: Random seed; the same arguments always give the same rows
+        roles: Roles to generate (default: all)
+
+    Returns:
+        {table name: [row dicts]}
+    """
+    rng = random.Random(seed)
+    now = datetime(2026, 1, 15, tzinfo=timezone.utc)
+    dataset = {}
+    for role in roles or ROLE_TABLES:
+        table, _, prefix = ROLE_TABLES[role]
+        rows = []
+        for entity, size in enumerate(entity_sizes(entities, min_rows, max_rows, skew, rng)):
+            name = f'{prefix} {entity:05d}'
+            rows.extend(_row(table, name, len(rows) + i, rng, now) for i in range(size))
+        dataset[table] = rows
+    return dataset
@@ -5,29 +5,65 @@ Generates invoice PDFs for all businesses and investors and uploads to S3
 """
 import os
 import sys
+import json
+import shutil
+import time
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import util as mp_util
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
+from dataclasses import asdict
+from typing import TYPE_CHECKING, List, Dict, Set
 import logging
 from dotenv import load_dotenv
 
 # Add the current directory to Python path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from invoice_generator.database import DatabaseManager
-from invoice_generator.pdf_generator import PDFGenerator
+from invoice_generator.database import DatabaseManager, EntitySummary, InvoiceRecordWriter
+from invoice_generator.pdf_generator import ENGINES, PDFGenerator
 from invoice_generator.s3_uploader import S3Uploader
+from invoice_generator.storage import StorageBackend, LocalDirectoryStorage, ArchiveStorage, ARCHIVE_SUFFIXES
+from invoice_generator.pipeline import InvoicePipeline, RenderedInvoice
+from invoice_generator.fingerprint import invoice_fingerprint
+from invoice_generator.journal import RunJournal, UPLOADED, RECORDED
+from invoice_generator.metrics import metrics, STAGES
+from invoice_generator import profiling
+from invoice_generator.profiling import ProfileSettings
+from invoice_generator.proration import InvoiceLines, prorate, prorate_role
+from invoice_generator.records import Record
+from invoice_generator.scheduling import CostModel, largest_first, makespan_bound
+from invoice_generator.sharding import Shard, parse_shard, merge_shard_reports, load_reports
+from invoice_generator.stats import RunStats
+
+if TYPE_CHECKING:
+    # asyncpg and aioboto3 are only imported for --async
+    from invoice_generator.async_engine import AsyncDatabaseManager, AsyncS3Uploader
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('invoice_generation.log'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
 logger = logging.getLogger(__name__)
 
+# Per-process components for --workers mode, built once by _init_worker
+_worker_state = {}
+
+
+def setup_logging():
+    """
+    Log to invoice_generation.log and stdout
+
+    Called by main() and the worker initializers rather than at import, so
+    importing this module (the benchmark does) has no side effects. Does
+    nothing if logging is already configured, e.g. in a forked worker.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('invoice_generation.log'),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+
 
 def generate_file_name(business_name: str, invoice_date: datetime) -> str:
     """
@@ -47,160 +83,1061 @@ def generate_file_name(business_name: str, invoice_date: datetime) -> str:
     return f"{clean_name}_{date_str}.pdf"
 
 
-def process_business(db: DatabaseManager, pdf_gen: PDFGenerator, s3: S3Uploader,
-                    business_name: str, invoice_date: datetime, logo_url: str = None):
-    """Process invoice for a single business (client/borrower)"""
-    try:
-        logger.info(f"Processing business: {business_name}")
+# Role -> suffix for the invoice total in log lines
+ROLE_TOTAL_SUFFIX = {
+    'client': '',
+    'investor': '/month',
+    'capinvestor': '/month'
+}
 
-        # Get records
-        records = db.get_business_records(business_name)
 
-        if not records:
-            logger.warning(f"No records found for business: {business_name}")
-            return
+def render_invoice(pdf_gen: PDFGenerator, role: str, name: str, records: List[Record],
+                   invoice_date: datetime, logo_url: str = None, fingerprint: str = None,
+                   lines: InvoiceLines = None) -> RenderedInvoice:
+    """
+    Render the invoice PDF for one business/investor
+
+    Args:
+        role: 'client', 'investor', or 'capinvestor'
+        name: Name of business/investor
+        records: The entity's loan/investment records
+        fingerprint: Source fingerprint, if the caller already computed it
+        lines: Line items from prorate_role, if the caller already computed them
 
-        # Generate PDF
+    Returns:
+        RenderedInvoice: PDF content plus the metadata needed to store it
+    """
+    if lines is None:
+        with metrics.stage('prorate'):
+            lines = prorate(role, name, records, invoice_date)
+
+    with profiling.entity(role, name):
+        render_start = time.perf_counter()
         pdf_content = pdf_gen.generate_invoice_pdf(
-            business_name=business_name,
-            role='client',
+            business_name=name,
+            role=role,
             records=records,
             invoice_date=invoice_date,
-            logo_url=logo_url
+            logo_url=logo_url,
+            lines=lines
         )
+        render_seconds = time.perf_counter() - render_start
+
+    return RenderedInvoice(
+        role=role,
+        business_name=name,
+        invoice_date=invoice_date,
+        file_name=generate_file_name(name, invoice_date),
+        pdf_content=pdf_content,
+        total_amount=lines.total,
+        record_count=len(records),
+        source_fingerprint=fingerprint or invoice_fingerprint(
+            role, name, records, invoice_date, pdf_gen.template_version, logo_url),
+        line_items=lines,
+        render_seconds=render_seconds
+    )
 
-        # Generate file name
-        file_name = generate_file_name(business_name, invoice_date)
-
-        # Upload to S3
-        s3_key = s3.generate_s3_key('client', business_name, file_name)
-        s3_url = s3.upload_pdf(pdf_content, s3_key)
-
-        # Calculate total
-        total_amount = sum(float(r.get('interest_payment', 0) or 0) for r in records)
-
-        # Save to database
-        db.save_invoice_record(
-            business_name=business_name,
-            role='client',
-            invoice_date=invoice_date.date(),
-            file_name=file_name,
-            s3_key=s3_key,
-            s3_url=s3_url,
-            total_amount=total_amount,
-            record_count=len(records)
+
+def render_invoice_batch(pdf_gen: PDFGenerator, role: str, batch: List[tuple], invoice_date: datetime,
+                         logo_url: str = None) -> List[RenderedInvoice]:
+    """
+    Render several small invoices of one role from a single WeasyPrint document (see PDFGenerator.batchable)
+
+    Args:
+        batch: (name, records, fingerprint, lines) per invoice; fingerprint and
+            lines are computed when None
+
+    Returns:
+        List[RenderedInvoice], in batch order
+    """
+    prorated = []
+    for name, records, fingerprint, lines in batch:
+        if lines is None:
+            with metrics.stage('prorate'):
+                lines = prorate(role, name, records, invoice_date)
+        prorated.append((name, records, fingerprint, lines))
+
+    render_start = time.perf_counter()
+    pdfs = pdf_gen.generate_invoice_pdfs([(name, role, records, lines) for name, records, _, lines in prorated],
+                                         invoice_date, logo_url)
+    # Invoices share the batch's render time by the pages each one laid out
+    seconds_per_page = (time.perf_counter() - render_start) / sum(pages for _, pages in pdfs)
+    return [
+        RenderedInvoice(
+            role=role,
+            business_name=name,
+            invoice_date=invoice_date,
+            file_name=generate_file_name(name, invoice_date),
+            pdf_content=pdf_content,
+            total_amount=lines.total,
+            record_count=len(records),
+            source_fingerprint=fingerprint or invoice_fingerprint(
+                role, name, records, invoice_date, pdf_gen.template_version, logo_url),
+            line_items=lines,
+            render_seconds=seconds_per_page * pages
         )
+        for (name, records, fingerprint, lines), (pdf_content, pages) in zip(prorated, pdfs)
+    ]
 
-        logger.info(f"✓ Successfully processed {business_name}: {len(records)} records, ${total_amount:,.2f}")
+
+def store_invoice(db, s3: StorageBackend, invoice: RenderedInvoice, journal: RunJournal = None) -> str:
+    """
+    Upload a rendered invoice to S3 and save its metadata and line items
+
+    Args:
+        db: DatabaseManager, an InvoiceRecordWriter to batch the metadata save,
+            or None to only store the PDF (local and archive exports)
+        s3: S3 uploader or other storage backend
+        invoice: Rendered invoice from render_invoice
+        journal: Optional run journal to record progress in. When `db` is a
+            writer, the writer's on_flush marks the invoice recorded
+
+    Returns:
+        str: URL of the stored PDF
+    """
+    # Upload to S3
+    s3_key = s3.generate_s3_key(invoice.role, invoice.business_name, invoice.file_name)
+    s3_url = s3.upload_pdf(invoice.pdf_content, s3_key, record_count=invoice.record_count)
+    if journal:
+        journal.mark(invoice.role, invoice.business_name, invoice.invoice_date.date(), UPLOADED)
+    if db is None:
+        logger.info(f"✓ Stored {invoice.business_name}: {invoice.record_count} records at {s3_url}")
+        return s3_url
+
+    # Save to database
+    db.save_invoice_record(
+        business_name=invoice.business_name,
+        role=invoice.role,
+        invoice_date=invoice.invoice_date.date(),
+        file_name=invoice.file_name,
+        s3_key=s3_key,
+        s3_url=s3_url,
+        total_amount=invoice.total_amount,
+        record_count=invoice.record_count,
+        source_fingerprint=invoice.source_fingerprint,
+        line_items=invoice.line_items
+    )
+    if journal and not isinstance(db, InvoiceRecordWriter):
+        journal.mark(invoice.role, invoice.business_name, invoice.invoice_date.date(), RECORDED)
+
+    logger.info(f"✓ Successfully processed {invoice.business_name}: {invoice.record_count} records, "
+                f"${invoice.total_amount:,.2f}{ROLE_TOTAL_SUFFIX[invoice.role]}")
+    return s3_url
+
+
+async def store_invoice_async(db: 'AsyncDatabaseManager', s3: 'AsyncS3Uploader', invoice: RenderedInvoice,
+                              journal: RunJournal = None):
+    """store_invoice for the --async engine"""
+    s3_key = s3.generate_s3_key(invoice.role, invoice.business_name, invoice.file_name)
+    s3_url = await s3.upload_pdf(invoice.pdf_content, s3_key, record_count=invoice.record_count)
+    if journal:
+        journal.mark(invoice.role, invoice.business_name, invoice.invoice_date.date(), UPLOADED)
+
+    await db.save_invoice_record(
+        business_name=invoice.business_name,
+        role=invoice.role,
+        invoice_date=invoice.invoice_date.date(),
+        file_name=invoice.file_name,
+        s3_key=s3_key,
+        s3_url=s3_url,
+        total_amount=invoice.total_amount,
+        record_count=invoice.record_count,
+        source_fingerprint=invoice.source_fingerprint,
+        line_items=invoice.line_items
+    )
+    if journal:
+        journal.mark(invoice.role, invoice.business_name, invoice.invoice_date.date(), RECORDED)
+
+    logger.info(f"✓ Successfully processed {invoice.business_name}: {invoice.record_count} records, "
+                f"${invoice.total_amount:,.2f}{ROLE_TOTAL_SUFFIX[invoice.role]}")
+
+
+def process_business(db: DatabaseManager, pdf_gen: PDFGenerator, s3: S3Uploader,
+                    business_name: str, invoice_date: datetime, logo_url: str = None,
+                    records: List[Record] = None, writer: InvoiceRecordWriter = None,
+                     journal: RunJournal = None):
+    """
+    Process invoice for a single business (client/borrower)
+
+    Returns:
+        bool: False if the invoice failed, True otherwise
+    """
+    try:
+        logger.info(f"Processing business: {business_name}")
+
+        # Get records
+        if records is None:
+            records = db.get_business_records(business_name, invoice_date)
+
+        if not records:
+            logger.warning(f"No records found for business: {business_name}")
+            return True
+
+        invoice = render_invoice(pdf_gen, 'client', business_name, records, invoice_date, logo_url)
+        if journal:
+            journal.mark_rendered('client', business_name, invoice_date.date(), len(records), invoice.render_seconds)
+        store_invoice(writer or db, s3, invoice, journal)
+        return True
 
     except Exception as e:
         logger.error(f"✗ Failed to process business {business_name}: {str(e)}", exc_info=True)
+        return False
 
 
 def process_investor(db: DatabaseManager, pdf_gen: PDFGenerator, s3: S3Uploader,
-                    investor_name: str, invoice_date: datetime, logo_url: str = None):
-    """Process invoice for a single investor (promissory)"""
+                    investor_name: str, invoice_date: datetime, logo_url: str = None,
+                    records: List[Record] = None, writer: InvoiceRecordWriter = None,
+                     journal: RunJournal = None):
+    """
+    Process invoice for a single investor (promissory)
+
+    Returns:
+        bool: False if the invoice failed, True otherwise
+    """
     try:
         logger.info(f"Processing investor: {investor_name}")
 
-        # Get active records
-        records = db.get_investor_records(investor_name)
+        # Get the records invoiced this month
+        if records is None:
+            records = db.get_investor_records(investor_name, invoice_date)
 
         if not records:
-            logger.warning(f"No active records found for investor: {investor_name}")
-            return
+            logger.warning(f"No records to invoice for investor: {investor_name}")
+            return True
 
-        # Generate PDF
-        pdf_content = pdf_gen.generate_invoice_pdf(
-            business_name=investor_name,
-            role='investor',
-            records=records,
-            invoice_date=invoice_date,
-            logo_url=logo_url
-        )
-
-        # Generate file name
-        file_name = generate_file_name(investor_name, invoice_date)
-
-        # Upload to S3
-        s3_key = s3.generate_s3_key('investor', investor_name, file_name)
-        s3_url = s3.upload_pdf(pdf_content, s3_key)
-
-        # Calculate totals
-        total_amount = sum(float(r.get('loan_amount', 0) or 0) for r in records)
-        monthly_interest = sum(float(r.get('capital_pay', 0) or 0) for r in records)
-
-        # Save to database
-        db.save_invoice_record(
-            business_name=investor_name,
-            role='investor',
-            invoice_date=invoice_date.date(),
-            file_name=file_name,
-            s3_key=s3_key,
-            s3_url=s3_url,
-            total_amount=monthly_interest,
-            record_count=len(records)
-        )
-
-        logger.info(f"✓ Successfully processed {investor_name}: {len(records)} records, ${monthly_interest:,.2f}/month")
+        invoice = render_invoice(pdf_gen, 'investor', investor_name, records, invoice_date, logo_url)
+        if journal:
+            journal.mark_rendered('investor', investor_name, invoice_date.date(), len(records), invoice.render_seconds)
+        store_invoice(writer or db, s3, invoice, journal)
+        return True
 
     except Exception as e:
         logger.error(f"✗ Failed to process investor {investor_name}: {str(e)}", exc_info=True)
+        return False
 
 
 def process_cap_investor(db: DatabaseManager, pdf_gen: PDFGenerator, s3: S3Uploader,
-                        investor_name: str, invoice_date: datetime, logo_url: str = None):
-    """Process invoice for a single cap investor"""
+                        investor_name: str, invoice_date: datetime, logo_url: str = None,
+                        records: List[Record] = None, writer: InvoiceRecordWriter = None,
+                         journal: RunJournal = None):
+    """
+    Process invoice for a single cap investor
+
+    Returns:
+        bool: False if the invoice failed, True otherwise
+    """
     try:
         logger.info(f"Processing cap investor: {investor_name}")
 
-        # Get active records
-        records = db.get_cap_investor_records(investor_name)
+        # Get the records invoiced this month
+        if records is None:
+            records = db.get_cap_investor_records(investor_name, invoice_date)
 
         if not records:
-            logger.warning(f"No active records found for cap investor: {investor_name}")
+            logger.warning(f"No records to invoice for cap investor: {investor_name}")
+            return True
+
+        invoice = render_invoice(pdf_gen, 'capinvestor', investor_name, records, invoice_date, logo_url)
+        if journal:
+            journal.mark_rendered('capinvestor', investor_name, invoice_date.date(), len(records),
+                                  invoice.render_seconds)
+        store_invoice(writer or db, s3, invoice, journal)
+        return True
+
+    except Exception as e:
+        logger.error(f"✗ Failed to process cap investor {investor_name}: {str(e)}", exc_info=True)
+        return False
+
+
+# Per-role processing settings, in run order
+ROLES = {
+    'client': {
+        'title': 'Businesses (Clients/Borrowers)',
+        'label': 'business',
+        'plural': 'businesses',
+        'stats_key': 'clients',
+        'processor': process_business
+    },
+    'investor': {
+        'title': 'Investors (Promissory)',
+        'label': 'investor',
+        'plural': 'investors',
+        'stats_key': 'investors',
+        'processor': process_investor
+    },
+    'capinvestor': {
+        'title': 'Cap Investors',
+        'label': 'cap investor',
+        'plural': 'cap investors',
+        'stats_key': 'capinvestors',
+        'processor': process_cap_investor
+    }
+}
+
+
+def current_invoice_date() -> datetime:
+    """Invoices are dated the first of the current month"""
+    return datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+# --since value meaning "since the watermark stored by the last complete run"
+LAST_RUN = 'last-run'
+
+
+def _start_worker_profile(profile: ProfileSettings = None):
+    """Profile a worker process (--profile) until it exits, after its final flushes"""
+    if profile is None:
+        return
+    profiling.start(profile, f'worker-{os.getpid()}')
+    mp_util.Finalize(None, profiling.stop, exitpriority=5)
+
+
+def _init_worker(database_url: str, aws_access_key: str, aws_secret_key: str,
+                 aws_region: str, s3_bucket: str, template_dir: str, batch_size: int = 100,
+                 journal_path: str = None, metrics_dir: str = None, asset_cache_dir: str = None,
+                 optimize_pdf: bool = False, engine: str = 'weasyprint', profile: ProfileSettings = None):
+    """Build the database connection, PDF generator and S3 client once per worker process"""
+    setup_logging()
+    # A forked worker inherits the parent's samples so far; only report its own
+    metrics.reset()
+    _start_worker_profile(profile)
+    db = DatabaseManager(database_url)
+    db.connect()
+    journal = RunJournal(journal_path) if journal_path else None
+    writer = InvoiceRecordWriter(db, batch_size, on_flush=_flush_recorder(journal))
+    # Flush buffered invoice rows before the connection closes when the worker exits
+    mp_util.Finalize(None, db.close, exitpriority=10)
+    mp_util.Finalize(None, writer.close, exitpriority=20)
+    if metrics_dir:
+        # Samples from that final flush never make it back through a task result
+        mp_util.Finalize(None, metrics.dump, args=(os.path.join(metrics_dir, f'{os.getpid()}.json'),),
+                         exitpriority=15)
+
+    _worker_state['db'] = db
+    _worker_state['writer'] = writer
+    _worker_state['journal'] = journal
+    _worker_state['pdf_gen'] = PDFGenerator(template_dir, asset_cache_dir, optimize=optimize_pdf, engine=engine)
+    _worker_state['s3'] = S3Uploader(aws_access_key, aws_secret_key, aws_region, s3_bucket,
+                                     endpoint_url=os.getenv('S3_ENDPOINT_URL'))
+
+
+def _process_in_worker(role: str, name: str, records: List[Record], invoice_date: datetime,
+                       logo_url: str = None):
+    """
+    Run the processor for one entity inside a worker process
+
+    Returns (role, name, ok, metrics) where metrics is the worker's drained
+    samples for the parent to merge.
+    """
+    processor = ROLES[role]['processor']
+    ok = processor(_worker_state['db'], _worker_state['pdf_gen'], _worker_state['s3'],
+                   name, invoice_date, logo_url, records=records, writer=_worker_state['writer'],
+                   journal=_worker_state['journal'])
+    return role, name, ok, metrics.drain()
+
+
+def _init_render_worker(template_dir: str, asset_cache_dir: str = None, optimize_pdf: bool = False,
+                        warm_up: bool = False, engine: str = 'weasyprint', profile: ProfileSettings = None):
+    """Build the PDF generator once per render process (--async with --workers, and the daemon)"""
+    setup_logging()
+    metrics.reset()
+    _start_worker_profile(profile)
+    _worker_state['pdf_gen'] = PDFGenerator(template_dir, asset_cache_dir, optimize=optimize_pdf, engine=engine)
+    if warm_up:
+        _worker_state['pdf_gen'].warm_up()
+
+
+def _render_in_worker(role: str, name: str, records: List[Record], invoice_date: datetime, logo_url: str = None,
+                      fingerprint: str = None, lines: InvoiceLines = None):
+    """Render one invoice inside a render process; returns (invoice, drained metrics)"""
+    invoice = render_invoice(_worker_state['pdf_gen'], role, name, records, invoice_date, logo_url,
+                             fingerprint, lines)
+    return invoice, metrics.drain()
+
+
+def _flush_recorder(journal: RunJournal = None, stats: RunStats = None):
+    """
+    Build an InvoiceRecordWriter on_flush callback for invoices whose batch committed
+
+    Marks them recorded in the journal and, given `stats`, counts them as
+    processed; until then they were only buffered.
+    """
+    if journal is None and stats is None:
+        return None
+
+    def on_flush(keys):
+        for business_name, role, invoice_date in keys:
+            if journal:
+                journal.mark(role, business_name, invoice_date, RECORDED)
+            if stats:
+                stats.record(role, 'processed', business_name)
+    return on_flush
+
+
+def _flush_failure_recorder(stats: RunStats):
+    """Build an InvoiceRecordWriter on_error callback counting a rolled-back batch's invoices as failed"""
+    def on_error(keys):
+        for business_name, role, _ in keys:
+            stats.record(role, 'failed', business_name)
+    return on_error
+
+
+def skip_completed(role: str, groups, completed, stats: RunStats):
+    """
+    Drop entities the run journal already recorded (--resume)
+
+    Args:
+        groups: Iterable of (name, records)
+        completed: Names recorded for this role and invoice date by an earlier run
+    """
+    for name, records in groups:
+        if name in completed:
+            logger.info(f"Already completed in an earlier run, skipping {ROLES[role]['label']}: {name}")
+            stats.record(role, 'skipped', name)
+            continue
+        yield name, records
+
+
+def _skip_unchanged(role: str, name: str, stats: RunStats):
+    logger.info(f"No changes since the watermark, skipping {ROLES[role]['label']}: {name}")
+    stats.record(role, 'skipped', name)
+
+
+def skip_unchanged_since(role: str, groups, changed: Set[str], stats: RunStats):
+    """
+    Drop entities none of whose records changed since the watermark (--since)
+
+    Args:
+        groups: Iterable of (name, records)
+        changed: Names flagged by DatabaseManager.get_entity_changes
+    """
+    for name, records in groups:
+        if name not in changed:
+            _skip_unchanged(role, name, stats)
+            continue
+        yield name, records
+
+
+def select_changed(role: str, changes: Dict[str, bool], stats: RunStats) -> List[str]:
+    """
+    Pick the entities whose records changed since the watermark (--since), skipping the rest
+
+    Only the returned names' records are then read, so the unchanged
+    entities' records never leave the database.
+
+    Args:
+        changes: {name: changed} from DatabaseManager.get_entity_changes
+    """
+    changed = []
+    for name, is_changed in changes.items():
+        if is_changed:
+            changed.append(name)
+        else:
+            _skip_unchanged(role, name, stats)
+    logger.info(f"{len(changed)} of {len(changes)} {ROLES[role]['plural']} changed since the watermark")
+    return changed
+
+
+def fetch_role_records(db: DatabaseManager, role: str, invoice_date: datetime, stats: RunStats,
+                       since: datetime = None) -> Dict[str, List[Record]]:
+    """A role's records grouped by name; with `since`, only the changed entities' (see select_changed)"""
+    if since is None:
+        records_by_name = db.get_all_role_records(role, invoice_date)
+    else:
+        names = select_changed(role, db.get_entity_changes(role, since, invoice_date.date()), stats)
+        records_by_name = db.get_all_role_records(role, invoice_date, names)
+    logger.info(f"Found {len(records_by_name)} {ROLES[role]['plural']}")
+    return records_by_name
+
+
+def is_unchanged(role: str, name: str, records: List[Record], invoice_date: datetime, pdf_gen: PDFGenerator,
+                 fingerprints: Dict[str, str], stats: RunStats, logo_url: str = None):
+    """
+    Check an entity against the fingerprint of its existing invoice
+
+    Returns:
+        tuple: (unchanged, fingerprint). Unchanged entities are logged and counted as skipped.
+    """
+    fingerprint = invoice_fingerprint(role, name, records, invoice_date, pdf_gen.template_version, logo_url)
+    if fingerprints is not None and fingerprints.get(name) == fingerprint:
+        logger.info(f"Unchanged since last run, skipping {ROLES[role]['label']}: {name}")
+        stats.record(role, 'skipped', name)
+        return True, fingerprint
+    return False, fingerprint
+
+
+def load_cost_model(journal: RunJournal = None, roles: List[str] = None) -> CostModel:
+    """Cost model from the render times the run journal kept; record counts only without a journal"""
+    if journal is None:
+        return CostModel()
+    return CostModel({role: journal.render_costs(role) for role in roles or ROLES})
+
+
+def schedule_largest_first(jobs: List[tuple], cost_model: CostModel, workers: int) -> List[tuple]:
+    """
+    Order (role, name, records, ...) jobs by predicted render time, largest first, and log the plan
+
+    Handed to a pool whose idle workers take the next job, the run then ends
+    close to the total predicted work divided by `workers`.
+    """
+    jobs, costs = largest_first(jobs, lambda job: cost_model.predict(job[0], job[1], len(job[2])))
+    if jobs:
+        logger.info(f"Scheduled {len(jobs)} invoices largest first: {sum(costs):.2f}s of rendering predicted, "
+                    f"{makespan_bound(costs, workers):.2f}s at best on {workers} render "
+                    f"{'process' if workers == 1 else 'processes'} (largest {jobs[0][1]}, {costs[0]:.2f}s)")
+    return jobs
+
+
+def process_jobs(jobs: List[tuple], stats: RunStats, executor: ProcessPoolExecutor, invoice_date: datetime,
+                 logo_url: str = None) -> List[tuple]:
+    """
+    Process entities across the worker pool (--workers mode), in the order given
+
+    Every job is submitted up front. The workers take jobs from one shared
+    queue, each picking up the next as soon as it finishes its last.
+
+    Args:
+        jobs: (role, name, records, fingerprint) per entity, across roles
+        stats: Run statistics, updated in place for failures
+        executor: Process pool whose workers were set up by _init_worker
+
+    Returns:
+        The jobs whose invoice was stored. Their metadata may still be buffered
+        in the worker's InvoiceRecordWriter; see confirm_recorded
+    """
+    futures = {}
+    for job in jobs:
+        role, name, records = job[:3]
+        futures[executor.submit(_process_in_worker, role, name, records, invoice_date, logo_url)] = job
+
+    stored = []
+    for future in as_completed(futures):
+        job = futures[future]
+        role, name = job[:2]
+        try:
+            _, _, ok, worker_metrics = future.result()
+            metrics.merge(worker_metrics)
+        except Exception as e:
+            # Worker crashed outside the processor's own error handling
+            ok = False
+            logger.error(f"✗ Worker failed for {role} {name}: {e}")
+        if ok:
+            stored.append(job)
+        else:
+            stats.record(role, 'failed', name)
+    return stored
+
+
+def confirm_recorded(db: DatabaseManager, stored: List[tuple], stats: RunStats, invoice_date: datetime,
+                     started: datetime):
+    """
+    Count worker-stored invoices as processed once their rows are in the database
+
+    Workers batch their metadata saves and flush the last batch as they exit,
+    after the parent has seen every result, so a batch that failed to commit
+    is only visible here: an invoice counts as failed unless its row was
+    saved during this run, carrying the fingerprint it was rendered from. A
+    row left by an earlier run with the same fingerprint doesn't count, since
+    the upsert always moves updated_at.
+
+    Args:
+        stored: (role, name, records, fingerprint) jobs from process_jobs, with
+            the worker pool already shut down
+        started: Database time (DatabaseManager.current_timestamp) taken
+            before any job was submitted
+    """
+    saved = {role: db.get_invoice_fingerprints(role, invoice_date.date(), saved_since=started)
+             for role in {job[0] for job in stored}}
+    for role, name, _, fingerprint in stored:
+        if saved[role].get(name) == fingerprint:
+            stats.record(role, 'processed', name)
+        else:
+            logger.error(f"✗ Invoice record for {ROLES[role]['label']} {name} was not saved")
+            stats.record(role, 'failed', name)
+
+
+def render_role(role: str, groups, pipeline: InvoicePipeline, stats: RunStats, pdf_gen: PDFGenerator,
+                invoice_date: datetime, logo_url: str = None, fingerprints: Dict[str, str] = None,
+                journal: RunJournal = None, prorations: Dict[str, InvoiceLines] = None,
+                render_batch: int = 1):
+    """
+    Render each (name, records) group and hand it to the pipeline's store stage
+
+    Args:
+        role: 'client', 'investor', or 'capinvestor'
+        groups: Iterable of (name, records), either in memory or streamed from the database
+        pipeline: Running InvoicePipeline that uploads and records the PDFs
+        stats: Run statistics, updated in place for render failures and skips
+        fingerprints: Existing invoices' source fingerprints; matching entities are skipped
+        journal: Optional run journal to record progress in
+        prorations: Line items for the whole role from prorate_role; computed per
+            entity when not given (streaming)
+        render_batch: Render up to this many small invoices together in one
+            WeasyPrint document (1 renders every invoice on its own)
+    """
+    label = ROLES[role]['label']
+    # Single-page invoices waiting to be rendered together: (name, records, fingerprint, lines)
+    batch = []
+
+    def submit(invoice: RenderedInvoice):
+        if journal:
+            journal.mark_rendered(role, invoice.business_name, invoice_date.date(), invoice.record_count,
+                                  invoice.render_seconds)
+        pipeline.submit(invoice)
+
+    def render_one(name, records, fingerprint, lines):
+        try:
+            invoice = render_invoice(pdf_gen, role, name, records, invoice_date, logo_url, fingerprint, lines)
+        except Exception as e:
+            logger.error(f"✗ Failed to process {label} {name}: {str(e)}", exc_info=True)
+            stats.record(role, 'failed', name)
             return
+        submit(invoice)
 
-        # Generate PDF
-        pdf_content = pdf_gen.generate_invoice_pdf(
-            business_name=investor_name,
-            role='capinvestor',
-            records=records,
-            invoice_date=invoice_date,
-            logo_url=logo_url
-        )
+    def flush_batch():
+        try:
+            invoices = render_invoice_batch(pdf_gen, role, batch, invoice_date, logo_url)
+        except Exception as e:
+            # Render them one by one, so only the offending invoice fails
+            logger.warning(f"Batch render of {len(batch)} {ROLES[role]['plural']} failed ({e}), "
+                           f"rendering them one by one")
+            for item in batch:
+                render_one(*item)
+        else:
+            for invoice in invoices:
+                submit(invoice)
+        batch.clear()
 
-        # Generate file name
-        file_name = generate_file_name(investor_name, invoice_date)
-
-        # Upload to S3
-        s3_key = s3.generate_s3_key('capinvestor', investor_name, file_name)
-        s3_url = s3.upload_pdf(pdf_content, s3_key)
-
-        # Calculate totals
-        total_amount = sum(float(r.get('loan_amount', 0) or 0) for r in records)
-        monthly_interest = sum(float(r.get('payment', 0) or 0) for r in records)
-
-        # Save to database
-        db.save_invoice_record(
-            business_name=investor_name,
-            role='capinvestor',
-            invoice_date=invoice_date.date(),
-            file_name=file_name,
-            s3_key=s3_key,
-            s3_url=s3_url,
-            total_amount=monthly_interest,
-            record_count=len(records)
-        )
+    for name, records in groups:
+        try:
+            unchanged, fingerprint = is_unchanged(role, name, records, invoice_date, pdf_gen,
+                                                  fingerprints, stats, logo_url)
+        except Exception as e:
+            logger.error(f"✗ Failed to process {label} {name}: {str(e)}", exc_info=True)
+            stats.record(role, 'failed', name)
+            continue
+        if unchanged:
+            continue
+        logger.info(f"Processing {label}: {name}")
+        lines = prorations.pop(name, None) if prorations else None
+        # Entities profiled on their own are never batched
+        if render_batch > 1 and pdf_gen.batchable(records) and not profiling.selects(name):
+            batch.append((name, records, fingerprint, lines))
+            if len(batch) >= render_batch:
+                flush_batch()
+        else:
+            render_one(name, records, fingerprint, lines)
+        # Drop our reference so only the current group is held while the store stage catches up
+        del records
+    if batch:
+        flush_batch()
 
-        logger.info(f"✓ Successfully processed {investor_name}: {len(records)} records, ${monthly_interest:,.2f}/month")
 
-    except Exception as e:
-        logger.error(f"✗ Failed to process cap investor {investor_name}: {str(e)}", exc_info=True)
+def log_role_summary(role: str, summaries: Dict[str, EntitySummary]):
+    """Log how many entities and records a role has, and its amounts before proration"""
+    settings = ROLES[role]
+    amount_total = sum(summary.amount_total for summary in summaries.values())
+    logger.info(f"Found {len(summaries)} {settings['plural']} with "
+                f"{sum(summary.record_count for summary in summaries.values())} records, "
+                f"${amount_total:,.2f}{ROLE_TOTAL_SUFFIX[role]} before proration")
+
+
+def shard_entities(role: str, record_counts: Dict[str, int], shard: Shard, stats: RunStats) -> Set[str]:
+    """
+    Pick this shard's entities for a role (--shard) and note them for the coordinator
+
+    Args:
+        record_counts: {name: record count} for every entity of the role
+    """
+    names = shard.select(record_counts)
+    stats.assign(role, names, len(record_counts))
+    logger.info(f"Shard {shard}: {len(names)} of {len(record_counts)} {ROLES[role]['plural']}, "
+                f"{sum(record_counts[name] for name in names)} of {sum(record_counts.values())} records")
+    return names
+
+
+def run_workers(db: DatabaseManager, executor: ProcessPoolExecutor, workers: int, pdf_gen: PDFGenerator,
+                stats: RunStats, invoice_date: datetime, logo_url: str = None, force: bool = False,
+                journal: RunJournal = None, resume: bool = False, shard: Shard = None,
+                since: datetime = None, roles: List[str] = None):
+    """
+    Fetch each role in bulk, then render/upload/record every role's entities across the worker pool
+
+    All roles share one queue, ordered by predicted render time (largest first),
+    so no role waits on another's slowest invoice. The pool is shut down once
+    every job is done, so each invoice is only counted as processed after its
+    worker's final metadata flush.
+    """
+    roles = list(roles or ROLES)
+    jobs = []
+    for role in roles:
+        settings = ROLES[role]
+        logger.info("\n" + "=" * 80)
+        logger.info(f"Processing {settings['title']}")
+        logger.info("=" * 80)
+        groups = fetch_role_records(db, role, invoice_date, stats, since)
+        if shard:
+            names = shard_entities(role, {name: len(records) for name, records in groups.items()}, shard, stats)
+            groups = {name: records for name, records in groups.items() if name in names}
+        fingerprints = None if force else db.get_invoice_fingerprints(role, invoice_date.date())
+        pairs = groups.items()
+        if resume:
+            pairs = skip_completed(role, pairs, journal.completed(role, invoice_date.date()), stats)
+        for name, records in pairs:
+            unchanged, fingerprint = is_unchanged(role, name, records, invoice_date, pdf_gen, fingerprints, stats,
+                                                  logo_url)
+            if not unchanged:
+                jobs.append((role, name, records, fingerprint))
+
+    jobs = schedule_largest_first(jobs, load_cost_model(journal, roles), workers)
+    started = db.current_timestamp()
+    stored = process_jobs(jobs, stats, executor, invoice_date, logo_url)
+    # Let the workers flush their last metadata batches before checking them
+    executor.shutdown(wait=True)
+    confirm_recorded(db, stored, stats, invoice_date, started)
+
+
+def run_pipeline(db: DatabaseManager, database_url: str, pdf_gen: PDFGenerator, s3: StorageBackend,
+                 stats: RunStats, invoice_date: datetime, logo_url: str = None, stream: bool = False,
+                 max_pending: int = 4, upload_threads: int = 8, batch_size: int = 100,
+                 force: bool = False, journal: RunJournal = None, resume: bool = False,
+                 shard: Shard = None, render_batch: int = 1, record: bool = True, since: datetime = None,
+                 roles: List[str] = None, names: List[str] = None):
+    """
+    Render in this process while a pool of upload threads stores the PDFs
+
+    Uploads overlap with rendering and share one S3 client. With `stream`,
+    records are read through server-side cursors on `db` so memory stays
+    bounded; the store stage always saves metadata over its own connection,
+    batched `batch_size` rows per transaction. Unless `force` is set, entities
+    whose source fingerprint matches their existing invoice are skipped. With
+    `resume`, entities the journal already recorded are skipped as well. With
+    `shard`, only that shard's share of each role is invoiced. With `since`,
+    only entities whose records changed after it are. Single-page invoices are
+    rendered `render_batch` at a time. Without `record`, PDFs are stored but
+    nothing is written to the invoices tables. `roles` limits the run to those
+    roles, and `names` to those entities, which are looked up one by one
+    instead of listing the whole role.
+    """
+    store_db = DatabaseManager(database_url)
+    store_db.connect()
+    # Stored invoices count as processed once their metadata batch commits; a
+    # batch that fails counts all of its invoices as failed, so the watermark
+    # stays put and the next run retries them
+    writer = InvoiceRecordWriter(store_db, batch_size, on_flush=_flush_recorder(journal, stats),
+                                 on_error=_flush_failure_recorder(stats))
+
+    def on_result(invoice: RenderedInvoice, ok: bool):
+        if not ok or not record:
+            stats.record(invoice.role, 'processed' if ok else 'failed', invoice.business_name)
 
+    pipeline = InvoicePipeline(lambda invoice: store_invoice(writer if record else None, s3, invoice, journal),
+                               on_result=on_result, max_pending=max_pending, workers=upload_threads)
+    try:
+        # The writer flushes remaining rows after the pipeline drains, even on error
+        with writer, pipeline:
+            for role in roles or ROLES:
+                settings = ROLES[role]
+                logger.info("\n" + "=" * 80)
+                logger.info(f"Processing {settings['title']}")
+                logger.info("=" * 80)
+                fingerprints = None if force else store_db.get_invoice_fingerprints(role, invoice_date.date())
+                prorations = None
+                if stream:
+                    # Counts and totals come from a GROUP BY up front; the records
+                    # themselves are only read as they are streamed
+                    summaries = db.get_role_summaries(role, invoice_date)
+                    log_role_summary(role, summaries)
+                    changed = None
+                    if since is not None:
+                        changed = select_changed(
+                            role, store_db.get_entity_changes(role, since, invoice_date.date()), stats)
+                    groups = db.iter_role_record_groups(role, invoice_date, names=changed)
+                    if shard:
+                        # Other shards' groups are still streamed past and dropped
+                        shard_names = shard_entities(role, {name: summary.record_count
+                                                            for name, summary in summaries.items()},
+                                                     shard, stats)
+                        groups = ((name, records) for name, records in groups if name in shard_names)
+                else:
+                    if names:
+                        records_by_name = db.get_entity_records(role, names, invoice_date)
+                        for name in names:
+                            if name not in records_by_name:
+                                logger.warning(f"No records to invoice for {settings['label']} {name}, "
+                                               f"nothing to invoice")
+                        if since is not None:
+                            changes = store_db.get_entity_changes(role, since, invoice_date.date())
+                            changed = {name for name, is_changed in changes.items() if is_changed}
+                            records_by_name = dict(skip_unchanged_since(role, records_by_name.items(), changed,
+                                                                        stats))
+                    else:
+                        records_by_name = fetch_role_records(db, role, invoice_date, stats, since)
+                    if shard:
+                        shard_names = shard_entities(role, {name: len(records)
+                                                            for name, records in records_by_name.items()},
+                                                     shard, stats)
+                        records_by_name = {name: records for name, records in records_by_name.items()
+                                           if name in shard_names}
+                    groups = records_by_name.items()
+                    # Prorate and total the whole role in one pass
+                    with metrics.stage('prorate'):
+                        prorations = prorate_role(role, records_by_name, invoice_date)
+                if resume:
+                    groups = skip_completed(role, groups, journal.completed(role, invoice_date.date()), stats)
+
+                render_role(role, groups, pipeline, stats, pdf_gen, invoice_date, logo_url, fingerprints,
+                            journal, prorations, render_batch)
+        logger.info("All uploads and invoice records flushed")
+    finally:
+        store_db.close()
+
+
+async def run_async(database_url: str, pdf_gen: PDFGenerator, s3: 'AsyncS3Uploader', stats: RunStats,
+                    invoice_date: datetime, logo_url: str = None, concurrency: int = 16,
+                    render_pool: ProcessPoolExecutor = None, workers: int = 1, force: bool = False,
+                    journal: RunJournal = None, resume: bool = False, shard: Shard = None,
+                    since: datetime = None, roles: List[str] = None):
+    """
+    Asyncio engine (--async): fetch, upload and save without blocking on I/O
+
+    Every role's records and fingerprints are fetched concurrently over an
+    asyncpg pool. Up to `concurrency` entities are then in flight at once, each
+    rendered in an executor (`render_pool`'s `workers` processes, or a single thread
+    sharing `pdf_gen`) and uploaded and saved while others render. Entities
+    start in order of predicted render time, largest first.
+    """
+    import asyncio
+    from invoice_generator.async_engine import AsyncDatabaseManager
+
+    db = AsyncDatabaseManager(database_url, pool_size=concurrency)
+    await db.connect()
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    render_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='render') if render_pool is None else None
+
+    async def render(role, name, records, fingerprint, lines):
+        if render_pool is None:
+            return await loop.run_in_executor(render_thread, render_invoice, pdf_gen, role, name, records,
+                                              invoice_date, logo_url, fingerprint, lines)
+        invoice, worker_metrics = await loop.run_in_executor(render_pool, _render_in_worker, role, name, records,
+                                                             invoice_date, logo_url, fingerprint, lines)
+        metrics.merge(worker_metrics)
+        return invoice
+
+    async def process(role, name, records, fingerprint, lines):
+        async with semaphore:
+            label = ROLES[role]['label']
+            try:
+                logger.info(f"Processing {label}: {name}")
+                invoice = await render(role, name, records, fingerprint, lines)
+                if journal:
+                    journal.mark_rendered(role, name, invoice_date.date(), invoice.record_count,
+                                          invoice.render_seconds)
+                await store_invoice_async(db, s3, invoice, journal)
+            except Exception as e:
+                logger.error(f"✗ Failed to process {label} {name}: {str(e)}", exc_info=True)
+                stats.record(role, 'failed', name)
+            else:
+                stats.record(role, 'processed', name)
+
+    try:
+        async with s3:
+            roles = list(roles or ROLES)
+            async def fetch(role):
+                if since is None:
+                    return await db.get_all_role_records(role, invoice_date)
+                changes = await db.get_entity_changes(role, since, invoice_date.date())
+                return await db.get_all_role_records(role, invoice_date, select_changed(role, changes, stats))
+
+            fetched = await asyncio.gather(*(fetch(role) for role in roles))
+            existing = [None] * len(roles) if force else await asyncio.gather(
+                *(db.get_invoice_fingerprints(role, invoice_date.date()) for role in roles))
+
+            jobs = []
+            for role, records_by_name, fingerprints in zip(roles, fetched, existing):
+                logger.info(f"Found {len(records_by_name)} {ROLES[role]['plural']}")
+                if shard:
+                    names = shard_entities(role, {name: len(records) for name, records in records_by_name.items()},
+                                           shard, stats)
+                    records_by_name = {name: records for name, records in records_by_name.items()
+                                       if name in names}
+                with metrics.stage('prorate'):
+                    prorations = prorate_role(role, records_by_name, invoice_date)
+                groups = records_by_name.items()
+                if resume:
+                    groups = skip_completed(role, groups, journal.completed(role, invoice_date.date()), stats)
+                for name, records in groups:
+                    unchanged, fingerprint = is_unchanged(role, name, records, invoice_date, pdf_gen,
+                                                          fingerprints, stats, logo_url)
+                    if not unchanged:
+                        jobs.append((role, name, records, fingerprint, prorations.pop(name)))
+
+            # The semaphore and the render pool's queue both hand out work in this order
+            jobs = schedule_largest_first(jobs, load_cost_model(journal, roles), workers)
+            await asyncio.gather(*(process(*job) for job in jobs))
+        logger.info("All uploads and invoice records saved")
+    finally:
+        if render_thread is not None:
+            render_thread.shutdown(wait=True)
+        await db.close()
+
+
+def parse_since(value: str):
+    """argparse type for --since: an ISO timestamp, or 'last-run' for the stored watermark"""
+    if value == LAST_RUN:
+        return value
+    try:
+        since = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected an ISO timestamp or '{LAST_RUN}', got {value!r}")
+    # Naive timestamps are in this machine's time zone
+    return since if since.tzinfo else since.astimezone()
+
+
+def parse_args(argv=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Generate monthly invoice PDFs and upload them to S3')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes for PDF rendering (default: 1, no pool)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream records through a server-side cursor with bounded memory')
+    parser.add_argument('--max-pending', type=int, default=16,
+                        help='Rendered PDFs allowed to wait for the upload stage (default: 16)')
+    parser.add_argument('--upload-threads', type=int, default=8,
+                        help='Concurrent S3 uploads when rendering in-process (default: 8; 0 stores '
+                             'each invoice between renders)')
+    parser.add_argument('--render-batch', type=int, default=1,
+                        help='Render up to this many small invoices in one WeasyPrint document '
+                             '(default: 1, no batching)')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Invoice records saved per database transaction (default: 100)')
+    parser.add_argument('--force', action='store_true',
+                        help='Regenerate every invoice, even if its source records are unchanged')
+    parser.add_argument('--journal', default='invoice_run_journal.sqlite3',
+                        help='SQLite file recording per-invoice progress (default: invoice_run_journal.sqlite3)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip invoices an earlier, interrupted run already recorded')
+    parser.add_argument('--asset-cache',
+                        help='Directory caching fetched template resources (logo) across runs')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Use the asyncio engine (asyncpg + aioboto3); see requirements-async.txt')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Entities in flight at once with --async (default: 16)')
+    parser.add_argument('--since', nargs='?', const=LAST_RUN, type=parse_since,
+                        help='Only regenerate invoices whose records were created, updated, closed or '
+                             'deleted after the last complete run (or after the given ISO timestamp)')
+    parser.add_argument('--role', choices=list(ROLES),
+                        help='Only invoice this role')
+    parser.add_argument('--name', dest='names', action='append', metavar='NAME',
+                        help='Only invoice this business or investor of --role; repeat for several. '
+                             'Looks each one up directly instead of listing the whole role')
+    parser.add_argument('--shard', type=parse_shard,
+                        help='Invoice only shard i of N (e.g. 2/4); run every shard, then merge-shards their reports')
+    parser.add_argument('--optimize-pdf', action='store_true',
+                        help='Shrink PDFs before upload: downscaled logo, subset fonts, and recompressed '
+                             'streams if pikepdf is installed')
+    parser.add_argument('--engine', choices=ENGINES, default='weasyprint',
+                        help='PDF render engine: weasyprint (default, renders the HTML template) or reportlab '
+                             '(draws the same layout directly; needs requirements-reportlab.txt)')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='Write CPU profiles (collapsed stacks for flamegraphs) and per-stage allocation '
+                             'reports to DIR, for the whole run or only --profile-entity renders')
+    parser.add_argument('--profile-mode', choices=profiling.MODES, default='sample',
+                        help='CPU profiler: sample (default; every thread, flamegraph-ready stacks) or '
+                             'cprofile (deterministic, pstats output)')
+    parser.add_argument('--profile-entity', dest='profile_entities', action='append', metavar='NAME',
+                        help='Only profile this business or investor\'s render, in files of its own; '
+                             'repeat for several')
+    parser.add_argument('--report',
+                        help='JSON file for per-stage timings and run totals (default: invoice_run_report.json, '
+                             'or invoice_run_report.shard-i-of-N.json with --shard)')
+    parser.add_argument('--storage', choices=['s3', 'local', 'archive'], default='s3',
+                        help='Where PDFs go: S3 (default), a local directory, or one .zip/.tar archive with '
+                             'a manifest. local and archive regenerate every invoice and leave the invoices '
+                             'tables and run journal untouched')
+    parser.add_argument('--output',
+                        help='Directory (--storage local) or archive file (--storage archive)')
+    parser.add_argument('--prom-file',
+                        help='Also write metrics to this file for the node_exporter textfile collector '
+                             '(e.g. /var/lib/node_exporter/textfile_collector/invoices.prom)')
+    args = parser.parse_args(argv)
+    if args.stream and args.workers > 1:
+        parser.error('--stream cannot be combined with --workers')
+    if args.use_async and args.stream:
+        parser.error('--async cannot be combined with --stream')
+    if args.render_batch > 1 and (args.use_async or args.workers > 1):
+        parser.error('--render-batch applies to in-process rendering only, not --workers or --async')
+    if args.names and not args.role:
+        parser.error('--name requires --role')
+    if args.names and (args.use_async or args.workers > 1 or args.stream or args.shard):
+        parser.error('--name applies to the default in-process mode only, not --workers, --async, '
+                     '--stream or --shard')
+    if args.since and args.shard:
+        parser.error('--since cannot be combined with --shard')
+    if args.profile_entities and not args.profile:
+        parser.error('--profile-entity requires --profile')
+    if args.storage != 's3':
+        if not args.output:
+            parser.error(f'--storage {args.storage} requires --output')
+        if args.storage == 'archive' and not args.output.lower().endswith(ARCHIVE_SUFFIXES):
+            parser.error(f"--storage archive needs an --output ending in {', '.join(ARCHIVE_SUFFIXES)}")
+        if args.use_async or args.workers > 1:
+            parser.error(f'--storage {args.storage} applies to in-process rendering only, not --workers or --async')
+        if args.resume:
+            parser.error(f'--storage {args.storage} does not use the run journal, so it cannot --resume')
+    if args.report is None:
+        args.report = (f'invoice_run_report.shard-{args.shard.index}-of-{args.shard.count}.json'
+                       if args.shard else 'invoice_run_report.json')
+    return args
+
+
+def merge_shards(argv=None):
+    """
+    Coordinator for sharded runs: merge-shards REPORT [REPORT ...]
+
+    Combines the shards' run reports and checks that every entity was invoiced
+    exactly once.
+
+    Returns:
+        int: Exit status, 1 if any entity was missed or invoiced twice
+    """
+    parser = argparse.ArgumentParser(prog='generate_invoices.py merge-shards',
+                                     description='Merge --shard run reports and check every entity '
+                                                 'was invoiced exactly once')
+    parser.add_argument('reports', nargs='+', help='Run reports written by each shard')
+    parser.add_argument('--output', default='invoice_run_report.json',
+                        help='Merged report (default: invoice_run_report.json)')
+    args = parser.parse_args(argv)
+
+    merged, problems = merge_shard_reports(load_reports(args.reports))
+    with open(args.output, 'w') as f:
+        json.dump(merged, f, indent=2)
+
+    for entity_key, counts in merged.get('stats', {}).items():
+        logger.info(f"{entity_key}: {counts.get('processed', 0)} processed, {counts.get('failed', 0)} failed, "
+                    f"{counts.get('skipped', 0)} unchanged")
+    for problem in problems:
+        logger.error(f"✗ {problem}")
+    if problems:
+        logger.error(f"Sharded run incomplete: {len(problems)} problems, see {args.output}")
+        return 1
+    logger.info(f"All {len(args.reports)} shards complete; every entity invoiced exactly once. "
+                f"Merged report written to {args.output}")
+    return 0
 
-def main():
+
+def main(argv=None):
     """Main execution function"""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['merge-shards']:
+        setup_logging()
+        sys.exit(merge_shards(argv[1:]))
+
+    args = parse_args(argv)
+    started_at = datetime.now()
+    setup_logging()
+
     logger.info("=" * 80)
     logger.info("Starting Monthly Invoice Generation")
     logger.info("=" * 80)
@@ -216,94 +1153,218 @@ def main():
     s3_bucket = os.getenv('S3_BUCKET_NAME')
     logo_url = os.getenv('LOGO_URL')
 
+    # Local and archive exports only read the database
+    export = args.storage != 's3'
+
     # Validate configuration
-    if not all([database_url, aws_access_key, aws_secret_key, s3_bucket]):
+    if not database_url or not (export or all([aws_access_key, aws_secret_key, s3_bucket])):
         logger.error("Missing required environment variables!")
         logger.error("Required: DATABASE_URL, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_BUCKET_NAME")
         sys.exit(1)
 
-    # Use first of current month as invoice date
-    invoice_date = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    invoice_date = current_invoice_date()
     logger.info(f"Invoice Date: {invoice_date.strftime('%B %d, %Y')}")
+    if args.shard:
+        logger.info(f"Shard: {args.shard}")
+    if args.engine != 'weasyprint':
+        logger.info(f"Render engine: {args.engine}")
 
     # Initialize components
     logger.info("Initializing components...")
-    db = DatabaseManager(database_url)
-    db.connect()
-
     template_dir = os.path.join(os.path.dirname(__file__), 'invoice_generator', 'templates')
-    pdf_gen = PDFGenerator(template_dir)
+    pdf_gen = PDFGenerator(template_dir, args.asset_cache, optimize=args.optimize_pdf, engine=args.engine)
 
-    s3 = S3Uploader(aws_access_key, aws_secret_key, aws_region, s3_bucket)
+    if args.use_async:
+        from invoice_generator.async_engine import AsyncS3Uploader
 
-    # Statistics
-    stats = {
-        'clients': {'processed': 0, 'failed': 0},
-        'investors': {'processed': 0, 'failed': 0},
-        'capinvestors': {'processed': 0, 'failed': 0}
-    }
+        # The async engine opens its own pool and client
+        db = None
+        s3 = AsyncS3Uploader(aws_access_key, aws_secret_key, aws_region, s3_bucket,
+                             max_pool_connections=max(args.concurrency, 10),
+                             endpoint_url=os.getenv('S3_ENDPOINT_URL'))
+    else:
+        db = DatabaseManager(database_url)
+        db.connect()
+        if args.storage == 'local':
+            s3 = LocalDirectoryStorage(args.output)
+        elif args.storage == 'archive':
+            s3 = ArchiveStorage(args.output)
+        else:
+            s3 = S3Uploader(aws_access_key, aws_secret_key, aws_region, s3_bucket,
+                            max_pool_connections=max(args.upload_threads, 10),
+                            endpoint_url=os.getenv('S3_ENDPOINT_URL'))
+    if export:
+        logger.info(f"Exporting every invoice to {args.output} ({args.storage}); the database is read only")
 
-    try:
-        # Process all businesses (clients/borrowers)
-        logger.info("\n" + "=" * 80)
-        logger.info("Processing Businesses (Clients/Borrowers)")
-        logger.info("=" * 80)
-        businesses = db.get_all_businesses()
-        logger.info(f"Found {len(businesses)} businesses")
+    # Taken before any records are read, so changes made during this run are
+    # picked up by the next --since run. The async engine has no psycopg2
+    # connection of its own, so it opens one for the watermark.
+    settings_db = db
+    if settings_db is None:
+        settings_db = DatabaseManager(database_url)
+        settings_db.connect()
+    watermark = settings_db.current_timestamp()
+    since = args.since
+    if since == LAST_RUN:
+        since = settings_db.get_watermark()
+        if since is None:
+            logger.info("No complete run recorded yet, invoicing every entity")
+    if since is not None:
+        logger.info(f"Only invoicing entities whose records changed since {since.isoformat()}")
 
-        for business_name in businesses:
-            try:
-                process_business(db, pdf_gen, s3, business_name, invoice_date, logo_url)
-                stats['clients']['processed'] += 1
-            except Exception as e:
-                stats['clients']['failed'] += 1
-                logger.error(f"Failed to process business {business_name}: {e}")
+    journal = None if export else RunJournal(args.journal)
+    if args.resume:
+        logger.info(f"Resuming from run journal: {args.journal}")
 
-        # Process all investors (promissory)
-        logger.info("\n" + "=" * 80)
-        logger.info("Processing Investors (Promissory)")
-        logger.info("=" * 80)
-        investors = db.get_all_investors()
-        logger.info(f"Found {len(investors)} investors")
+    profile = None
+    if args.profile:
+        profile = ProfileSettings(args.profile, args.profile_mode, tuple(args.profile_entities or ()))
+        scope = (f"renders of {', '.join(profile.entities)}" if profile.entities
+                 else 'the whole run, per process')
+        logger.info(f"Profiling {scope} ({profile.mode}) into {args.profile}")
+        # tracemalloc traces every thread of a process, so nothing may store
+        # while this process renders, or uploads land in the stage reports
+        if args.workers <= 1 and args.use_async and args.concurrency > 1:
+            logger.info("Profiling with --concurrency 1: invoices are stored between renders")
+            args.concurrency = 1
+        elif args.workers <= 1 and not args.use_async and args.upload_threads:
+            logger.info("Profiling with --upload-threads 0: invoices are stored between renders")
+            args.upload_threads = 0
+        profiling.start(profile, 'main')
 
-        for investor_name in investors:
-            try:
-                process_investor(db, pdf_gen, s3, investor_name, invoice_date, logo_url)
-                stats['investors']['processed'] += 1
-            except Exception as e:
-                stats['investors']['failed'] += 1
-                logger.error(f"Failed to process investor {investor_name}: {e}")
+    executor = None
+    metrics_dir = None
+    if args.workers > 1 and args.use_async:
+        logger.info(f"Starting {args.workers} render processes...")
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=_init_render_worker,
+                                       initargs=(template_dir, args.asset_cache, args.optimize_pdf, False,
+                                                 args.engine, profile))
+    elif args.workers > 1:
+        logger.info(f"Starting {args.workers} worker processes...")
+        metrics_dir = tempfile.mkdtemp(prefix='invoice-metrics-')
+        executor = ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=_init_worker,
+            initargs=(database_url, aws_access_key, aws_secret_key, aws_region, s3_bucket, template_dir,
+                      args.batch_size, args.journal, metrics_dir, args.asset_cache, args.optimize_pdf,
+                      args.engine, profile)
+        )
 
-        # Process all cap investors
-        logger.info("\n" + "=" * 80)
-        logger.info("Processing Cap Investors")
-        logger.info("=" * 80)
-        cap_investors = db.get_all_cap_investors()
-        logger.info(f"Found {len(cap_investors)} cap investors")
+    roles = [args.role] if args.role else list(ROLES)
 
-        for investor_name in cap_investors:
-            try:
-                process_cap_investor(db, pdf_gen, s3, investor_name, invoice_date, logo_url)
-                stats['capinvestors']['processed'] += 1
-            except Exception as e:
-                stats['capinvestors']['failed'] += 1
-                logger.error(f"Failed to process cap investor {investor_name}: {e}")
+    # Statistics
+    stats = RunStats({role: settings['stats_key'] for role, settings in ROLES.items()})
+
+    try:
+        if args.use_async:
+            import asyncio
+            asyncio.run(run_async(database_url, pdf_gen, s3, stats, invoice_date, logo_url,
+                                  concurrency=args.concurrency, render_pool=executor,
+                                  workers=args.workers if executor is not None else 1, force=args.force,
+                                  journal=journal, resume=args.resume, shard=args.shard, since=since,
+                                  roles=roles))
+        elif executor is not None:
+            run_workers(db, executor, args.workers, pdf_gen, stats, invoice_date, logo_url, force=args.force,
+                        journal=journal, resume=args.resume, shard=args.shard, since=since, roles=roles)
+        else:
+            run_pipeline(db, database_url, pdf_gen, s3, stats, invoice_date, logo_url,
+                         stream=args.stream, max_pending=args.max_pending,
+                         upload_threads=args.upload_threads, batch_size=args.batch_size,
+                         force=args.force or export, journal=journal, resume=args.resume, shard=args.shard,
+                         render_batch=args.render_batch, record=not export, since=since,
+                         roles=roles, names=args.names)
+
+        # Only a complete run moves the watermark: not one shard, role or entity,
+        # an export, a resumed run (its earlier half read older data) or a run
+        # with failures
+        if export or args.shard or args.role or args.resume or stats.total('failed'):
+            logger.info("Watermark not advanced; the next --since run starts from the previous one")
+        else:
+            settings_db.set_watermark(watermark)
+            logger.info(f"Watermark advanced to {watermark.isoformat()}")
 
     finally:
-        db.close()
+        if executor is not None:
+            executor.shutdown(wait=True)
+        if metrics_dir is not None:
+            for file_name in os.listdir(metrics_dir):
+                metrics.merge_file(os.path.join(metrics_dir, file_name))
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+        profiling.stop()
+        # Archives write their manifest on close; the async client is closed by run_async
+        if not args.use_async:
+            s3.close()
+        if journal is not None:
+            journal.close()
+        if db is not None:
+            db.close()
+        if settings_db is not db:
+            settings_db.close()
 
     # Print summary
     logger.info("\n" + "=" * 80)
     logger.info("Invoice Generation Complete")
     logger.info("=" * 80)
-    logger.info(f"Clients:       {stats['clients']['processed']} processed, {stats['clients']['failed']} failed")
-    logger.info(f"Investors:     {stats['investors']['processed']} processed, {stats['investors']['failed']} failed")
-    logger.info(f"Cap Investors: {stats['capinvestors']['processed']} processed, {stats['capinvestors']['failed']} failed")
+    logger.info(f"Clients:       {stats.count('client', 'processed')} processed, "
+                f"{stats.count('client', 'failed')} failed, {stats.count('client', 'skipped')} unchanged")
+    logger.info(f"Investors:     {stats.count('investor', 'processed')} processed, "
+                f"{stats.count('investor', 'failed')} failed, {stats.count('investor', 'skipped')} unchanged")
+    logger.info(f"Cap Investors: {stats.count('capinvestor', 'processed')} processed, "
+                f"{stats.count('capinvestor', 'failed')} failed, {stats.count('capinvestor', 'skipped')} unchanged")
     logger.info("=" * 80)
 
-    total_processed = stats['clients']['processed'] + stats['investors']['processed'] + stats['capinvestors']['processed']
-    total_failed = stats['clients']['failed'] + stats['investors']['failed'] + stats['capinvestors']['failed']
-    logger.info(f"TOTAL: {total_processed} successful, {total_failed} failed")
+    total_processed = stats.total('processed')
+    total_failed = stats.total('failed')
+    total_skipped = stats.total('skipped')
+    logger.info(f"TOTAL: {total_processed} successful, {total_failed} failed, {total_skipped} unchanged")
+
+    write_run_report(args, stats, invoice_date, started_at)
+
+
+def write_run_report(args, stats: RunStats, invoice_date: datetime, started_at: datetime):
+    """Log per-stage timings and write the JSON report (and Prometheus file if requested)"""
+    finished_at = datetime.now()
+    summary = metrics.summary()
+
+    logger.info("Stage timings (p50 / p95 / max seconds):")
+    for name in STAGES:
+        timing = summary['stages'].get(name)
+        if timing:
+            logger.info(f"  {name:<15} {timing['p50']:.3f} / {timing['p95']:.3f} / {timing['max']:.3f} "
+                        f"({timing['count']} samples)")
+    logger.info(f"Uploaded {summary['counters'].get('bytes_uploaded', 0) / 1048576:.1f} MiB, "
+                f"peak RSS {summary['peak_rss_bytes'] / 1048576:.0f} MiB")
+    saved = summary['distributions'].get('pdf_bytes_saved')
+    if saved:
+        logger.info(f"PDF optimization saved {saved['sum'] / 1048576:.1f} MiB, "
+                    f"{saved['sum'] / saved['count'] / 1024:.1f} KiB per invoice "
+                    f"(p50 {saved['p50'] / 1024:.1f} KiB, max {saved['max'] / 1024:.1f} KiB)")
+    if summary['counters'].get('image_bytes_saved'):
+        logger.info(f"Logo downscaled once per process, {summary['counters']['image_bytes_saved']} bytes smaller")
+
+    try:
+        metrics.write_json_report(args.report, {
+            'invoice_date': invoice_date.date().isoformat(),
+            'started_at': started_at.isoformat(),
+            'finished_at': finished_at.isoformat(),
+            'duration_seconds': (finished_at - started_at).total_seconds(),
+            'mode': ('async' if args.use_async else 'workers' if args.workers > 1
+                     else 'stream' if args.stream else 'pipeline'),
+            'workers': args.workers,
+            'engine': args.engine,
+            'storage': args.storage,
+            'shard': asdict(args.shard) if args.shard else None,
+            'stats': stats.as_dict(),
+            # Per-entity outcomes, so merge-shards can check every entity was invoiced once
+            'entities': stats.entities()
+        })
+        logger.info(f"Run report written to {args.report}")
+        if args.prom_file:
+            metrics.write_prometheus(args.prom_file, stats.as_dict())
+            logger.info(f"Prometheus metrics written to {args.prom_file}")
+    except OSError as e:
+        # The invoices are already out; a missing report shouldn't fail the run
+        logger.error(f"Failed to write run report: {e}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Invoice render daemon
+
+Keeps warm render processes (WeasyPrint loaded, stylesheet parsed, fonts
+discovered), a Postgres connection pool and one S3 client alive, so an
+on-demand regeneration only pays for its own render and upload. Jobs are JSON
+objects, one per line on a unix socket, or NOTIFY payloads on a Postgres
+channel (--listen):
+
+    {"role": "client", "name": "Acme Holdings LLC", "force": true}
+
+Socket jobs get a JSON reply line; channel jobs are answered on <channel>_done.
+{"command": "stats"} replies with the daemon's stage timings.
+"""
+import os
+import sys
+import json
+import time
+import select
+import signal
+import argparse
+import threading
+import socketserver
+import logging
+from contextlib import suppress
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict
+
+import psycopg2
+from psycopg2 import sql
+from dotenv import load_dotenv
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_invoices import (ROLES, setup_logging, current_invoice_date, store_invoice,
+                               _init_render_worker, _render_in_worker)
+from invoice_generator.database import DatabasePool
+from invoice_generator.fingerprint import invoice_fingerprint
+from invoice_generator.metrics import metrics
+from invoice_generator.pdf_generator import render_version
+from invoice_generator.s3_uploader import S3Uploader
+
+logger = logging.getLogger(__name__)
+
+# Seconds before the first attempt to reopen a lost --listen connection,
+# doubling on each failed attempt up to the maximum
+LISTEN_RETRY_DELAY = 1.0
+LISTEN_RETRY_MAX_DELAY = 60.0
+
+
+class InvoiceDaemon:
+    """Regenerates single invoices on request, sharing warm resources between requests"""
+
+    def __init__(self, pool: DatabasePool, s3: S3Uploader, render_pool: ProcessPoolExecutor,
+                 template_version: str, logo_url: str = None):
+        """
+        Args:
+            pool: Connections checked out per job
+            s3: Uploader shared by every job (boto3 clients are thread-safe)
+            render_pool: Render processes set up by _init_render_worker
+            template_version: The render processes' PDFGenerator.template_version
+                (pdf_generator.render_version), for invoice fingerprints
+        """
+        self.pool = pool
+        self.s3 = s3
+        self.render_pool = render_pool
+        self.logo_url = logo_url
+        self.template_version = template_version
+
+    def regenerate(self, role: str, name: str, force: bool = False) -> Dict:
+        """
+        Render, upload and record one entity's invoice for the current month
+
+        Unless `force` is set, an invoice whose source fingerprint is unchanged
+        is left alone.
+        """
+        started = time.perf_counter()
+        label = ROLES[role]['label']
+        invoice_date = current_invoice_date()
+        with self.pool.manager() as db:
+            records = db.get_entity_records(role, [name], invoice_date).get(name)
+            if not records:
+                return {'ok': False, 'error': f"No records to invoice for {label} {name}"}
+            fingerprint = invoice_fingerprint(role, name, records, invoice_date, self.template_version,
+                                              self.logo_url)
+            if not force and db.get_invoice_fingerprint(role, name, invoice_date.date()) == fingerprint:
+                logger.info(f"Unchanged since last run, skipping {label}: {name}")
+                return {'ok': True, 'status': 'unchanged', 'seconds': time.perf_counter() - started}
+
+        # No connection is held while rendering
+        invoice, worker_metrics = self.render_pool.submit(_render_in_worker, role, name, records, invoice_date,
+                                                          self.logo_url, fingerprint).result()
+        metrics.merge(worker_metrics)
+        with self.pool.manager() as db:
+            s3_url = store_invoice(db, self.s3, invoice)
+        return {
+            'ok': True,
+            'status': 'processed',
+            's3_url': s3_url,
+            'total_amount': str(invoice.total_amount),
+            'record_count': invoice.record_count,
+            'seconds': time.perf_counter() - started
+        }
+
+    def handle(self, request: Dict) -> Dict:
+        """Run one job request and build its reply; never raises"""
+        if request.get('command') == 'stats':
+            return {'ok': True, 'metrics': metrics.summary()}
+        role, name = request.get('role'), request.get('name')
+        if role not in ROLES or not isinstance(name, str) or not name:
+            return {'ok': False, 'error': f"Expected {{\"role\": one of {list(ROLES)}, \"name\": ...}}"}
+        try:
+            reply = self.regenerate(role, name, force=bool(request.get('force')))
+        except Exception as e:
+            logger.error(f"✗ Failed to regenerate {ROLES[role]['label']} {name}: {str(e)}", exc_info=True)
+            reply = {'ok': False, 'error': str(e)}
+        return {'role': role, 'name': name, **reply}
+
+
+class JobRequestHandler(socketserver.StreamRequestHandler):
+    """Reads JSON job lines from a socket client and writes one JSON reply line for each"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                reply = {'ok': False, 'error': f"Invalid JSON: {e}"}
+            else:
+                reply = self.server.invoice_daemon.handle(request)
+            self.wfile.write(json.dumps(reply, default=str).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server handling each client connection in its own thread"""
+    daemon_threads = True
+
+    def __init__(self, path: str, invoice_daemon: InvoiceDaemon):
+        # A socket file left behind by an earlier daemon would make bind fail
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, JobRequestHandler)
+        os.chmod(path, 0o660)
+        self.invoice_daemon = invoice_daemon
+
+
+def listen_for_jobs(invoice_daemon: InvoiceDaemon, database_url: str, channel: str, stop: threading.Event,
+                    jobs: ThreadPoolExecutor):
+    """
+    Take jobs from NOTIFY payloads on `channel` until `stop` is set
+
+    Jobs run on `jobs`; each reply is sent as a NOTIFY on <channel>_done. A lost
+    connection is reopened after a growing delay; notifications sent while it
+    was down are lost, as Postgres only delivers them to current listeners.
+    """
+    reply_channel = f"{channel}_done"
+    conn = reply_conn = None
+
+    def reply(payload: Dict):
+        with reply_conn.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", (reply_channel, json.dumps(payload, default=str)))
+
+    def run(payload: str):
+        try:
+            request = json.loads(payload)
+        except ValueError as e:
+            request, result = None, {'ok': False, 'error': f"Invalid JSON: {e}"}
+        if request is not None:
+            result = invoice_daemon.handle(request)
+        try:
+            reply(result)
+        except psycopg2.Error as e:
+            logger.error(f"✗ Failed to reply on {reply_channel}: {str(e)}")
+
+    delay = LISTEN_RETRY_DELAY
+    while not stop.is_set():
+        try:
+            conn = psycopg2.connect(database_url)
+            conn.autocommit = True
+            # Replies go out on their own connection: polling the listening one while a
+            # job thread runs a query on it would swallow that query's result
+            reply_conn = psycopg2.connect(database_url)
+            reply_conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+            logger.info(f"Listening for jobs on channel {channel}, replying on {reply_channel}")
+            delay = LISTEN_RETRY_DELAY
+            while not stop.is_set():
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    jobs.submit(run, conn.notifies.pop(0).payload)
+        except psycopg2.Error as e:
+            logger.error(f"✗ Lost the connection listening on {channel}: {str(e).strip()}; "
+                         f"reconnecting in {delay:g}s")
+            stop.wait(delay)
+            delay = min(delay * 2, LISTEN_RETRY_MAX_DELAY)
+        finally:
+            for connection in (conn, reply_conn):
+                if connection is not None:
+                    connection.close()
+            conn = reply_conn = None
+
+
+def parse_args(argv=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Serve on-demand invoice regeneration from warm workers')
+    parser.add_argument('--socket', default='invoice_daemon.sock',
+                        help='Unix socket to accept JSON jobs on (default: invoice_daemon.sock)')
+    parser.add_argument('--listen', metavar='CHANNEL',
+                        help='Also take jobs from NOTIFY payloads on this Postgres channel')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Warm render processes (default: 2)')
+    parser.add_argument('--pool-size', type=int, default=4,
+                        help='Pooled Postgres connections, i.e. jobs fetching or saving at once (default: 4)')
+    parser.add_argument('--asset-cache',
+                        help='Directory caching fetched template resources (logo) across runs')
+    parser.add_argument('--optimize-pdf', action='store_true',
+                        help='Shrink PDFs before upload, as generate_invoices.py --optimize-pdf')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Main execution function"""
+    args = parse_args(argv)
+    setup_logging()
+    load_dotenv()
+
+    database_url = os.getenv('DATABASE_URL')
+    aws_access_key = os.getenv('AWS_ACCESS_KEY_ID')
+    aws_secret_key = os.getenv('AWS_SECRET_ACCESS_KEY')
+    aws_region = os.getenv('AWS_REGION', 'us-east-1')
+    s3_bucket = os.getenv('S3_BUCKET_NAME')
+    if not all([database_url, aws_access_key, aws_secret_key, s3_bucket]):
+        logger.error("Missing required environment variables!")
+        logger.error("Required: DATABASE_URL, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_BUCKET_NAME")
+        sys.exit(1)
+
+    template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'invoice_generator', 'templates')
+    logger.info(f"Starting {args.workers} render processes...")
+    render_pool = ProcessPoolExecutor(max_workers=args.workers, initializer=_init_render_worker,
+                                      initargs=(template_dir, args.asset_cache, args.optimize_pdf, True))
+    # Start (and so warm up) every render process before taking jobs; a process
+    # that can't render would fail every job, so don't start serving at all
+    try:
+        for future in [render_pool.submit(os.getpid) for _ in range(args.workers)]:
+            future.result()
+    except BrokenProcessPool:
+        logger.error("Render processes failed to start or warm up; see the traceback above")
+        render_pool.shutdown(wait=False, cancel_futures=True)
+        sys.exit(1)
+
+    pool = DatabasePool(database_url, maxconn=args.pool_size)
+    s3 = S3Uploader(aws_access_key, aws_secret_key, aws_region, s3_bucket,
+                    max_pool_connections=max(args.pool_size, 10),
+                    endpoint_url=os.getenv('S3_ENDPOINT_URL'))
+    invoice_daemon = InvoiceDaemon(pool, s3, render_pool, render_version(template_dir, optimize=args.optimize_pdf),
+                                   os.getenv('LOGO_URL'))
+
+    server = JobServer(args.socket, invoice_daemon)
+    stop = threading.Event()
+    jobs = ThreadPoolExecutor(max_workers=args.pool_size, thread_name_prefix='notify-job')
+    listener = None
+    if args.listen:
+        listener = threading.Thread(target=listen_for_jobs, name='listen', daemon=True,
+                                    args=(invoice_daemon, database_url, args.listen, stop, jobs))
+        listener.start()
+
+    def shut_down(signum, frame):
+        logger.info("Shutting down...")
+        stop.set()
+        # shutdown() waits for serve_forever to return, so it can't run on this thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shut_down)
+    signal.signal(signal.SIGINT, shut_down)
+
+    logger.info(f"Ready for jobs on {args.socket}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        with suppress(FileNotFoundError):
+            os.unlink(args.socket)
+        if listener is not None:
+            listener.join()
+        jobs.shutdown(wait=True)
+        render_pool.shutdown(wait=True)
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+Asyncio database and S3 clients for the --async engine
+
+asyncpg and aioboto3 are optional dependencies (requirements-async.txt) and
+are only imported when an async client is created. Records come back as the
+same row types as DatabaseManager's, so proration, fingerprints and rendering
+work unchanged.
+"""
+import uuid
+import asyncio
+import importlib
+import logging
+from datetime import date, datetime, timezone
+from operator import attrgetter
+from typing import Dict, Iterable, List, Tuple
+
+from .database import (ROLE_QUERIES, LINE_ITEM_COLUMNS, line_item_rows, changed_entities_query, named_records_query,
+                       record_query_params)
+from .metrics import metrics
+from .proration import InvoiceLines
+from .records import Record, ROLE_RECORD_TYPES
+from .s3_uploader import RETRYABLE_ERROR_CODES, backoff_delay, object_url
+from .storage import invoice_key
+
+logger = logging.getLogger(__name__)
+
+
+def _require(module: str):
+    """Import an optional async dependency, explaining how to install it"""
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise RuntimeError(f"--async needs the '{module}' package: pip3 install -r requirements-async.txt")
+
+
+def _numbered(query: str, params: Dict) -> Tuple[str, List]:
+    """
+    Turn a psycopg2 query's %(name)s parameters into asyncpg's $1, $2, ...
+
+    Returns the query and the values of just the parameters it uses, in $n
+    order; asyncpg rejects arguments a query doesn't reference.
+    """
+    args = []
+    for name, value in params.items():
+        if f'%({name})s' in query:
+            args.append(value)
+            query = query.replace(f'%({name})s', f'${len(args)}')
+    return query, args
+
+
+class AsyncDatabaseManager:
+    """asyncpg counterpart of DatabaseManager, over a connection pool"""
+
+    def __init__(self, database_url: str, pool_size: int = 10):
+        """
+        Args:
+            pool_size: Maximum pooled connections, i.e. queries in flight at once
+        """
+        self.database_url = database_url
+        self.pool_size = pool_size
+        self.pool = None
+        self._timezone = timezone.utc
+
+    async def connect(self):
+        """Open the connection pool"""
+        asyncpg = _require('asyncpg')
+        self.pool = await asyncpg.create_pool(self.database_url, min_size=1, max_size=self.pool_size)
+        # asyncpg returns timestamptz in UTC; psycopg2 uses the session time zone.
+        # Match it so dates, proration and fingerprints agree with the other engines.
+        setting = await self.pool.fetchval('SHOW TimeZone')
+        try:
+            from zoneinfo import ZoneInfo
+            self._timezone = ZoneInfo(setting)
+        except (ImportError, KeyError, ValueError):
+            logger.warning(f"Unknown session time zone {setting!r}, timestamps stay in UTC")
+        return self.pool
+
+    async def close(self):
+        """Close the connection pool"""
+        if self.pool:
+            await self.pool.close()
+
+    def _to_value(self, value):
+        """Convert an asyncpg value to the one psycopg2 would return"""
+        if isinstance(value, uuid.UUID):
+            return str(value)
+        if isinstance(value, datetime) and value.tzinfo is not None:
+            return value.astimezone(self._timezone)
+        return value
+
+    def _record_query_params(self, invoice_date) -> Dict[str, datetime]:
+        """record_query_params in the session time zone, as psycopg2 would send them"""
+        return {name: value.replace(tzinfo=self._timezone)
+                for name, value in record_query_params(invoice_date).items()}
+
+    async def get_all_role_records(self, role: str, invoice_date,
+                                   names: Iterable[str] = None) -> Dict[str, List[Record]]:
+        """Get the records a role invoices on a date, grouped by name (see DatabaseManager.get_all_role_records)"""
+        query, key = ROLE_QUERIES[role]
+        params = self._record_query_params(invoice_date)
+        if names is not None:
+            query, params['names'] = named_records_query(role), list(names)
+        query, args = _numbered(query, params)
+        with metrics.stage('db_fetch'):
+            records = await self.pool.fetch(query, *args)
+        make = ROLE_RECORD_TYPES[role]._make
+        name_of = attrgetter(key)
+        groups = {}
+        for record in records:
+            row = make(map(self._to_value, record.values()))
+            groups.setdefault(name_of(row), []).append(row)
+        return groups
+
+    async def get_entity_changes(self, role: str, since: datetime, invoice_date: date) -> Dict[str, bool]:
+        """Get {name: changed after `since`} for every entity of a role (see changed_entities_query)"""
+        params = {'since': since, 'role': role, 'invoice_date': invoice_date,
+                  **self._record_query_params(invoice_date)}
+        query, args = _numbered(changed_entities_query(role), params)
+        with metrics.stage('db_fetch'):
+            records = await self.pool.fetch(query, *args)
+        return {record[0]: bool(record[1]) for record in records}
+
+    async def get_invoice_fingerprints(self, role: str, invoice_date: date) -> Dict[str, str]:
+        """Get {business_name: source_fingerprint} for a role's existing invoices on a date"""
+        records = await self.pool.fetch("""
+            SELECT business_name, source_fingerprint
+            FROM invoices
+            WHERE role = $1
+            AND invoice_date = $2
+            AND source_fingerprint IS NOT NULL
+        """, role, invoice_date)
+        return {record['business_name']: record['source_fingerprint'] for record in records}
+
+    async def save_invoice_record(self, business_name: str, role: str, invoice_date: date,
+                                  file_name: str, s3_key: str, s3_url: str,
+                                  total_amount, record_count: int, source_fingerprint: str = None,
+                                  line_items: InvoiceLines = None):
+        """Save invoice metadata, and its line items if given, in one transaction"""
+        with metrics.stage('metadata_save'):
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    invoice_id = await conn.fetchval("""
+                        INSERT INTO invoices
+                        (business_name, role, invoice_date, file_name, s3_key, s3_url, total_amount, record_count,
+                         source_fingerprint)
+                        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                        ON CONFLICT (business_name, role, invoice_date)
+                        DO UPDATE SET
+                            file_name = EXCLUDED.file_name,
+                            s3_key = EXCLUDED.s3_key,
+                            s3_url = EXCLUDED.s3_url,
+                            total_amount = EXCLUDED.total_amount,
+                            record_count = EXCLUDED.record_count,
+                            source_fingerprint = EXCLUDED.source_fingerprint,
+                            updated_at = CURRENT_TIMESTAMP
+                        RETURNING id
+                    """, business_name, role, invoice_date, file_name, s3_key, s3_url, total_amount,
+                        record_count, source_fingerprint)
+                    if line_items is not None:
+                        await conn.execute("DELETE FROM invoice_line_items WHERE invoice_id = $1", invoice_id)
+                        await conn.copy_records_to_table(
+                            'invoice_line_items', columns=LINE_ITEM_COLUMNS,
+                            records=list(line_item_rows(invoice_id, line_items, datetime.now(timezone.utc)))
+                        )
+
+
+class AsyncS3Uploader:
+    """
+    aioboto3 counterpart of S3Uploader
+
+    Use as an async context manager; `upload_pdf` is a coroutine with the same
+    retry behaviour. It is not a StorageBackend, since its upload can't be
+    called synchronously; keys and URLs come from the same functions
+    (storage.invoice_key, s3_uploader.object_url) as S3Uploader's.
+    """
+
+    def __init__(self, aws_access_key_id: str, aws_secret_access_key: str,
+                 region: str, bucket_name: str, max_pool_connections: int = 10,
+                 endpoint_url: str = None, max_attempts: int = 5, backoff_base: float = 0.5,
+                 backoff_cap: float = 20.0):
+        """Takes S3Uploader's arguments"""
+        self.bucket_name = bucket_name
+        self.endpoint_url = endpoint_url
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._client_args = dict(aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key,
+                                 region_name=region, endpoint_url=endpoint_url)
+        self._max_pool_connections = max_pool_connections
+        self._client_context = None
+        self.s3_client = None
+
+    def generate_s3_key(self, role: str, business_name: str, file_name: str) -> str:
+        """S3 key (path) for the invoice; see storage.invoice_key"""
+        return invoice_key(role, business_name, file_name)
+
+    def object_url(self, s3_key: str) -> str:
+        """URL of an uploaded object"""
+        return object_url(self.bucket_name, s3_key, self.endpoint_url)
+
+    async def __aenter__(self):
+        aioboto3 = _require('aioboto3')
+        config = _require('aiobotocore.config').AioConfig(max_pool_connections=self._max_pool_connections,
+                                                          retries={'max_attempts': 1, 'mode': 'standard'})
+        self._client_context = aioboto3.Session().client('s3', config=config, **self._client_args)
+        self.s3_client = await self._client_context.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._client_context.__aexit__(exc_type, exc_value, traceback)
+        self.s3_client = None
+
+    async def upload_pdf(self, pdf_content: bytes, s3_key: str, record_count: int = None) -> str:
+        """Upload a PDF and return its URL, retrying throttling errors with jittered backoff"""
+        ClientError = _require('botocore.exceptions').ClientError
+        attempt = 1
+        while True:
+            try:
+                with metrics.stage('s3_upload'):
+                    await self.s3_client.put_object(
+                        Bucket=self.bucket_name,
+                        Key=s3_key,
+                        Body=pdf_content,
+                        ContentType='application/pdf',
+                        ServerSideEncryption='AES256'  # Encrypt at rest
+                    )
+                metrics.increment('bytes_uploaded', len(pdf_content))
+                break
+
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code in RETRYABLE_ERROR_CODES and attempt < self.max_attempts:
+                    delay = backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+                    logger.warning(f"S3 upload of {s3_key} throttled ({code}), retrying in {delay:.2f}s "
+                                   f"(attempt {attempt}/{self.max_attempts})")
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+
+                logger.error(f"Failed to upload PDF to S3: {e}")
+                raise
+
+        url = self.object_url(s3_key)
+        logger.info(f"Successfully uploaded PDF to {url}")
+        return url
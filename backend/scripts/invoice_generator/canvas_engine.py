@@ -0,0 +1,446 @@
+"""
+Direct-to-PDF invoice rendering with ReportLab (--engine reportlab)
+
+Draws the layout of invoice_pages.html and invoice.css straight onto a PDF
+canvas, from the same template context, without HTML parsing, CSS layout or
+font embedding. WeasyPrint stays the reference engine, and
+benchmark_invoices.py --engine-parity compares the two.
+
+Sizes below are the stylesheet's CSS pixels (0.75pt each) and are measured
+from the top of the page. Content breaks across pages as WeasyPrint breaks it:
+table rows are never split, the table head is repeated on the next page, and
+a block that doesn't fit starts the next page without its top margin.
+
+ReportLab is an optional dependency (requirements-reportlab.txt), imported
+when the engine is created.
+"""
+import io
+import logging
+import threading
+from typing import Dict, List, Tuple
+
+from .pdf_generator import format_currency, format_date, format_percent
+
+logger = logging.getLogger(__name__)
+
+PT_PER_PX = 0.75
+PAGE_WIDTH = 816
+PAGE_HEIGHT = 1056
+# Horizontal padding of every section, and the top padding of continuation pages
+SIDE = 72
+CONTENT_WIDTH = PAGE_WIDTH - 2 * SIDE
+LINE_HEIGHT = 1.2
+# Helvetica's ascent and descent, as fractions of the font size
+ASCENT = 0.718
+DESCENT = 0.207
+
+REGULAR = 'Helvetica'
+BOLD = 'Helvetica-Bold'
+
+BLUE_DARK = '#1E3A8A'
+BLUE = '#2563EB'
+BLUE_LIGHT = '#60A5FA'
+
+HEADER_PADDING = 48
+LOGO_HEIGHT = 48
+TWO_COLUMN_GAP = 24
+SECTION_TITLE_HEIGHT = 12 + 14 * LINE_HEIGHT + 12
+SUMMARY_ROW_HEIGHT = 16 + 18 * LINE_HEIGHT + 16
+CELL_PADDING_X = 20
+CELL_PADDING_Y = 18
+HEAD_HEIGHT = 16 + 12 * LINE_HEIGHT + 16
+NOTE_HEIGHT = 2 + 9 * LINE_HEIGHT
+TOTAL_BAR_HEIGHT = 2 + 24 + 32 * LINE_HEIGHT + 24 + 2
+FOOTER_HEIGHT = (1 + 24 + 15 * LINE_HEIGHT + 16 + 14 * LINE_HEIGHT + 12 + 12
+                 + 4 + 13 * 1.6 + 4 + 13 * 1.6 + 4 + 24 + 6 + SIDE)
+
+WEBSITE = 'http://www.CoastalPrivateLending.com'
+
+
+def _cells_client(record, amount) -> List[str]:
+    return [str(record.project_address), format_currency(record.loan_amount), format_currency(amount)]
+
+
+def _cells_investor(record, amount) -> List[str]:
+    return [format_date(record.fund_date), format_currency(record.loan_amount),
+            format_percent(record.interest_rate), format_currency(amount)]
+
+
+def _cells_capinvestor(record, amount) -> List[str]:
+    return [str(record.property_address), format_currency(record.loan_amount),
+            format_percent(record.interest_rate), format_currency(amount)]
+
+
+# Role -> (column headers, column widths as shares of the table, cell texts for (record, amount))
+ROLE_TABLES = {
+    'client': (('Property Address', 'Loan Amount', 'Interest Payment'), (0.5, 0.25, 0.25), _cells_client),
+    'investor': (('Date Funded', 'Loan Amount', 'Interest Rate', 'Interest Earned'),
+                 (0.28, 0.26, 0.2, 0.26), _cells_investor),
+    'capinvestor': (('Property Address', 'Loan Amount', 'Interest Rate', 'Interest Earned'),
+                    (0.37, 0.22, 0.17, 0.24), _cells_capinvestor)
+}
+
+
+class CanvasEngine:
+    """Renders invoice template contexts to PDF with ReportLab's canvas"""
+
+    def __init__(self, url_fetcher):
+        """
+        Args:
+            url_fetcher: Fetches the logo (PDFGenerator's CachingURLFetcher, so
+                the asset cache and --optimize-pdf downscaling apply)
+        """
+        try:
+            from reportlab.lib.colors import Color, HexColor
+            from reportlab.lib.utils import ImageReader
+            from reportlab.pdfbase.pdfmetrics import stringWidth
+            from reportlab.pdfgen.canvas import Canvas
+        except ImportError:
+            raise RuntimeError("--engine reportlab needs the 'reportlab' package: "
+                               "pip3 install -r requirements-reportlab.txt")
+        self._canvas_class = Canvas
+        self._color = Color
+        self._hex = HexColor
+        self._image_reader = ImageReader
+        self._string_width = stringWidth
+        self.url_fetcher = url_fetcher
+        self._logos = {}
+        self._logo_lock = threading.Lock()
+
+    def render(self, context: Dict) -> Tuple[bytes, int]:
+        """
+        Draw one invoice
+
+        Args:
+            context: Template context from PDFGenerator._invoice_context
+
+        Returns:
+            (PDF content, page count)
+        """
+        output = io.BytesIO()
+        canvas = self._canvas_class(output, pagesize=(PAGE_WIDTH * PT_PER_PX, PAGE_HEIGHT * PT_PER_PX),
+                                    pageCompression=1, invariant=1)
+        canvas.setTitle(f"Invoice - {context['business_name']}")
+        page_count = _InvoiceDrawing(self, canvas, context).draw()
+        canvas.save()
+        return output.getvalue(), page_count
+
+    def logo(self, url: str):
+        """
+        The logo as drawn by .invoice-logo-image (filter: brightness(0) invert(1)):
+        a white silhouette keeping the image's transparency
+
+        Returns:
+            (ImageReader, width / height), or None if it can't be fetched or decoded
+        """
+        with self._logo_lock:
+            if url in self._logos:
+                return self._logos[url]
+        # Pillow is a ReportLab (and WeasyPrint) dependency
+        from PIL import Image
+
+        try:
+            resource = self.url_fetcher(url)
+            image = Image.open(io.BytesIO(resource['string']))
+            image.load()
+        except Exception as e:
+            logger.warning(f"Could not load logo {url}, drawing invoices without it: {e}")
+            logo = None
+        else:
+            silhouette = Image.new('RGBA', image.size, (255, 255, 255, 255))
+            if 'A' in image.getbands() or 'transparency' in image.info:
+                silhouette.putalpha(image.convert('RGBA').getchannel('A'))
+            logo = (self._image_reader(silhouette), image.width / image.height)
+        with self._logo_lock:
+            self._logos[url] = logo
+        return logo
+
+
+class _InvoiceDrawing:
+    """Draws one invoice's pages, tracking the position on the current page"""
+
+    def __init__(self, engine: CanvasEngine, canvas, context: Dict):
+        self.engine = engine
+        self.canvas = canvas
+        self.context = context
+        self.role = context['role']
+        self.y = 0
+        self.page_count = 1
+
+    # Primitives; x and top are CSS px from the page's top left corner
+
+    def _color(self, color: str, alpha: float = None):
+        color = self.engine._hex(color)
+        if alpha is not None:
+            color = self.engine._color(color.red, color.green, color.blue, alpha=alpha)
+        return color
+
+    def _width(self, text: str, size: float, font: str, spacing: float = 0) -> float:
+        return self.engine._string_width(text, font, size) + spacing * len(text)
+
+    def _text(self, text: str, x: float, top: float, size: float, font: str = REGULAR, color: str = '#000000',
+              alpha: float = None, spacing: float = 0, align: str = 'left', line_height: float = LINE_HEIGHT):
+        """Draw one line of text whose line box starts at `top`"""
+        if align == 'right':
+            x -= self._width(text, size, font, spacing)
+        elif align == 'center':
+            x -= self._width(text, size, font, spacing) / 2
+        baseline = top + (line_height - ASCENT - DESCENT) / 2 * size + ASCENT * size
+        text_object = self.canvas.beginText(x * PT_PER_PX, (PAGE_HEIGHT - baseline) * PT_PER_PX)
+        text_object.setFont(font, size * PT_PER_PX)
+        text_object.setFillColor(self._color(color, alpha))
+        if spacing:
+            text_object.setCharSpace(spacing * PT_PER_PX)
+        text_object.textOut(text)
+        self.canvas.drawText(text_object)
+
+    def _wrap(self, text: str, width: float, size: float, font: str = REGULAR) -> List[str]:
+        """Break text into lines no wider than `width`, at spaces where possible"""
+        lines, line = [], ''
+        for word in text.split(' '):
+            candidate = f'{line} {word}' if line else word
+            if line and self._width(candidate, size, font) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        return lines + [line]
+
+    def _rect(self, x: float, top: float, width: float, height: float, fill: str = None, fill_alpha: float = None,
+              stroke: str = None, stroke_alpha: float = None, border: float = 0, radius: float = 0):
+        """Draw a box; a border is drawn inside it, as with box-sizing: border-box"""
+        canvas = self.canvas
+        inset = border / 2
+        x, top, width, height = x + inset, top + inset, width - border, height - border
+        if fill:
+            canvas.setFillColor(self._color(fill, fill_alpha))
+        if stroke:
+            canvas.setStrokeColor(self._color(stroke, stroke_alpha))
+            canvas.setLineWidth(border * PT_PER_PX)
+        args = (x * PT_PER_PX, (PAGE_HEIGHT - top - height) * PT_PER_PX, width * PT_PER_PX, height * PT_PER_PX)
+        if radius:
+            canvas.roundRect(*args, max(radius - inset, 0) * PT_PER_PX, stroke=int(bool(stroke)), fill=int(bool(fill)))
+        else:
+            canvas.rect(*args, stroke=int(bool(stroke)), fill=int(bool(fill)))
+
+    def _gradient(self, x: float, top: float, width: float, height: float, stops: Tuple[str, ...],
+                  diagonal: bool = True, radius: float = 0):
+        """Fill a box with a 135deg (or, without `diagonal`, 90deg) linear gradient"""
+        canvas = self.canvas
+        canvas.saveState()
+        path = canvas.beginPath()
+        args = (x * PT_PER_PX, (PAGE_HEIGHT - top - height) * PT_PER_PX, width * PT_PER_PX, height * PT_PER_PX)
+        if radius:
+            path.roundRect(*args, radius * PT_PER_PX)
+        else:
+            path.rect(*args)
+        canvas.clipPath(path, stroke=0, fill=0)
+        end_x, end_top = (x + width, top + height) if diagonal else (x + width, top)
+        positions = [index / (len(stops) - 1) for index in range(len(stops))]
+        canvas.linearGradient(x * PT_PER_PX, (PAGE_HEIGHT - top) * PT_PER_PX,
+                              end_x * PT_PER_PX, (PAGE_HEIGHT - end_top) * PT_PER_PX,
+                              [self.engine._hex(stop) for stop in stops], positions, extend=True)
+        canvas.restoreState()
+
+    # Flow
+
+    def _new_page(self, top: float = 0):
+        self.canvas.showPage()
+        self.page_count += 1
+        self.y = top
+
+    def _place(self, margin: float, height: float):
+        """Move past `margin` to a block of `height`, on the next page if it doesn't fit on this one"""
+        if self.y > 0 and self.y + margin + height > PAGE_HEIGHT:
+            # Margins are truncated at a page break
+            self._new_page()
+        else:
+            self.y += margin
+
+    # Sections
+
+    def draw(self) -> int:
+        """Draw every page; returns the page count"""
+        pages = self.context['pages']
+        for index, page in enumerate(pages):
+            if index:
+                self._new_page(SIDE)
+            else:
+                self._draw_header()
+                self._draw_two_column()
+            self._draw_table(page['records'], first=index == 0)
+            if index == len(pages) - 1:
+                self._draw_total()
+                self._draw_footer()
+        return self.page_count
+
+    def _draw_header(self):
+        context = self.context
+        logo = self.engine.logo(context['logo_url']) if context['logo_url'] else None
+        title_height = 14 * LINE_HEIGHT
+        logo_column_height = (LOGO_HEIGHT + 8 if logo else 0) + title_height
+
+        date_text = context['invoice_date']
+        date_width = max(self._width('DATE', 11, BOLD, 1.1), self._width(date_text, 17, BOLD))
+        box_width = 2 + 24 + date_width + 24 + 2
+        box_height = 2 + 14 + 11 * LINE_HEIGHT + 6 + 17 * LINE_HEIGHT + 14 + 2
+        content_height = max(logo_column_height, box_height)
+        height = HEADER_PADDING + content_height + HEADER_PADDING
+        self._gradient(0, self.y, PAGE_WIDTH, height, (BLUE_DARK, BLUE))
+
+        top = self.y + HEADER_PADDING + (content_height - logo_column_height) / 2
+        if logo:
+            reader, aspect = logo
+            self.canvas.drawImage(reader, SIDE * PT_PER_PX, (PAGE_HEIGHT - top - LOGO_HEIGHT) * PT_PER_PX,
+                                  LOGO_HEIGHT * aspect * PT_PER_PX, LOGO_HEIGHT * PT_PER_PX, mask='auto')
+            top += LOGO_HEIGHT + 8
+        self._text('Loan Invoice', SIDE, top, 14, color='#FFFFFF', alpha=0.95)
+
+        box_x = PAGE_WIDTH - SIDE - box_width
+        box_top = self.y + HEADER_PADDING + (content_height - box_height) / 2
+        self._rect(box_x, box_top, box_width, box_height, fill='#FFFFFF', fill_alpha=0.2,
+                   stroke='#FFFFFF', stroke_alpha=0.3, border=2, radius=10)
+        center = box_x + box_width / 2
+        self._text('DATE', center, box_top + 16, 11, BOLD, '#FFFFFF', spacing=1.1, align='center')
+        self._text(date_text, center, box_top + 16 + 11 * LINE_HEIGHT + 6, 17, BOLD, '#FFFFFF', align='center')
+        self.y += height
+
+    def _draw_section(self, x: float, width: float, height: float, title: str):
+        """A bordered box with a grey title bar; returns the top of its content"""
+        self._rect(x, self.y, width, height, stroke='#000000', border=2)
+        self._rect(x + 2, self.y + 2, width - 4, SECTION_TITLE_HEIGHT, fill='#E8E8E8')
+        self._rect(x + 2, self.y + 2 + SECTION_TITLE_HEIGHT, width - 4, 2, fill='#000000')
+        self._text(title.upper(), x + 2 + 16, self.y + 2 + 12, 14, BOLD, spacing=0.5)
+        return self.y + 2 + SECTION_TITLE_HEIGHT + 2
+
+    def _draw_two_column(self):
+        context = self.context
+        width = (CONTENT_WIDTH - TWO_COLUMN_GAP) / 2
+        name_lines = self._wrap(context['business_name'], width - 4 - 32, 16)
+        if self.role == 'client':
+            summary = [('Total Interest Due', context['total_interest_due'])]
+        else:
+            summary = [('Total Amount Invested', context['total_invested']),
+                       ('Monthly Interest Earned', context['monthly_interest'])]
+        chrome = 2 + SECTION_TITLE_HEIGHT + 2 + 2
+        # Grid items in a row stretch to the tallest one
+        height = max(chrome + 16 + len(name_lines) * 16 * LINE_HEIGHT + 16,
+                     chrome + len(summary) * SUMMARY_ROW_HEIGHT)
+        self._place(32, height)
+
+        top = self._draw_section(SIDE, width, height, 'Bill To') + 16
+        for line in name_lines:
+            self._text(line, SIDE + 2 + 16, top, 16)
+            top += 16 * LINE_HEIGHT
+
+        x = SIDE + width + TWO_COLUMN_GAP
+        top = self._draw_section(x, width, height, 'Account Summary')
+        for label, value in summary:
+            row_middle = top + SUMMARY_ROW_HEIGHT / 2
+            self._text(label, x + 2 + 16, row_middle - 14 * LINE_HEIGHT / 2, 14, BOLD)
+            self._text(format_currency(value), x + width - 2 - 16, row_middle - 18 * LINE_HEIGHT / 2, 18, BOLD,
+                       align='right')
+            top += SUMMARY_ROW_HEIGHT
+        self.y += height + 32
+
+    def _draw_head(self, headers: Tuple[str, ...], widths: List[float]):
+        self._gradient(SIDE, self.y, CONTENT_WIDTH, HEAD_HEIGHT, (BLUE_DARK, BLUE))
+        x = SIDE
+        for index, (header, width) in enumerate(zip(headers, widths)):
+            last = index == len(headers) - 1
+            self._text(header.upper(), x + width - CELL_PADDING_X if last else x + CELL_PADDING_X, self.y + 16, 12,
+                       BOLD, '#FFFFFF', spacing=0.6, align='right' if last else 'left')
+            x += width
+        self.y += HEAD_HEIGHT
+
+    def _draw_table(self, rows: List[Tuple], first: bool):
+        headers, shares, cells_of = ROLE_TABLES[self.role]
+        widths = [share * CONTENT_WIDTH for share in shares]
+        if first:
+            self._place(0, 16 * LINE_HEIGHT + 16 + HEAD_HEIGHT)
+            self._text('DESCRIPTION', SIDE, self.y, 16, BOLD, '#1E40AF', spacing=0.5)
+            self.y += 16 * LINE_HEIGHT + 16
+        self._draw_head(headers, widths)
+
+        for index, (record, amount, is_prorated, days_in_period) in enumerate(rows):
+            cells = cells_of(record, amount)
+            lines = [self._wrap(text, width - 2 * CELL_PADDING_X, 15, BOLD if column == len(cells) - 1 else REGULAR)
+                     for column, (text, width) in enumerate(zip(cells, widths))]
+            text_height = max(len(cell_lines) for cell_lines in lines) * 15 * LINE_HEIGHT
+            note_height = NOTE_HEIGHT if is_prorated and self.role != 'client' else 0
+            height = CELL_PADDING_Y + max(text_height, len(lines[-1]) * 15 * LINE_HEIGHT + note_height) \
+                + CELL_PADDING_Y + 1
+            if self.y + height > PAGE_HEIGHT:
+                # Rows aren't split; the head is repeated on the next page
+                self._new_page()
+                self._draw_head(headers, widths)
+
+            if index % 2:
+                self._rect(SIDE, self.y, CONTENT_WIDTH, height - 1, fill='#F9FAFB')
+            self._rect(SIDE, self.y + height - 1, CONTENT_WIDTH, 1, fill='#E5E7EB')
+            x = SIDE
+            for column, (cell_lines, width) in enumerate(zip(lines, widths)):
+                last = column == len(cells) - 1
+                top = self.y + CELL_PADDING_Y
+                for line in cell_lines:
+                    if last:
+                        self._text(line, x + width - CELL_PADDING_X, top, 15, BOLD, '#1E293B', align='right')
+                    else:
+                        self._text(line, x + CELL_PADDING_X, top, 15, REGULAR, '#111827')
+                    top += 15 * LINE_HEIGHT
+                if last and note_height:
+                    self._text(f'Prorated {days_in_period} days', x + width - CELL_PADDING_X, top + 2, 9,
+                               color='#64748B', align='right')
+                x += width
+            self.y += height
+        # The table's 24px bottom margin collapses into the total's 32px top margin
+        self.y += 24
+
+    def _draw_total(self):
+        context = self.context
+        if self.role == 'client':
+            label = f"Total Due {context['invoice_date']}"
+            value = context['total_interest_due']
+        else:
+            label = f"Total Interest Earned ({context['invoice_date']})"
+            value = context['monthly_interest']
+        self._place(32 - 24, TOTAL_BAR_HEIGHT)
+        self._rect(SIDE, self.y, CONTENT_WIDTH, TOTAL_BAR_HEIGHT, fill='#FFFFFF', stroke='#000000', border=2,
+                   radius=12)
+        middle = self.y + TOTAL_BAR_HEIGHT / 2
+        self._text(label.upper(), SIDE + 2 + 28, middle - 16 * LINE_HEIGHT / 2, 16, BOLD, spacing=0.8)
+        self._text(format_currency(value), SIDE + CONTENT_WIDTH - 2 - 28, middle - 32 * LINE_HEIGHT / 2, 32, BOLD,
+                   spacing=-0.64, align='right')
+        self.y += TOTAL_BAR_HEIGHT + 32
+
+    def _draw_footer(self):
+        # The total's 32px bottom margin collapses into the footer's 48px top margin
+        self._place(48 - 32, FOOTER_HEIGHT)
+        center = PAGE_WIDTH / 2
+        top = self.y
+        self._rect(SIDE, top, CONTENT_WIDTH, 1, fill='#E5E7EB')
+        top += 1 + 24
+        self._text('Thank you for your continued partnership.', center, top, 15, color='#1E293B', align='center')
+        top += 15 * LINE_HEIGHT + 16
+
+        parts = [('Coastal Private Lending', '#1E40AF'), ('|', '#CBD5E1'), ('support@coastalprivate.com', '#64748B'),
+                 ('|', '#CBD5E1'), ('(410) 555-8290', '#64748B')]
+        gap = 12
+        x = center - (sum(self._width(text, 14, BOLD) for text, _ in parts) + gap * (len(parts) - 1)) / 2
+        for text, color in parts:
+            self._text(text, x, top, 14, BOLD, color)
+            x += self._width(text, 14, BOLD) + gap
+        top += 14 * LINE_HEIGHT + 12 + 12 + 4
+
+        self._text('30 E. Padonia Rd., Suite 206 • Timonium, MD 21093', center, top, 13, color='#64748B',
+                   align='center', line_height=1.6)
+        top += 13 * 1.6 + 4
+        link = 'www.CoastalPrivateLending.com'
+        self._text(link, center, top, 13, BOLD, BLUE, align='center', line_height=1.6)
+        link_width = self._width(link, 13, BOLD)
+        self.canvas.linkURL(WEBSITE, ((center - link_width / 2) * PT_PER_PX, (PAGE_HEIGHT - top - 13 * 1.6) * PT_PER_PX,
+                                      (center + link_width / 2) * PT_PER_PX, (PAGE_HEIGHT - top) * PT_PER_PX),
+                            relative=0)
+        top += 13 * 1.6 + 4 + 24
+        self._gradient(SIDE, top, CONTENT_WIDTH, 6, (BLUE_DARK, BLUE, BLUE_LIGHT), diagonal=False, radius=3)
+        self.y = top + 6 + SIDE
@@ -1,16 +1,268 @@
 """
 Database operations for invoice generation
 """
+import io
+import uuid
+import threading
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from typing import List, Dict, Optional
-from datetime import date
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from contextlib import contextmanager
+from itertools import groupby
+from operator import attrgetter
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import List, Dict, Optional, Iterable, Iterator, Tuple, Callable
+from datetime import date, datetime, timedelta, timezone
+import logging
+
+from .metrics import metrics
+from .proration import InvoiceLines, covered_month
+from .records import (BusinessRecord, InvestorRecord, CapInvestorRecord, Record, ROLE_RECORD_TYPES,
+                      select_list)
+
+logger = logging.getLogger(__name__)
+
+# Which rows each role invoices for an invoice date, as the Node generator
+# (src/scripts/generate-invoices.js) selects them: %(period_start)s is the first
+# day of the covered month and %(invoice_month)s the first day of the invoice's
+# own month (see record_query_params).
+# A funded loan is first invoiced the month after the month after it closed.
+BUSINESS_FILTER = """
+    business_name IS NOT NULL
+    AND business_name != ''
+    AND (closing_date IS NULL OR closing_date < %(period_start)s)
+"""
+
+# Active loans still open after the covered month, plus closed loans paid off
+# during it (billed for their last month); loans funded in the invoice month or
+# later aren't invoiced yet
+INVESTOR_FILTER = """
+    investor_name IS NOT NULL
+    AND investor_name != ''
+    AND (fund_date IS NULL OR fund_date < %(invoice_month)s)
+    AND (
+        (status ILIKE 'active' AND (payoff_date IS NULL OR payoff_date >= %(invoice_month)s))
+        OR (status ILIKE 'closed' AND payoff_date >= %(period_start)s AND payoff_date < %(invoice_month)s)
+    )
+"""
+
+# As INVESTOR_FILTER, with loan_status 'Funded' for active and anything else for closed
+CAP_INVESTOR_FILTER = """
+    investor_name IS NOT NULL
+    AND investor_name != ''
+    AND (fund_date IS NULL OR fund_date < %(invoice_month)s)
+    AND (
+        (loan_status = 'Funded' AND (payoff_date IS NULL OR payoff_date >= %(invoice_month)s))
+        OR (loan_status != 'Funded' AND payoff_date >= %(period_start)s AND payoff_date < %(invoice_month)s)
+    )
+"""
+
+# Role-wide record queries, ordered by entity name first so rows arrive grouped.
+# Only the columns of each role's row type (see records.py) are selected; the
+# covering indexes (20261018000001-index-invoiced-records.js) carry the filtered columns
+BUSINESS_RECORDS_QUERY = f"""
+    SELECT {select_list(BusinessRecord)}
+    FROM funded
+    WHERE {BUSINESS_FILTER}
+    ORDER BY business_name, project_address
+"""
+
+INVESTOR_RECORDS_QUERY = f"""
+    SELECT {select_list(InvestorRecord)}
+    FROM promissory
+    WHERE {INVESTOR_FILTER}
+    ORDER BY investor_name, fund_date
+"""
+
+CAP_INVESTOR_RECORDS_QUERY = f"""
+    SELECT {select_list(CapInvestorRecord)}
+    FROM capinvestor
+    WHERE {CAP_INVESTOR_FILTER}
+    ORDER BY investor_name, property_address
+"""
+
+# Per-entity record counts and totals over the same rows as the records
+# queries, summed as exact NUMERIC; index-only scans on the covering indexes
+BUSINESS_SUMMARY_QUERY = f"""
+    SELECT business_name AS name,
+           COUNT(*) AS record_count,
+           COALESCE(SUM(interest_payment), 0) AS amount_total,
+           COALESCE(SUM(loan_amount), 0) AS principal_total
+    FROM funded
+    WHERE {BUSINESS_FILTER}
+    GROUP BY business_name
+    ORDER BY business_name
+"""
+
+INVESTOR_SUMMARY_QUERY = f"""
+    SELECT investor_name AS name,
+           COUNT(*) AS record_count,
+           COALESCE(SUM(capital_pay), 0) AS amount_total,
+           COALESCE(SUM(loan_amount), 0) AS principal_total
+    FROM promissory
+    WHERE {INVESTOR_FILTER}
+    GROUP BY investor_name
+    ORDER BY investor_name
+"""
+
+CAP_INVESTOR_SUMMARY_QUERY = f"""
+    SELECT investor_name AS name,
+           COUNT(*) AS record_count,
+           COALESCE(SUM(payment), 0) AS amount_total,
+           COALESCE(SUM(loan_amount), 0) AS principal_total
+    FROM capinvestor
+    WHERE {CAP_INVESTOR_FILTER}
+    GROUP BY investor_name
+    ORDER BY investor_name
+"""
+
+# Role -> (records query, grouping column)
+ROLE_QUERIES = {
+    'client': (BUSINESS_RECORDS_QUERY, 'business_name'),
+    'investor': (INVESTOR_RECORDS_QUERY, 'investor_name'),
+    'capinvestor': (CAP_INVESTOR_RECORDS_QUERY, 'investor_name')
+}
+
+# Role -> per-entity summary query
+ROLE_SUMMARY_QUERIES = {
+    'client': BUSINESS_SUMMARY_QUERY,
+    'investor': INVESTOR_SUMMARY_QUERY,
+    'capinvestor': CAP_INVESTOR_SUMMARY_QUERY
+}
+
+# Role -> source table
+ROLE_TABLES = {
+    'client': 'funded',
+    'investor': 'promissory',
+    'capinvestor': 'capinvestor'
+}
+
+# app_settings key holding the start time of the last complete run (--since)
+WATERMARK_SETTING = 'invoice_generator_watermark'
+
+
+def record_query_params(invoice_date) -> Dict[str, datetime]:
+    """The %(period_start)s and %(invoice_month)s parameters of the records and summary queries"""
+    period_start, period_end = covered_month(invoice_date)
+    invoice_month = period_end + timedelta(days=1)
+    return {'period_start': datetime(period_start.year, period_start.month, period_start.day),
+            'invoice_month': datetime(invoice_month.year, invoice_month.month, invoice_month.day)}
+
+
+def changed_entities_query(role: str) -> str:
+    """
+    Query for every entity of a role, flagging those whose invoice may differ from the one already saved
+
+    Returns (name, changed) rows for the entities invoiced on %(invoice_date)s,
+    which also takes the record_query_params. An entity changed when it has a
+    row created, updated or closed after %(since)s (an updated_at index scan),
+    when its invoiced record count no longer matches its invoice (deleted rows,
+    entities not invoiced yet), or when a loan on that invoice's line items is
+    gone from its rows (a deletion offset by an insert elsewhere).
+    """
+    key = ROLE_QUERIES[role][1]
+    table = ROLE_TABLES[role]
+    return f"""
+        SELECT records.name,
+               invoices.record_count IS DISTINCT FROM records.record_count
+               OR records.name IN (
+                   SELECT {key}
+                   FROM {table}
+                   WHERE updated_at > %(since)s
+                   AND {key} IS NOT NULL
+               )
+               OR EXISTS (
+                   SELECT 1
+                   FROM invoice_line_items AS items
+                   LEFT JOIN {table} AS source
+                       ON source.id = items.loan_id
+                       AND source.{key} = records.name
+                   WHERE items.invoice_id = invoices.id
+                   AND source.id IS NULL
+               ) AS changed
+        FROM ({ROLE_SUMMARY_QUERIES[role]}) AS records
+        LEFT JOIN invoices
+            ON invoices.business_name = records.name
+            AND invoices.role = %(role)s
+            AND invoices.invoice_date = %(invoice_date)s
+    """
+
+
+def named_records_query(role: str) -> str:
+    """A role's records query (ROLE_QUERIES) limited to the names in %(names)s"""
+    query, key = ROLE_QUERIES[role]
+    where, order = query.rsplit('ORDER BY', 1)
+    return f"{where}AND {key} = ANY(%(names)s)\n    ORDER BY{order}"
+
+
+@dataclass(frozen=True)
+class EntitySummary:
+    """One entity's invoiced record count and summed amounts, before proration"""
+    record_count: int
+    # Sum of the role's monthly amount (interest_payment, capital_pay or payment)
+    amount_total: Decimal
+    # Sum of loan_amount
+    principal_total: Decimal
+
+
+# invoice_line_items columns, in the order copy_line_items writes them
+LINE_ITEM_COLUMNS = (
+    'id', 'invoice_id', 'loan_table', 'loan_id', 'loan_identifier', 'original_amount', 'prorated_amount',
+    'is_prorated', 'proration_type', 'period_start_date', 'period_end_date', 'days_in_period',
+    'total_days_in_month', 'created_at', 'updated_at'
+)
+
+
+def _copy_value(value) -> str:
+    """Encode a value for COPY's text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def line_item_rows(invoice_id: int, lines: InvoiceLines, now: datetime) -> Iterator[Tuple]:
+    """An invoice's invoice_line_items rows, in LINE_ITEM_COLUMNS order"""
+    for row in lines.rows():
+        yield (uuid.uuid4(), invoice_id, lines.loan_table) + row + (now, now)
+
+
+def copy_line_items(cursor, invoices: List[Tuple[int, InvoiceLines]]):
+    """
+    Replace the line items of several invoices with a single COPY
+
+    Runs on the caller's cursor, so it commits (or rolls back) together with the
+    invoice headers.
+
+    Args:
+        invoices: (invoice_id, InvoiceLines) pairs
+    """
+    if not invoices:
+        return
+    cursor.execute("DELETE FROM invoice_line_items WHERE invoice_id = ANY(%s)",
+                   ([invoice_id for invoice_id, _ in invoices],))
+
+    now = datetime.now(timezone.utc)
+    buffer = io.StringIO()
+    for invoice_id, lines in invoices:
+        for values in line_item_rows(invoice_id, lines, now):
+            buffer.write('\t'.join(_copy_value(value) for value in values))
+            buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY invoice_line_items ({', '.join(LINE_ITEM_COLUMNS)}) FROM STDIN", buffer)
 
 
 class DatabaseManager:
     def __init__(self, database_url: str):
         self.database_url = database_url
         self.conn = None
+        # Serializes writes when several threads share this connection
+        self._write_lock = threading.Lock()
 
     def connect(self):
         """Establish database connection"""
@@ -36,7 +288,7 @@ class DatabaseManager:
 
     def get_all_investors(self) -> List[str]:
         """Get all unique investor names from promissory table"""
-        with self.conn.cursor as cursor:
+        with self.conn.cursor() as cursor:
             cursor.execute("""
                 SELECT DISTINCT investor_name
                 FROM promissory
@@ -58,57 +310,390 @@ class DatabaseManager:
             """)
             return [row[0] for row in cursor.fetchall()]
 
-    def get_business_records(self, business_name: str) -> List[Dict]:
-        """Get all funded records for a business"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT *
+    def get_business_records(self, business_name: str, invoice_date) -> List[BusinessRecord]:
+        """Get the funded records invoiced to a business on `invoice_date`"""
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT {select_list(BusinessRecord)}
                 FROM funded
-                WHERE business_name = %s
+                WHERE {BUSINESS_FILTER}
+                AND business_name = %(name)s
                 ORDER BY project_address
-            """, (business_name,))
-            return cursor.fetchall()
+            """, {'name': business_name, **record_query_params(invoice_date)})
+            return list(map(BusinessRecord._make, cursor.fetchall()))
 
-    def get_investor_records(self, investor_name: str) -> List[Dict]:
-        """Get active promissory records for an investor"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT *
+    def get_investor_records(self, investor_name: str, invoice_date) -> List[InvestorRecord]:
+        """Get the promissory records invoiced to an investor on `invoice_date`"""
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT {select_list(InvestorRecord)}
                 FROM promissory
-                WHERE investor_name = %s
-                AND (status IS NULL OR status != 'closed')
+                WHERE {INVESTOR_FILTER}
+                AND investor_name = %(name)s
                 ORDER BY fund_date
-            """, (investor_name,))
-            return cursor.fetchall()
+            """, {'name': investor_name, **record_query_params(invoice_date)})
+            return list(map(InvestorRecord._make, cursor.fetchall()))
 
-    def get_cap_investor_records(self, investor_name: str) -> List[Dict]:
-        """Get active capinvestor records for an investor"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT *
+    def get_cap_investor_records(self, investor_name: str, invoice_date) -> List[CapInvestorRecord]:
+        """Get the capinvestor records invoiced to an investor on `invoice_date`"""
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT {select_list(CapInvestorRecord)}
                 FROM capinvestor
-                WHERE investor_name = %s
-                AND (loan_status IS NULL OR loan_status != 'closed')
+                WHERE {CAP_INVESTOR_FILTER}
+                AND investor_name = %(name)s
                 ORDER BY property_address
-            """, (investor_name,))
-            return cursor.fetchall()
+            """, {'name': investor_name, **record_query_params(invoice_date)})
+            return list(map(CapInvestorRecord._make, cursor.fetchall()))
 
-    def save_invoice_record(self, business_name: str, role: str, invoice_date: date,
-                           file_name: str, s3_key: str, s3_url: str,
-                           total_amount: float, record_count: int):
-        """Save invoice metadata to database"""
+    def get_entity_records(self, role: str, names: List[str], invoice_date) -> Dict[str, List[Record]]:
+        """
+        Get the records of just the named entities of a role invoiced on `invoice_date`, grouped by name
+
+        Uses the per-entity queries, so nothing else in the role is read. Names
+        without records to invoice are left out.
+        """
+        fetch = {
+            'client': self.get_business_records,
+            'investor': self.get_investor_records,
+            'capinvestor': self.get_cap_investor_records
+        }[role]
+        groups = {}
+        for name in names:
+            with metrics.stage('db_fetch'):
+                records = fetch(name, invoice_date)
+            if records:
+                groups[name] = records
+        return groups
+
+    def _group_records(self, rows: Iterable[Record], key: str) -> Dict[str, List[Record]]:
+        """Group rows already ordered by `key` into {name: [records]}, keeping row order"""
+        groups = {}
+        name_of = attrgetter(key)
+        for row in rows:
+            groups.setdefault(name_of(row), []).append(row)
+        return groups
+
+    def get_all_role_records(self, role: str, invoice_date,
+                             names: Iterable[str] = None) -> Dict[str, List[Record]]:
+        """
+        Get every record a role ('client', 'investor' or 'capinvestor') invoices on a date, grouped by name
+
+        Args:
+            invoice_date: Invoice date; see the role filters for which rows it selects
+            names: Only read these entities' records, filtered by the database
+                (e.g. the changed ones from get_entity_changes)
+        """
+        query, key = ROLE_QUERIES[role]
+        params = record_query_params(invoice_date)
+        if names is not None:
+            query, params['names'] = named_records_query(role), list(names)
+        with metrics.stage('db_fetch'), self.conn.cursor() as cursor:
+            cursor.execute(query, params)
+            return self._group_records(map(ROLE_RECORD_TYPES[role]._make, cursor.fetchall()), key)
+
+    def _iter_record_groups(self, query: str, key: str, record_type, itersize: int,
+                            params: Dict = None) -> Iterator[Tuple[str, List[Record]]]:
+        """
+        Stream rows through a server-side cursor, yielding one entity's records at a time
+
+        Only `itersize` rows plus the current group are held in memory. Nothing may
+        commit on this connection while the generator is being consumed.
+        """
+        with self.conn.cursor(name=f'{key}_records_stream') as cursor:
+            cursor.itersize = itersize
+            with metrics.stage('db_fetch'):
+                cursor.execute(query, params)
+            groups = groupby(map(record_type._make, cursor), key=attrgetter(key))
+            while True:
+                # Only time the fetch itself, not the consumer's work between groups
+                with metrics.stage('db_fetch'):
+                    try:
+                        name, rows = next(groups)
+                        records = list(rows)
+                    except StopIteration:
+                        break
+                yield name, records
+        self.conn.commit()
+
+    def iter_role_record_groups(self, role: str, invoice_date, itersize: int = 2000,
+                                names: Iterable[str] = None) -> Iterator[Tuple[str, List[Record]]]:
+        """Stream a role's records for `invoice_date` (or only `names`') as (name, records), one entity at a time"""
+        query, key = ROLE_QUERIES[role]
+        params = record_query_params(invoice_date)
+        if names is not None:
+            query, params['names'] = named_records_query(role), list(names)
+        return self._iter_record_groups(query, key, ROLE_RECORD_TYPES[role], itersize, params)
+
+    def get_role_summaries(self, role: str, invoice_date) -> Dict[str, EntitySummary]:
+        """
+        Get {name: EntitySummary} for every entity of a role, in name order
+
+        Counts and sums are done by the database over the same rows as the
+        role's records query, without reading the records themselves.
+        """
+        with metrics.stage('db_fetch'), self.conn.cursor() as cursor:
+            cursor.execute(ROLE_SUMMARY_QUERIES[role], record_query_params(invoice_date))
+            return {name: EntitySummary(record_count, amount_total, principal_total)
+                    for name, record_count, amount_total, principal_total in cursor.fetchall()}
+
+    def get_role_record_counts(self, role: str, invoice_date) -> Dict[str, int]:
+        """Get {name: record count} for a role on a date, using the same filters as its records query"""
+        return {name: summary.record_count for name, summary in self.get_role_summaries(role, invoice_date).items()}
+
+    def get_entity_changes(self, role: str, since: datetime, invoice_date: date) -> Dict[str, bool]:
+        """Get {name: changed after `since`} for every entity of a role (see changed_entities_query)"""
+        with metrics.stage('db_fetch'), self.conn.cursor() as cursor:
+            cursor.execute(changed_entities_query(role),
+                           {'since': since, 'role': role, 'invoice_date': invoice_date,
+                            **record_query_params(invoice_date)})
+            return {name: bool(changed) for name, changed in cursor.fetchall()}
+
+    def current_timestamp(self) -> datetime:
+        """The database server's current time, so watermarks don't depend on this machine's clock"""
+        with self.conn.cursor() as cursor:
+            cursor.execute("SELECT CURRENT_TIMESTAMP")
+            return cursor.fetchone()[0]
+
+    def get_watermark(self) -> Optional[datetime]:
+        """Start time of the last complete run, or None if none was recorded"""
+        with self.conn.cursor() as cursor:
+            cursor.execute("SELECT setting_value FROM app_settings WHERE setting_key = %s", (WATERMARK_SETTING,))
+            row = cursor.fetchone()
+        return datetime.fromisoformat(row[0]) if row and row[0] else None
+
+    def set_watermark(self, watermark: datetime):
+        """Record the start time of a complete run for the next --since run"""
         with self.conn.cursor() as cursor:
             cursor.execute("""
-                INSERT INTO invoices
-                (business_name, role, invoice_date, file_name, s3_key, s3_url, total_amount, record_count)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (business_name, role, invoice_date)
+                INSERT INTO app_settings (setting_key, setting_value, description, created_at, updated_at)
+                VALUES (%s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                ON CONFLICT (setting_key)
                 DO UPDATE SET
-                    file_name = EXCLUDED.file_name,
-                    s3_key = EXCLUDED.s3_key,
-                    s3_url = EXCLUDED.s3_url,
-                    total_amount = EXCLUDED.total_amount,
-                    record_count = EXCLUDED.record_count,
+                    setting_value = EXCLUDED.setting_value,
                     updated_at = CURRENT_TIMESTAMP
-            """, (business_name, role, invoice_date, file_name, s3_key, s3_url, total_amount, record_count))
-            self.conn.commit()
+            """, (WATERMARK_SETTING, watermark.isoformat(),
+                  'Start time of the last complete invoice generation run; --since runs only '
+                  'regenerate invoices whose records changed after it'))
+        self.conn.commit()
+
+    def get_invoice_fingerprints(self, role: str, invoice_date: date,
+                                 saved_since: datetime = None) -> Dict[str, str]:
+        """
+        Get {business_name: source_fingerprint} for a role's existing invoices on a date
+
+        Args:
+            saved_since: Only invoices inserted or updated at or after this
+                database time (see current_timestamp), e.g. by the current run
+        """
+        query = """
+            SELECT business_name, source_fingerprint
+            FROM invoices
+            WHERE role = %s
+            AND invoice_date = %s
+            AND source_fingerprint IS NOT NULL
+        """
+        params = (role, invoice_date)
+        if saved_since is not None:
+            query += "AND updated_at >= %s"
+            params += (saved_since,)
+        with self.conn.cursor() as cursor:
+            cursor.execute(query, params)
+            return dict(cursor.fetchall())
+
+    def get_invoice_fingerprint(self, role: str, business_name: str, invoice_date: date) -> Optional[str]:
+        """Get one entity's invoice fingerprint on a date, or None if it has no fingerprinted invoice"""
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT source_fingerprint
+                FROM invoices
+                WHERE role = %s
+                AND business_name = %s
+                AND invoice_date = %s
+            """, (role, business_name, invoice_date))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def save_invoice_record(self, business_name: str, role: str, invoice_date: date,
+                           file_name: str, s3_key: str, s3_url: str,
+                           total_amount: float, record_count: int, source_fingerprint: str = None,
+                           line_items: InvoiceLines = None):
+        """Save invoice metadata, and its line items if given, in one transaction"""
+        with metrics.stage('metadata_save'), self._write_lock, self.conn.cursor() as cursor:
+            try:
+                cursor.execute("""
+                    INSERT INTO invoices
+                    (business_name, role, invoice_date, file_name, s3_key, s3_url, total_amount, record_count,
+                     source_fingerprint)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (business_name, role, invoice_date)
+                    DO UPDATE SET
+                        file_name = EXCLUDED.file_name,
+                        s3_key = EXCLUDED.s3_key,
+                        s3_url = EXCLUDED.s3_url,
+                        total_amount = EXCLUDED.total_amount,
+                        record_count = EXCLUDED.record_count,
+                        source_fingerprint = EXCLUDED.source_fingerprint,
+                        updated_at = CURRENT_TIMESTAMP
+                    RETURNING id
+                """, (business_name, role, invoice_date, file_name, s3_key, s3_url, total_amount, record_count,
+                      source_fingerprint))
+                if line_items is not None:
+                    copy_line_items(cursor, [(cursor.fetchone()[0], line_items)])
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+
+class DatabasePool:
+    """
+    Thread-safe pool of connections, each lent out wrapped in a DatabaseManager
+
+    For long-running processes (the invoice daemon) serving requests from
+    several threads: each job checks out a connection instead of opening one.
+    Checkouts block while all `maxconn` connections are in use.
+    """
+
+    def __init__(self, database_url: str, minconn: int = 1, maxconn: int = 4):
+        self.database_url = database_url
+        self._pool = ThreadedConnectionPool(minconn, maxconn, database_url)
+        self._available = threading.BoundedSemaphore(maxconn)
+
+    @contextmanager
+    def manager(self) -> Iterator[DatabaseManager]:
+        """Check out a connection for the duration of the block"""
+        self._available.acquire()
+        try:
+            conn = self._pool.getconn()
+            db = DatabaseManager(self.database_url)
+            db.conn = conn
+            try:
+                yield db
+            finally:
+                # Reads leave a transaction open; end it before the connection is reused,
+                # and drop connections the server has closed
+                try:
+                    conn.rollback()
+                    broken = False
+                except psycopg2.Error:
+                    broken = True
+                self._pool.putconn(conn, close=broken or bool(conn.closed))
+        finally:
+            self._available.release()
+
+    def close(self):
+        """Close every pooled connection"""
+        self._pool.closeall()
+
+
+class InvoiceRecordWriter:
+    """
+    Buffers invoice metadata and upserts it in batches
+
+    Drop-in for DatabaseManager.save_invoice_record: rows are collected in memory
+    and written with one multi-row INSERT ... ON CONFLICT, one COPY of their line
+    items and a single commit per batch instead of one round trip and commit per
+    invoice. Thread-safe. Use as a
+    context manager (or call close()) so buffered rows are flushed on shutdown and
+    on error.
+
+    A buffered invoice isn't saved until its batch commits, so callers that
+    count invoices as saved should do so from on_flush.
+    """
+
+    def __init__(self, db: DatabaseManager, batch_size: int = 100,
+                 on_flush: Callable[[List[Tuple[str, str, date]]], None] = None,
+                 on_error: Callable[[List[Tuple[str, str, date]]], None] = None):
+        """
+        Args:
+            db: Connected DatabaseManager to write through
+            batch_size: Rows per multi-row upsert and commit
+            on_flush: Called with the (business_name, role, invoice_date) keys of
+                each batch after it commits
+            on_error: Called with the keys of a batch that failed to commit and
+                was rolled back. Without it the error is raised to whichever
+                save (or flush) triggered the batch
+        """
+        self.db = db
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.on_error = on_error
+        # (business_name, role, invoice_date) -> (row, line items); a later save for
+        # the same invoice replaces the earlier one, as the upsert would
+        self._buffer = {}
+        self._lock = threading.Lock()
+
+    def save_invoice_record(self, business_name: str, role: str, invoice_date: date,
+                            file_name: str, s3_key: str, s3_url: str,
+                            total_amount: float, record_count: int, source_fingerprint: str = None,
+                            line_items: InvoiceLines = None):
+        """Buffer invoice metadata and line items, flushing once batch_size rows are waiting"""
+        with self._lock:
+            self._buffer[(business_name, role, invoice_date)] = ((
+                business_name, role, invoice_date, file_name, s3_key, s3_url, total_amount, record_count,
+                source_fingerprint
+            ), line_items)
+            if len(self._buffer) >= self.batch_size:
+                self._flush_locked()
+
+    def flush(self):
+        """Write all buffered rows in one transaction"""
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._buffer:
+            return
+
+        buffered = list(self._buffer.values())
+        rows = [row for row, _ in buffered]
+        conn = self.db.conn
+        try:
+            with metrics.stage('metadata_save'), self.db._write_lock, conn.cursor() as cursor:
+                returned = execute_values(cursor, """
+                    INSERT INTO invoices
+                    (business_name, role, invoice_date, file_name, s3_key, s3_url, total_amount, record_count,
+                     source_fingerprint)
+                    VALUES %s
+                    ON CONFLICT (business_name, role, invoice_date)
+                    DO UPDATE SET
+                        file_name = EXCLUDED.file_name,
+                        s3_key = EXCLUDED.s3_key,
+                        s3_url = EXCLUDED.s3_url,
+                        total_amount = EXCLUDED.total_amount,
+                        record_count = EXCLUDED.record_count,
+                        source_fingerprint = EXCLUDED.source_fingerprint,
+                        updated_at = CURRENT_TIMESTAMP
+                    RETURNING id, business_name, role, invoice_date
+                """, rows, page_size=self.batch_size, fetch=True)
+
+                # Line items for the whole batch go in with one COPY, in the same transaction
+                ids = {(name, role, invoice_date): invoice_id for invoice_id, name, role, invoice_date in returned}
+                copy_line_items(cursor, [(ids[row[:3]], lines) for row, lines in buffered if lines is not None])
+                conn.commit()
+        except Exception as e:
+            conn.rollback()
+            # The batch is dropped either way; its keys go to on_error so they aren't lost silently
+            self._buffer.clear()
+            names = ', '.join(f"{row[1]}:{row[0]}" for row in rows)
+            logger.error(f"Failed to save {len(rows)} invoice records ({e}): {names}")
+            if self.on_error is None:
+                raise
+            self.on_error([(row[0], row[1], row[2]) for row in rows])
+            return
+
+        self._buffer.clear()
+        logger.info(f"Saved {len(rows)} invoice records")
+        if self.on_flush:
+            self.on_flush([(row[0], row[1], row[2]) for row in rows])
+
+    def close(self):
+        """Flush any remaining rows"""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,57 @@
+"""
+Content fingerprints for incremental invoice regeneration
+"""
+import hashlib
+import json
+import os
+from datetime import datetime
+from typing import List
+
+from .records import Record
+
+
+def template_version(template_dir: str) -> str:
+    """
+    Hash every file in the template directory
+
+    Any change to the template, stylesheet or assets changes the version, so
+    invoices rendered from an older template are regenerated.
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(template_dir):
+        dirs.sort()
+        for file_name in sorted(files):
+            path = os.path.join(root, file_name)
+            digest.update(os.path.relpath(path, template_dir).encode('utf-8'))
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def invoice_fingerprint(role: str, business_name: str, records: List[Record], invoice_date: datetime,
+                        template_version: str, logo_url: str = None) -> str:
+    """
+    Fingerprint everything an invoice PDF is rendered from
+
+    Args:
+        role: 'client', 'investor', or 'capinvestor'
+        business_name: Name of business/investor
+        records: The entity's records, in render order
+        invoice_date: Date for the invoice
+        template_version: Version from template_version()
+        logo_url: Optional URL to logo image
+
+    Returns:
+        str: Hex SHA-256 digest
+    """
+    payload = {
+        'role': role,
+        'business_name': business_name,
+        'invoice_date': invoice_date.strftime('%Y-%m-%d'),
+        'template_version': template_version,
+        'logo_url': logo_url,
+        # Records only carry the columns an invoice is rendered from
+        'records': [record._asdict() for record in records]
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
@@ -0,0 +1,119 @@
+"""
+Run journal for resuming interrupted invoice runs
+
+Also keeps each invoice's last render time, which the scheduler's cost model
+predicts the next run's render times from.
+"""
+import sqlite3
+import threading
+from datetime import date
+from typing import Dict, Set, Tuple
+
+# Progress states, in order
+RENDERED = 'rendered'
+UPLOADED = 'uploaded'
+RECORDED = 'recorded'
+
+
+class RunJournal:
+    """
+    Records how far each (role, name, invoice_date) invoice got, and how long
+    each entity's invoice last took to render
+
+    Backed by a local SQLite file so a crashed run can be resumed with only the
+    unfinished entities. Safe to share between threads, and between worker
+    processes opening the same path.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS invoice_progress (
+                role TEXT NOT NULL,
+                name TEXT NOT NULL,
+                invoice_date TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (role, name, invoice_date)
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS render_costs (
+                role TEXT NOT NULL,
+                name TEXT NOT NULL,
+                record_count INTEGER NOT NULL,
+                seconds REAL NOT NULL,
+                updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (role, name)
+            )
+        """)
+        self.conn.commit()
+
+    def mark(self, role: str, name: str, invoice_date: date, state: str):
+        """Record that an invoice reached `state`"""
+        with self._lock:
+            self._mark(role, name, invoice_date, state)
+            self.conn.commit()
+
+    def mark_rendered(self, role: str, name: str, invoice_date: date, record_count: int, seconds: float = None):
+        """
+        Record that an invoice was rendered and, when timed, its render time
+
+        A render of an unchanged record count is averaged with the time kept,
+        so one slow render (a process's first, which loads WeasyPrint) fades
+        out over the next runs instead of sticking.
+        """
+        with self._lock:
+            self._mark(role, name, invoice_date, RENDERED)
+            if seconds is not None:
+                self.conn.execute("""
+                    INSERT INTO render_costs (role, name, record_count, seconds)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (role, name)
+                    DO UPDATE SET
+                        seconds = CASE WHEN render_costs.record_count = excluded.record_count
+                                       THEN (render_costs.seconds + excluded.seconds) / 2
+                                       ELSE excluded.seconds END,
+                        record_count = excluded.record_count,
+                        updated_at = CURRENT_TIMESTAMP
+                """, (role, name, record_count, seconds))
+            self.conn.commit()
+
+    def _mark(self, role: str, name: str, invoice_date: date, state: str):
+        self.conn.execute("""
+            INSERT INTO invoice_progress (role, name, invoice_date, state)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (role, name, invoice_date)
+            DO UPDATE SET state = excluded.state, updated_at = CURRENT_TIMESTAMP
+        """, (role, name, invoice_date.isoformat(), state))
+
+    def completed(self, role: str, invoice_date: date) -> Set[str]:
+        """Names whose invoice for `invoice_date` was fully recorded"""
+        with self._lock:
+            rows = self.conn.execute("""
+                SELECT name
+                FROM invoice_progress
+                WHERE role = ?
+                AND invoice_date = ?
+                AND state = ?
+            """, (role, invoice_date.isoformat(), RECORDED)).fetchall()
+        return {row[0] for row in rows}
+
+    def render_costs(self, role: str) -> Dict[str, Tuple[int, float]]:
+        """{name: (record count, render seconds)} from each entity's last timed render"""
+        with self._lock:
+            rows = self.conn.execute("""
+                SELECT name, record_count, seconds
+                FROM render_costs
+                WHERE role = ?
+            """, (role,)).fetchall()
+        return {name: (record_count, seconds) for name, record_count, seconds in rows}
+
+    def close(self):
+        """Close the journal"""
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,225 @@
+"""
+Per-stage timing and run metrics for invoice generation
+"""
+import os
+import sys
+import json
+import time
+import resource
+import threading
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from typing import Dict, List
+
+# Stages timed by the invoice_generator modules, in pipeline order
+STAGES = ('db_fetch', 'prorate', 'format_records', 'jinja_render', 'layout', 'write_pdf', 'optimize_pdf', 's3_upload',
+          'metadata_save')
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def _maxrss_bytes(who: int) -> int:
+    """Peak resident set size from getrusage (KiB on Linux, bytes on macOS)"""
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class RunMetrics:
+    """
+    Thread-safe collector of stage timings, value distributions and counters
+
+    Worker processes collect into their own instance and ship drain() snapshots
+    back to the parent, which merge()s them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Context managers entered around every stage, e.g. by --profile; none by default
+        self.stage_hooks = []
+        self.reset()
+
+    def reset(self):
+        """Discard everything collected so far"""
+        with self._lock:
+            self.timings = defaultdict(list)
+            self.distributions = defaultdict(list)
+            self.counters = defaultdict(float)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time the wrapped block as one sample of stage `name`"""
+        if self.stage_hooks:
+            with self._hooked_stage(name):
+                yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    @contextmanager
+    def _hooked_stage(self, name: str):
+        # Hooks wrap the timing, so their own cost isn't counted in the stage
+        with ExitStack() as hooks:
+            for hook in self.stage_hooks:
+                hooks.enter_context(hook(name))
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        """Add a timing sample for a stage"""
+        with self._lock:
+            self.timings[name].append(seconds)
+
+    def observe(self, name: str, value: float):
+        """Add a sample to a value distribution (e.g. PDF page counts)"""
+        with self._lock:
+            self.distributions[name].append(value)
+
+    def increment(self, name: str, value: float = 1):
+        """Add to a counter"""
+        with self._lock:
+            self.counters[name] += value
+
+    def drain(self) -> Dict:
+        """Return everything collected so far and reset"""
+        with self._lock:
+            snapshot = {
+                'timings': dict(self.timings),
+                'distributions': dict(self.distributions),
+                'counters': dict(self.counters)
+            }
+            self.timings = defaultdict(list)
+            self.distributions = defaultdict(list)
+            self.counters = defaultdict(float)
+        return snapshot
+
+    def merge(self, snapshot: Dict):
+        """Fold in a snapshot from drain() (e.g. from a worker process)"""
+        with self._lock:
+            for name, values in snapshot.get('timings', {}).items():
+                self.timings[name].extend(values)
+            for name, values in snapshot.get('distributions', {}).items():
+                self.distributions[name].extend(values)
+            for name, value in snapshot.get('counters', {}).items():
+                self.counters[name] += value
+
+    def dump(self, path: str):
+        """Drain into a JSON file, for a process that can't return its samples directly"""
+        with open(path, 'w') as f:
+            json.dump(self.drain(), f)
+
+    def merge_file(self, path: str):
+        """Merge a file written by dump()"""
+        with open(path) as f:
+            self.merge(json.load(f))
+
+    def _summarize(self, values: List[float]) -> Dict:
+        ordered = sorted(values)
+        return {
+            'count': len(ordered),
+            'sum': sum(ordered),
+            'p50': percentile(ordered, 0.50),
+            'p95': percentile(ordered, 0.95),
+            'max': ordered[-1] if ordered else 0.0
+        }
+
+    def summary(self) -> Dict:
+        """p50/p95/max per stage and distribution, counters and peak RSS"""
+        with self._lock:
+            stages = {name: self._summarize(values) for name, values in self.timings.items()}
+            distributions = {name: self._summarize(values) for name, values in self.distributions.items()}
+            counters = dict(self.counters)
+        return {
+            'stages': stages,
+            'distributions': distributions,
+            'counters': counters,
+            'peak_rss_bytes': _maxrss_bytes(resource.RUSAGE_SELF),
+            'peak_children_rss_bytes': _maxrss_bytes(resource.RUSAGE_CHILDREN)
+        }
+
+    def write_json_report(self, path: str, extra: Dict = None) -> Dict:
+        """Write the summary plus `extra` run details as JSON and return it"""
+        report = dict(extra or {})
+        report.update(self.summary())
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True, default=str)
+        return report
+
+    def write_prometheus(self, path: str, stats: Dict = None):
+        """
+        Write the summary in Prometheus text format for node_exporter's textfile collector
+
+        The file is written to a temporary name and renamed so the collector
+        never reads a partial file.
+        """
+        summary = self.summary()
+        lines = [
+            '# HELP invoice_stage_seconds Time spent per invoice in each generation stage',
+            '# TYPE invoice_stage_seconds summary'
+        ]
+        for name, values in sorted(summary['stages'].items()):
+            lines.append(f'invoice_stage_seconds{{stage="{name}",quantile="0.5"}} {values["p50"]:.6f}')
+            lines.append(f'invoice_stage_seconds{{stage="{name}",quantile="0.95"}} {values["p95"]:.6f}')
+            lines.append(f'invoice_stage_seconds_sum{{stage="{name}"}} {values["sum"]:.6f}')
+            lines.append(f'invoice_stage_seconds_count{{stage="{name}"}} {values["count"]}')
+        lines += [
+            '# HELP invoice_stage_max_seconds Slowest single sample per stage',
+            '# TYPE invoice_stage_max_seconds gauge'
+        ]
+        for name, values in sorted(summary['stages'].items()):
+            lines.append(f'invoice_stage_max_seconds{{stage="{name}"}} {values["max"]:.6f}')
+
+        for name, values in sorted(summary['distributions'].items()):
+            metric = f'invoice_{name}'
+            lines += [f'# HELP {metric} Per-invoice {name.replace("_", " ")}', f'# TYPE {metric} summary']
+            lines.append(f'{metric}{{quantile="0.5"}} {values["p50"]}')
+            lines.append(f'{metric}{{quantile="0.95"}} {values["p95"]}')
+            lines.append(f'{metric}_sum {values["sum"]}')
+            lines.append(f'{metric}_count {values["count"]}')
+
+        for name, value in sorted(summary['counters'].items()):
+            metric = f'invoice_{name}_total'
+            lines += [f'# HELP {metric} Run total of {name.replace("_", " ")}', f'# TYPE {metric} counter']
+            lines.append(f'{metric} {value:g}')
+
+        lines += [
+            '# HELP invoice_peak_rss_bytes Peak resident memory of the run',
+            '# TYPE invoice_peak_rss_bytes gauge',
+            f'invoice_peak_rss_bytes{{process="main"}} {summary["peak_rss_bytes"]}',
+            f'invoice_peak_rss_bytes{{process="workers"}} {summary["peak_children_rss_bytes"]}'
+        ]
+
+        if stats:
+            lines += [
+                '# HELP invoice_run_invoices Invoices per role and outcome in the last run',
+                '# TYPE invoice_run_invoices gauge'
+            ]
+            for role, counts in sorted(stats.items()):
+                for status, count in sorted(counts.items()):
+                    lines.append(f'invoice_run_invoices{{role="{role}",status="{status}"}} {count}')
+
+        lines += [
+            '# HELP invoice_run_completed_timestamp_seconds When the last run finished',
+            '# TYPE invoice_run_completed_timestamp_seconds gauge',
+            f'invoice_run_completed_timestamp_seconds {time.time():.0f}'
+        ]
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+
+# Process-wide collector used by the timing hooks
+metrics = RunMetrics()
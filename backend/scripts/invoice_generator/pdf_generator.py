@@ -1,55 +1,188 @@
 """
 PDF generation from HTML template
+
+WeasyPrint is imported on the first render rather than at import time, so
+runs that end up rendering nothing (and tools that only need the
+formatting helpers) don't pay for loading it. WeasyPrint is the reference
+render engine; the ReportLab engine (canvas_engine) draws the same layout
+directly, from the same template context.
 """
-from weasyprint import HTML, CSS
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from datetime import datetime
-from typing import List, Dict
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from typing import List, Dict, Tuple
 import os
+import time
 import logging
 
+from .fingerprint import template_version
+from .metrics import metrics
+from .url_fetcher import CachingURLFetcher
+from .pdf_optimizer import PDFOptimizer, LOGO_MAX_HEIGHT_PX, RENDER_OPTIONS
+from .proration import InvoiceLines, prorate
+from .records import Record
+
 logger = logging.getLogger(__name__)
 
+# Rows on an invoice's first and later pages (see split_records_into_pages)
+FIRST_PAGE_ROWS = 12
+SUBSEQUENT_PAGE_ROWS = 20
+
+CENT = Decimal('0.01')
+
+# Render engines PDFGenerator can use; the first is the reference
+ENGINES = ('weasyprint', 'reportlab')
+
+
+def _to_decimal(value) -> Decimal:
+    """Exact Decimal for a numeric value; raises for anything non-numeric"""
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        # Via the shortest repr, so 0.1 stays 0.1 rather than its binary expansion
+        return Decimal(repr(value))
+    if isinstance(value, int):
+        return Decimal(value)
+    return Decimal(str(value).strip())
+
+
+def format_currency(value) -> str:
+    """Format a number as dollars, rounding half-up to cents without going through float"""
+    try:
+        amount = _to_decimal(value).quantize(CENT, rounding=ROUND_HALF_UP)
+    except (InvalidOperation, ValueError, TypeError):
+        return "$0.00"
+    return f"${amount:,.2f}"
+
+
+def format_percent(value) -> str:
+    """Format a number as a percentage"""
+    try:
+        rate = _to_decimal(value).quantize(CENT, rounding=ROUND_HALF_UP)
+    except (InvalidOperation, ValueError, TypeError):
+        return "0.00%"
+    return f"{rate:.2f}%"
+
+
+def format_date(value) -> str:
+    """Format a datetime (or YYYY-MM-DD string) as MM/DD/YYYY"""
+    if not value:
+        return "N/A"
+    if isinstance(value, str):
+        try:
+            value = datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            return value
+    if isinstance(value, datetime):
+        return value.strftime('%m/%d/%Y')
+    return str(value)
+
+
+def render_version(template_dir: str, engine: str = ENGINES[0], optimize: bool = False) -> str:
+    """
+    Version of the PDFs a PDFGenerator with these settings renders, for invoice fingerprints
+
+    The templates' version (fingerprint.template_version), suffixed so that
+    invoices drawn by another engine, or before --optimize-pdf was turned on,
+    are regenerated when those settings change.
+    """
+    version = template_version(template_dir)
+    if engine != ENGINES[0]:
+        version = f'{version}-{engine}'
+    if optimize:
+        version = f'{version}-optimized'
+    return version
+
 
 class PDFGenerator:
-    def __init__(self, template_dir: str):
+    def __init__(self, template_dir: str, asset_cache_dir: str = None, bytecode_cache_dir: str = None,
+                 optimize: bool = False, engine: str = 'weasyprint'):
+        """
+        Args:
+            template_dir: Directory holding invoice_template.html and invoice.css
+            asset_cache_dir: Optional on-disk cache for fetched resources such as
+                the logo, shared across runs
+            bytecode_cache_dir: Directory for compiled templates, shared by every
+                process (default: a per-user directory under the system temp dir)
+            optimize: Shrink PDFs before they are returned (see pdf_optimizer)
+            engine: 'weasyprint' (lay out the HTML template) or 'reportlab'
+                (draw the same layout with canvas_engine)
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown render engine '{engine}', expected one of {', '.join(ENGINES)}")
         self.template_dir = template_dir
-        self.env = Environment(loader=FileSystemLoader(template_dir))
+        if bytecode_cache_dir:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+        # Templates don't change during a run; skip the per-render freshness check.
+        # Compiled bytecode is cached on disk (keyed by the source's checksum), so
+        # new worker processes load the template without compiling it.
+        self.env = Environment(loader=FileSystemLoader(template_dir), auto_reload=False,
+                               bytecode_cache=FileSystemBytecodeCache(bytecode_cache_dir))
+        self.env.filters['currency'] = format_currency
+        self.env.filters['percent'] = format_percent
+        self.env.filters['date'] = format_date
+        self.template = self.env.get_template('invoice_template.html')
+        # Batch mode renders each invoice's pages with the partial, inside one shared document
+        self.pages_template = self.env.get_template('invoice_pages.html')
+        self.batch_template = self.env.get_template('invoice_batch.html')
+        self.template_version = render_version(template_dir, engine, optimize)
+
+        # Shared by every invoice: resources are fetched once and the stylesheet
+        # is parsed once (on the first render), so each invoice only pays for its
+        # own layout
+        self.url_fetcher = CachingURLFetcher(asset_cache_dir,
+                                             image_max_height=LOGO_MAX_HEIGHT_PX if optimize else None)
+        self.render_options = RENDER_OPTIONS if optimize else {}
+        self.optimizer = PDFOptimizer.create() if optimize else None
+        self.font_config = None
+        self.stylesheet = None
+        self.engine = engine
+        self.canvas_engine = None
+        if engine == 'reportlab':
+            from .canvas_engine import CanvasEngine
+            self.canvas_engine = CanvasEngine(self.url_fetcher)
+
+    def warm_up(self):
+        """
+        Load WeasyPrint, parse the stylesheet and discover fonts now instead of
+        on the first invoice, for long-lived processes that serve single renders
+        """
+        if self.canvas_engine is not None:
+            # ReportLab has nothing to set up beyond its import
+            return
+        self._layout('<html><body><div class="invoice-page">&nbsp;</div></body></html>').write_pdf()
+
+    def _layout(self, html_content: str):
+        """Lay out an HTML document with the shared stylesheet and fonts"""
+        from weasyprint import HTML, CSS
+        from weasyprint.text.fonts import FontConfiguration
+
+        if self.stylesheet is None:
+            self.font_config = FontConfiguration()
+            self.stylesheet = CSS(filename=os.path.join(self.template_dir, 'invoice.css'),
+                                  url_fetcher=self.url_fetcher, font_config=self.font_config)
+        html = HTML(string=html_content, url_fetcher=self.url_fetcher)
+        return html.render(stylesheets=[self.stylesheet], font_config=self.font_config, **self.render_options)
 
     def format_currency(self, value) -> str:
         """Format number as currency"""
-        try:
-            return f"${float(value):,.2f}"
-        except (ValueError, TypeError):
-            return "$0.00"
+        return format_currency(value)
 
     def format_percent(self, value) -> str:
         """Format number as percentage"""
-        try:
-            return f"{float(value):.2f}%"
-        except (ValueError, TypeError):
-            return "0.00%"
+        return format_percent(value)
 
     def format_date(self, value) -> str:
         """Format date"""
-        if not value:
-            return "N/A"
-        if isinstance(value, str):
-            try:
-                value = datetime.strptime(value, '%Y-%m-%d')
-            except:
-                return value
-        if isinstance(value, datetime):
-            return value.strftime('%m/%d/%Y')
-        return str(value)
-
-    def split_records_into_pages(self, records: List[Dict], first_page_rows: int = 12,
-                                 subsequent_rows: int = 20) -> List[Dict]:
+        return format_date(value)
+
+    def split_records_into_pages(self, records: List[Dict], first_page_rows: int = FIRST_PAGE_ROWS,
+                                 subsequent_rows: int = SUBSEQUENT_PAGE_ROWS) -> List[Dict]:
         """
         Split records into pages
 
         Args:
-            records: List of record dictionaries
+            records: Rows to paginate
             first_page_rows: Number of rows on first page
             subsequent_rows: Number of rows on subsequent pages
 
@@ -72,8 +205,54 @@ class PDFGenerator:
 
         return pages
 
-    def generate_invoice_pdf(self, business_name: str, role: str, records: List[Dict],
-                           invoice_date: datetime, logo_url: str = None) -> bytes:
+    def batchable(self, records: List[Record]) -> bool:
+        """
+        Whether an invoice is small enough to share a batch document (see generate_invoice_pdfs)
+
+        Its rows fit the template's first page, though the summary and footer can
+        still flow onto a second; how many pages it takes is only known once
+        the batch is laid out.
+        """
+        return len(records) <= FIRST_PAGE_ROWS
+
+    def _invoice_context(self, business_name: str, role: str, records: List[Record], invoice_date: datetime,
+                         logo_url: str = None, lines: InvoiceLines = None) -> Dict:
+        """Build the template context for one invoice"""
+        if lines is None:
+            lines = prorate(role, business_name, records, invoice_date)
+
+        with metrics.stage('format_records'):
+            # Totals come from the proration engine
+            total_invested = 0
+            monthly_interest = 0
+            total_interest_due = 0
+
+            if role == 'client':
+                total_interest_due = lines.total
+            else:
+                total_invested = lines.principal
+                monthly_interest = lines.total
+
+            # Rows are (record, invoiced amount, is_prorated, days_in_period); the
+            # template formats values through its filters, so records aren't copied
+            rows = list(zip(records, lines.prorated_amounts, lines.is_prorated, lines.days_in_period))
+
+            # Split into pages
+            pages = self.split_records_into_pages(rows)
+
+        return {
+            'business_name': business_name,
+            'role': role,
+            'invoice_date': invoice_date.strftime('%B %d, %Y'),
+            'total_invested': total_invested,
+            'monthly_interest': monthly_interest,
+            'total_interest_due': total_interest_due,
+            'pages': pages,
+            'logo_url': logo_url
+        }
+
+    def generate_invoice_pdf(self, business_name: str, role: str, records: List[Record],
+                           invoice_date: datetime, logo_url: str = None, lines: InvoiceLines = None) -> bytes:
         """
         Generate invoice PDF
 
@@ -83,66 +262,107 @@ class PDFGenerator:
             records: List of loan/investment records
             invoice_date: Date for the invoice
             logo_url: Optional URL to logo image
+            lines: Line items and totals from the proration engine, computed here if not given
 
         Returns:
             bytes: PDF content
         """
-        # Calculate totals
-        total_invested = 0
-        monthly_interest = 0
-        total_interest_due = 0
-
-        if role == 'client':
-            total_interest_due = sum(float(r.get('interest_payment', 0) or 0) for r in records)
-        elif role == 'investor':
-            total_invested = sum(float(r.get('loan_amount', 0) or 0) for r in records)
-            monthly_interest = sum(float(r.get('capital_pay', 0) or 0) for r in records)
-        elif role == 'capinvestor':
-            total_invested = sum(float(r.get('loan_amount', 0) or 0) for r in records)
-            monthly_interest = sum(float(r.get('payment', 0) or 0) for r in records)
-
-        # Format records for template
-        formatted_records = []
-        for record in records:
-            formatted = dict(record)
-            # Format currency and percentage fields
-            if 'loan_amount' in formatted:
-                formatted['loan_amount'] = self.format_currency(formatted['loan_amount'])
-            if 'interest_rate' in formatted:
-                formatted['interest_rate'] = self.format_percent(formatted['interest_rate'])
-            if 'interest_payment' in formatted:
-                formatted['interest_payment'] = self.format_currency(formatted['interest_payment'])
-            if 'payment' in formatted:
-                formatted['payment'] = self.format_currency(formatted['payment'])
-            if 'capital_pay' in formatted:
-                formatted['capital_pay'] = self.format_currency(formatted['capital_pay'])
-            if 'fund_date' in formatted:
-                formatted['fund_date'] = self.format_date(formatted['fund_date'])
-
-            formatted_records.append(formatted)
-
-        # Split into pages
-        pages = self.split_records_into_pages(formatted_records)
-
-        # Prepare template context
-        context = {
-            'business_name': business_name,
-            'role': role,
-            'invoice_date': invoice_date.strftime('%B %d, %Y'),
-            'total_invested': self.format_currency(total_invested),
-            'monthly_interest': self.format_currency(monthly_interest),
-            'total_interest_due': self.format_currency(total_interest_due),
-            'pages': pages,
-            'logo_url': logo_url
-        }
+        return self._render_pdf(business_name, role, records, invoice_date, logo_url, lines)[0]
+
+    def _render_pdf(self, business_name: str, role: str, records: List[Record], invoice_date: datetime,
+                    logo_url: str = None, lines: InvoiceLines = None) -> Tuple[bytes, int]:
+        """generate_invoice_pdf, returning the PDF's page count with its content"""
+        context = self._invoice_context(business_name, role, records, invoice_date, logo_url, lines)
+
+        if self.canvas_engine is not None:
+            with metrics.stage('write_pdf'):
+                pdf, page_count = self.canvas_engine.render(context)
+        else:
+            # Render template
+            with metrics.stage('jinja_render'):
+                html_content = self.template.render(**context)
+
+            # Lay out first, so the page count can be recorded
+            with metrics.stage('layout'):
+                document = self._layout(html_content)
+            with metrics.stage('write_pdf'):
+                pdf = document.write_pdf()
+            page_count = len(document.pages)
+        if self.optimizer:
+            pdf = self.optimizer.optimize(pdf)
+        metrics.observe('pdf_pages', page_count)
+        metrics.observe('pdf_bytes', len(pdf))
+
+        logger.info(f"Generated PDF for {business_name} ({role}): {len(records)} records, {page_count} pages")
+
+        return pdf, page_count
+
+    def generate_invoice_pdfs(self, invoices: List[Tuple[str, str, List[Record], InvoiceLines]],
+                              invoice_date: datetime, logo_url: str = None) -> List[Tuple[bytes, int]]:
+        """
+        Generate several invoice PDFs from one WeasyPrint document
+
+        Fonts, the stylesheet and the shared header are set up once for the whole
+        batch rather than per invoice, which dominates for small invoices. Each
+        invoice still starts on a new page (`.invoice-page` breaks), and its first
+        page carries an anchor, so the laid-out pages are split back into one PDF
+        per invoice at the next invoice's anchor: an invoice gets every page it
+        laid out, however many that is. If any anchor is missing, the invoices
+        are rendered one by one, as they always are with the ReportLab engine,
+        which has no per-document setup to share.
+
+        Args:
+            invoices: (business_name, role, records, lines) per invoice; lines may be None
+            invoice_date: Date for the invoices
+            logo_url: Optional URL to logo image
+
+        Returns:
+            List[Tuple[bytes, int]]: PDF content and page count, in the order of `invoices`
+        """
+        if self.canvas_engine is not None:
+            return [self._render_pdf(name, role, records, invoice_date, logo_url, lines)
+                    for name, role, records, lines in invoices]
+
+        contexts = [self._invoice_context(name, role, records, invoice_date, logo_url, lines)
+                    for name, role, records, lines in invoices]
 
-        # Render template
-        template = self.env.get_template('invoice_template.html')
-        html_content = template.render(**context)
+        bodies = []
+        for index, context in enumerate(contexts):
+            with metrics.stage('jinja_render'):
+                bodies.append(self.pages_template.render(anchor=f'invoice-{index}', **context))
+        html_content = self.batch_template.render(bodies=bodies)
 
-        # Generate PDF
-        pdf = HTML(string=html_content).write_pdf()
+        # Lay out the whole batch once
+        layout_start = time.perf_counter()
+        document = self._layout(html_content)
+        layout_seconds = time.perf_counter() - layout_start
 
-        logger.info(f"Generated PDF for {business_name} ({role}): {len(records)} records, {len(pages)} pages")
+        first_pages = {}
+        for page_number, page in enumerate(document.pages):
+            for anchor in page.anchors:
+                first_pages.setdefault(anchor, page_number)
+        starts = [first_pages.get(f'invoice-{index}') for index in range(len(invoices))]
+        if None in starts or starts != sorted(starts):
+            logger.warning(f"Could not split a batch of {len(invoices)} invoices, rendering them one by one")
+            metrics.record('layout', layout_seconds)
+            return [self._render_pdf(name, role, records, invoice_date, logo_url, lines)
+                    for name, role, records, lines in invoices]
 
-        return pdf
+        pdfs = []
+        ends = starts[1:] + [len(document.pages)]
+        for (name, role, records, _), start, end in zip(invoices, starts, ends):
+            # The layout's time is shared by the pages each invoice laid out
+            metrics.record('layout', layout_seconds * (end - start) / len(document.pages))
+            write_start = time.perf_counter()
+            # Copies share the batch's metadata; give each PDF its own title
+            document.metadata.title = f"Invoice - {name}"
+            pdf = document.copy(document.pages[start:end]).write_pdf()
+            metrics.record('write_pdf', time.perf_counter() - write_start)
+            if self.optimizer:
+                pdf = self.optimizer.optimize(pdf)
+            metrics.observe('pdf_pages', end - start)
+            metrics.observe('pdf_bytes', len(pdf))
+            pdfs.append((pdf, end - start))
+            logger.info(f"Generated PDF for {name} ({role}): {len(records)} records, "
+                        f"{end - start} pages (batch of {len(invoices)})")
+        return pdfs
@@ -0,0 +1,119 @@
+"""
+Shrinking invoice PDFs before upload (--optimize-pdf)
+
+Three steps, none of which changes how an invoice looks:
+- the logo is downscaled to its printed size and recompressed once, when the
+  URL fetcher first fetches it, so every invoice embeds the small copy
+- WeasyPrint lays the document out with optimized images, no denser than
+  they print at 300 dpi (fonts are always subset to the glyphs used)
+- if pikepdf is installed, each PDF is rewritten with recompressed streams
+  packed into object streams, and the bytes saved are recorded per invoice
+"""
+import io
+import logging
+from typing import Dict, Optional
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# .invoice-logo-image is 48 CSS px (half an inch) tall; 150 px prints it at 300 dpi
+LOGO_MAX_HEIGHT_PX = 150
+
+# HTML.render options. WeasyPrint reads its image options while it lays the
+# document out, not in write_pdf: optimize images, re-encode JPEGs at the
+# quality downscale_image uses and cap images at their 300 dpi print size
+RENDER_OPTIONS = {
+    'optimize_images': True,
+    'jpeg_quality': 90,
+    'dpi': 300
+}
+
+RASTER_MIME_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
+
+
+def downscale_image(resource: Dict, max_height: int) -> Dict:
+    """
+    Downscale and recompress a fetched raster image no taller than `max_height` pixels
+
+    Args:
+        resource: url_fetcher result with the body in 'string'
+
+    Returns:
+        Dict: A new resource if that made it smaller, otherwise `resource` unchanged
+    """
+    if resource.get('mime_type') not in RASTER_MIME_TYPES:
+        return resource
+    # Pillow is a WeasyPrint dependency
+    from PIL import Image
+
+    original = resource['string']
+    try:
+        image = Image.open(io.BytesIO(original))
+        image.load()
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read image for downscaling, embedding it as is: {e}")
+        return resource
+
+    source_format = image.format
+    width, height = image.size
+    if height > max_height:
+        image = image.resize((max(1, round(width * max_height / height)), max_height), Image.LANCZOS)
+
+    output = io.BytesIO()
+    if source_format == 'JPEG':
+        image.save(output, format='JPEG', quality=90, optimize=True)
+        mime_type = 'image/jpeg'
+    else:
+        image.save(output, format='PNG', optimize=True)
+        mime_type = 'image/png'
+    optimized = output.getvalue()
+
+    if len(optimized) >= len(original):
+        return resource
+    logger.info(f"Downscaled image {width}x{height} -> {image.size[0]}x{image.size[1]}, "
+                f"{len(original)} -> {len(optimized)} bytes")
+    metrics.increment('image_bytes_saved', len(original) - len(optimized))
+    return {**resource, 'string': optimized, 'mime_type': mime_type}
+
+
+class PDFOptimizer:
+    """Rewrites rendered PDFs with recompressed streams and object streams (needs pikepdf)"""
+
+    def __init__(self):
+        import pikepdf
+        self._pikepdf = pikepdf
+
+    @classmethod
+    def create(cls) -> Optional['PDFOptimizer']:
+        """An optimizer, or None (logged) when pikepdf isn't installed"""
+        try:
+            return cls()
+        except ImportError:
+            logger.info("pikepdf is not installed, skipping PDF post-processing "
+                        "(pip3 install -r requirements-optimize.txt)")
+            return None
+
+    def optimize(self, pdf: bytes) -> bytes:
+        """
+        Return the smaller of `pdf` and its rewritten copy
+
+        Records the bytes saved in the pdf_bytes_saved distribution. Anything
+        pikepdf can't read is passed through unchanged.
+        """
+        pikepdf = self._pikepdf
+        with metrics.stage('optimize_pdf'):
+            try:
+                with pikepdf.open(io.BytesIO(pdf)) as document:
+                    output = io.BytesIO()
+                    document.save(output, compress_streams=True, recompress_flate=True,
+                                  object_stream_mode=pikepdf.ObjectStreamMode.generate)
+                optimized = output.getvalue()
+            except pikepdf.PdfError as e:
+                logger.warning(f"Could not post-process PDF, uploading it as rendered: {e}")
+                optimized = pdf
+        if len(optimized) >= len(pdf):
+            optimized = pdf
+        metrics.observe('pdf_bytes_saved', len(pdf) - len(optimized))
+        metrics.increment('bytes_saved', len(pdf) - len(optimized))
+        return optimized
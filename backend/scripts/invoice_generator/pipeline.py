@@ -0,0 +1,109 @@
+"""
+Render -> store pipeline for streaming invoice runs
+"""
+import queue
+import threading
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+from typing import Callable
+
+from .proration import InvoiceLines
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the render stage's output
+_DONE = object()
+
+
+@dataclass
+class RenderedInvoice:
+    """A rendered invoice waiting to be uploaded and recorded"""
+    role: str
+    business_name: str
+    invoice_date: datetime
+    file_name: str
+    pdf_content: bytes
+    total_amount: Decimal
+    record_count: int
+    source_fingerprint: str = None
+    line_items: InvoiceLines = None
+    # Seconds spent rendering the PDF, for the scheduler's cost history
+    render_seconds: float = None
+
+
+class InvoicePipeline:
+    """
+    Hands rendered invoices to a pool of background store threads (upload + metadata save)
+
+    The queue between the stages is bounded, so at most `max_pending` rendered
+    PDFs are held in memory; submit() blocks the renderer until the store stage
+    catches up. With no store threads, submit() stores each invoice itself.
+    """
+
+    def __init__(self, store: Callable[[RenderedInvoice], None],
+                 on_result: Callable[[RenderedInvoice, bool], None] = None,
+                 max_pending: int = 4, workers: int = 1):
+        """
+        Args:
+            store: Uploads and records one invoice, raising on failure. Must be
+                thread-safe when workers > 1
+            on_result: Called with (invoice, succeeded) after each store attempt
+            max_pending: Maximum number of rendered invoices waiting to be stored
+            workers: Number of store threads; 0 stores on the submitting thread
+        """
+        self.store = store
+        self.on_result = on_result
+        self.queue = queue.Queue(maxsize=max_pending)
+        self._result_lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._run, name=f'invoice-store-{i}', daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        """Start the store threads"""
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def submit(self, invoice: RenderedInvoice):
+        """Queue a rendered invoice, blocking while the queue is full"""
+        if not self._threads:
+            self._store(invoice)
+            return
+        self.queue.put(invoice)
+
+    def close(self):
+        """Flush: wait for every queued invoice to be stored, then stop the threads"""
+        for _ in self._threads:
+            self.queue.put(_DONE)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        while True:
+            invoice = self.queue.get()
+            if invoice is _DONE:
+                break
+            self._store(invoice)
+
+    def _store(self, invoice: RenderedInvoice):
+        try:
+            self.store(invoice)
+            ok = True
+        except Exception as e:
+            logger.error(f"✗ Failed to store {invoice.role} invoice for {invoice.business_name}: {str(e)}",
+                         exc_info=True)
+            ok = False
+
+        if self.on_result:
+            with self._result_lock:
+                self.on_result(invoice, ok)
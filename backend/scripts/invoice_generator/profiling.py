@@ -0,0 +1,337 @@
+"""
+Profiling for generate_invoices.py --profile
+
+Captures where a run (or selected entities' renders) spends CPU time and
+which lines allocate memory in each stage, and writes both to a directory:
+
+    cpu-<label>.folded      sampled stacks, one "frame;frame;... count" line
+                            per stack (flamegraph.pl, speedscope, inferno)
+    cpu-<label>.prof        cProfile stats with --profile-mode cprofile
+                            (pstats, snakeviz, flameprof), plus a .txt summary
+    allocations-<label>.txt top allocating lines per render stage, from
+                            tracemalloc, traced only while the stage runs
+
+The label is the process ('main', 'worker-<pid>') for a whole-run profile, or
+the role and entity name with --profile-entity. Allocation snapshots hook into
+metrics.stage, so each render stage (jinja_render, layout, write_pdf, ...) is
+reported separately. Without --profile nothing is hooked, and a render only
+checks that no profiler is set.
+
+tracemalloc traces every thread of a process, and filtering a snapshot by
+file can't tell a render's allocations from an upload's in shared code
+(botocore, ssl, psycopg2 and the stdlib under both). So instead of filtering,
+generate_invoices.py stores nothing while its main process renders: with
+--profile, in-process runs use --upload-threads 0 (or --concurrency 1 with
+--async), storing each invoice between renders. Worker processes already
+render and store one after the other.
+"""
+import os
+import re
+import sys
+import time
+import pstats
+import cProfile
+import linecache
+import threading
+import contextlib
+import tracemalloc
+import logging
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Dict, Tuple
+
+from . import metrics as metrics_module
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MODES = ('sample', 'cprofile')
+
+# Seconds between stack samples of every thread (whole run) and of the one
+# thread rendering a selected entity, which is short and cheaper to sample
+SAMPLE_INTERVAL = 0.005
+ENTITY_SAMPLE_INTERVAL = 0.001
+
+# Stages of PDFGenerator.generate_invoice_pdf given an allocation report
+ALLOCATION_STAGES = ('format_records', 'jinja_render', 'layout', 'write_pdf', 'optimize_pdf')
+
+# The stage hooks' own bookkeeping and the stack sampler, left out of allocation reports
+_HOOK_FILTERS = tuple(tracemalloc.Filter(False, path) for path in (contextlib.__file__, metrics_module.__file__,
+                                                                  __file__))
+
+
+@dataclass(frozen=True)
+class ProfileSettings:
+    """What --profile captures; picklable, so worker processes can profile themselves"""
+    directory: str
+    mode: str = 'sample'
+    # Entity names to profile on their own; empty profiles the whole run
+    entities: Tuple[str, ...] = ()
+    # Lines listed per stage in the allocation report, and functions in the cProfile summary
+    top: int = 25
+
+
+def _file_label(label: str) -> str:
+    """A label safe to use in a file name"""
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', label).strip('_') or 'entity'
+
+
+class StackSampler:
+    """Samples Python stacks at a fixed interval and counts them as collapsed stacks"""
+
+    def __init__(self, thread_id: int = None, interval: float = SAMPLE_INTERVAL):
+        """
+        Args:
+            thread_id: Only sample this thread; every thread (rooted at its
+                name) when None
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or (self.thread_id is not None and ident != self.thread_id):
+                    continue
+                self.stacks[self._collapse(names.get(ident, str(ident)), frame)] += 1
+
+    @staticmethod
+    def _collapse(thread_name: str, frame) -> str:
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            name = getattr(code, 'co_qualname', code.co_name)
+            frames.append(f"{frame.f_globals.get('__name__', '?')}:{name}".replace(';', ':'))
+            frame = frame.f_back
+        frames.append(thread_name.replace(';', ':'))
+        return ';'.join(reversed(frames))
+
+    def write(self, path: str):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class CPUProfile:
+    """The --profile-mode CPU profiler, started and stopped around a run or an entity"""
+
+    def __init__(self, mode: str, thread_id: int = None):
+        """
+        Args:
+            thread_id: Sample only this thread, more often (sample mode).
+                cProfile always profiles the thread that starts it
+        """
+        self.mode = mode
+        if mode == 'cprofile':
+            self.profile = cProfile.Profile()
+        elif thread_id is None:
+            self.profile = StackSampler()
+        else:
+            self.profile = StackSampler(thread_id, ENTITY_SAMPLE_INTERVAL)
+
+    def start(self):
+        if self.mode == 'cprofile':
+            self.profile.enable()
+        else:
+            self.profile.start()
+
+    def stop(self):
+        if self.mode == 'cprofile':
+            self.profile.disable()
+        else:
+            self.profile.stop()
+
+    def write(self, directory: str, label: str, top: int):
+        base = os.path.join(directory, f'cpu-{label}')
+        if self.mode == 'cprofile':
+            self.profile.dump_stats(f'{base}.prof')
+            with open(f'{base}.txt', 'w') as f:
+                stats = pstats.Stats(self.profile, stream=f)
+                stats.sort_stats('cumulative').print_stats(top)
+        else:
+            self.profile.write(f'{base}.folded')
+
+
+@dataclass
+class _StageAllocations:
+    samples: int = 0
+    net_bytes: int = 0
+    peak_bytes: int = 0
+    # (file, line) -> bytes and blocks still allocated when the stage ended
+    lines: Counter = field(default_factory=Counter)
+    blocks: Counter = field(default_factory=Counter)
+
+
+class AllocationReport:
+    """
+    Top allocating lines per render stage
+
+    tracemalloc only runs while an ALLOCATION_STAGES stage does, so a snapshot
+    taken as the stage ends holds exactly what the stage allocated and kept,
+    and tracing costs nothing between stages. Render stages run on one thread
+    per process; a stage that starts while another is traced isn't measured.
+    Any other thread allocating meanwhile is counted too, so callers keep
+    other work out of the process while it renders (see the module docstring).
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, _StageAllocations] = {}
+        self._lock = threading.Lock()
+        self._tracing = threading.Lock()
+
+    @contextmanager
+    def track(self, stage: str):
+        """Trace the wrapped stage's allocations, if it is a render stage"""
+        if stage not in ALLOCATION_STAGES or not self._tracing.acquire(blocking=False):
+            yield
+            return
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            net_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self._tracing.release()
+            statistics = snapshot.filter_traces(_HOOK_FILTERS).statistics('lineno')
+            with self._lock:
+                totals = self.stages.setdefault(stage, _StageAllocations())
+                totals.samples += 1
+                totals.net_bytes += net_bytes
+                totals.peak_bytes = max(totals.peak_bytes, peak_bytes)
+                for statistic in statistics:
+                    frame = statistic.traceback[0]
+                    totals.lines[(frame.filename, frame.lineno)] += statistic.size
+                    totals.blocks[(frame.filename, frame.lineno)] += statistic.count
+
+    def write(self, path: str, top: int):
+        with self._lock, open(path, 'w') as f:
+            f.write('Memory allocated in each stage and still held when it ended, summed over its samples; '
+                    'peak is the most a single sample had allocated at once\n')
+            for stage in ALLOCATION_STAGES:
+                totals = self.stages.get(stage)
+                if not totals:
+                    continue
+                f.write(f'\n{stage}: {totals.samples} samples, held {totals.net_bytes / 1024:,.1f} KiB, '
+                        f'peak {totals.peak_bytes / 1024:,.1f} KiB\n')
+                for (filename, lineno), size in totals.lines.most_common(top):
+                    source = linecache.getline(filename, lineno).strip()
+                    f.write(f'  {size / 1024:10,.1f} KiB {totals.blocks[(filename, lineno)]:8} blocks  '
+                            f'{filename}:{lineno}  {source}\n')
+
+
+class RunProfiler:
+    """Profiles this process's share of a run, or only the selected entities' renders"""
+
+    def __init__(self, settings: ProfileSettings, label: str):
+        self.settings = settings
+        self.label = label
+        self.entities = frozenset(settings.entities)
+        self.cpu = None
+        self.allocations = AllocationReport()
+        # Set on the thread rendering a selected entity
+        self._local = threading.local()
+        os.makedirs(settings.directory, exist_ok=True)
+
+    def start(self):
+        metrics.stage_hooks.append(self._track_stage)
+        if not self.entities:
+            self.cpu = CPUProfile(self.settings.mode)
+            self.cpu.start()
+
+    def stop(self):
+        """Stop profiling and write this process's files"""
+        metrics.stage_hooks.remove(self._track_stage)
+        if self.entities:
+            return
+        self.cpu.stop()
+        self.cpu.write(self.settings.directory, self.label, self.settings.top)
+        self.allocations.write(os.path.join(self.settings.directory, f'allocations-{self.label}.txt'),
+                               self.settings.top)
+        logger.info(f"Profile for {self.label} written to {self.settings.directory}")
+
+    def discard(self):
+        """Stop profiling without writing anything, e.g. a profiler a forked worker inherited"""
+        if self._track_stage in metrics.stage_hooks:
+            metrics.stage_hooks.remove(self._track_stage)
+        if self.cpu is not None and self.cpu.mode == 'cprofile':
+            self.cpu.stop()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def selects(self, name: str) -> bool:
+        return name in self.entities
+
+    def _track_stage(self, stage: str):
+        if self.entities and not getattr(self._local, 'in_entity', False):
+            return nullcontext()
+        return self.allocations.track(stage)
+
+    @contextmanager
+    def entity(self, role: str, name: str):
+        """Profile the wrapped render on its own, into files labelled with the entity"""
+        label = _file_label(f'{role}-{name}')
+        allocations, self.allocations = self.allocations, AllocationReport()
+        cpu = CPUProfile(self.settings.mode, threading.get_ident())
+        started = time.perf_counter()
+        self._local.in_entity = True
+        cpu.start()
+        try:
+            yield
+        finally:
+            cpu.stop()
+            self._local.in_entity = False
+            entity_allocations, self.allocations = self.allocations, allocations
+            cpu.write(self.settings.directory, label, self.settings.top)
+            entity_allocations.write(os.path.join(self.settings.directory, f'allocations-{label}.txt'),
+                                     self.settings.top)
+            logger.info(f"Profiled {role} {name} ({time.perf_counter() - started:.2f}s), "
+                        f"written to {self.settings.directory}")
+
+
+# This process's profiler, set by start(); None when --profile is off
+profiler: RunProfiler = None
+
+
+def start(settings: ProfileSettings, label: str) -> RunProfiler:
+    """Start profiling this process"""
+    global profiler
+    if profiler is not None:
+        profiler.discard()
+    profiler = RunProfiler(settings, label)
+    profiler.start()
+    return profiler
+
+
+def stop():
+    """Stop profiling this process and write its files"""
+    global profiler
+    if profiler is not None:
+        profiler.stop()
+        profiler = None
+
+
+def selects(name: str) -> bool:
+    """Whether `name` is profiled on its own (--profile-entity)"""
+    return profiler is not None and profiler.selects(name)
+
+
+def entity(role: str, name: str):
+    """Context manager profiling one entity's render if it was selected, else doing nothing"""
+    if profiler is not None and profiler.selects(name):
+        return profiler.entity(role, name)
+    return nullcontext()
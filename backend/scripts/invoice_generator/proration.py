@@ -0,0 +1,205 @@
+"""
+Proration and totals for invoice line items
+
+Mirrors the rules in src/scripts/generate-invoices.js: an invoice dated the
+1st covers the previous month. A loan funded in the covered month (and not
+invoiced before) is prorated from its fund date to the month end. A loan paid
+off in the covered month is prorated from the 1st to its payoff date. Prorated
+amounts always use a 30-day month, rounded half-up to cents. A loan funded and
+paid off in the same covered month is a last-month row: as in the Node
+generator's calculateLastMonthProration, it is charged for the payoff day's
+number of days, not the days between funding and payoff, and its line item's
+period runs from the 1st to the payoff date to match.
+
+Which loans reach it is up to the records queries (see the role filters in
+database.py), which select them as the Node generator does: loans funded in
+the invoice's own month or later, and loans paid off before the covered
+month, are never passed in, so every row is either a full month or one of the
+prorated cases above.
+
+Work is done column-wise over a whole role at once: each input column is
+extracted in one pass, the per-row results are computed as parallel lists,
+and per-entity totals are accumulated in the same pass.
+"""
+import calendar
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from operator import attrgetter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .records import Record
+
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+PRORATION_DAYS = 30
+
+FIRST_MONTH = 'first_month'
+LAST_MONTH = 'last_month'
+
+
+@dataclass(frozen=True)
+class ProrationRule:
+    """How a role's records are invoiced"""
+    loan_table: str
+    amount_field: str
+    start_field: str
+    end_field: Optional[str]
+    # Whether first/last month rows are marked as prorated at all
+    prorates: bool
+    # Whether the invoiced amount is prorated, or only flagged (the amount is
+    # already prorated upstream in the sheet)
+    prorate_amount: bool
+    identifier_fields: Tuple[str, str]
+
+
+ROLE_RULES = {
+    # Borrowers always pay the full monthly amount
+    'client': ProrationRule('funded', 'interest_payment', 'closing_date', None, False, False,
+                            ('business_name', 'project_address')),
+    # capital_pay comes from the sheet already prorated
+    'investor': ProrationRule('promissory', 'capital_pay', 'fund_date', 'payoff_date', True, False,
+                              ('asset_id', 'investor_name')),
+    'capinvestor': ProrationRule('capinvestor', 'payment', 'fund_date', 'payoff_date', True, True,
+                                 ('property_address', 'investor_name'))
+}
+
+
+@dataclass
+class InvoiceLines:
+    """Column-oriented line items for one invoice, plus its totals"""
+    loan_table: str
+    loan_ids: List = field(default_factory=list)
+    identifiers: List[str] = field(default_factory=list)
+    original_amounts: List[Decimal] = field(default_factory=list)
+    prorated_amounts: List[Decimal] = field(default_factory=list)
+    is_prorated: List[bool] = field(default_factory=list)
+    proration_types: List[Optional[str]] = field(default_factory=list)
+    period_starts: List[date] = field(default_factory=list)
+    period_ends: List[date] = field(default_factory=list)
+    days_in_period: List[int] = field(default_factory=list)
+    total_days_in_month: List[int] = field(default_factory=list)
+    # Sum of prorated_amounts: the amount invoiced
+    total: Decimal = ZERO
+    # Sum of loan_amount, shown as "Total Invested" on investor invoices
+    principal: Decimal = ZERO
+
+    def __len__(self):
+        return len(self.prorated_amounts)
+
+    def rows(self) -> Iterable[Tuple]:
+        """(loan_id, loan_identifier, original, prorated, is_prorated, type, start, end, days, total_days)"""
+        return zip(self.loan_ids, self.identifiers, self.original_amounts, self.prorated_amounts,
+                   self.is_prorated, self.proration_types, self.period_starts, self.period_ends,
+                   self.days_in_period, self.total_days_in_month)
+
+
+def _to_decimal(value) -> Decimal:
+    """Like parseFloat(value) || 0, but exact"""
+    if value is None:
+        return ZERO
+    try:
+        return Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        return ZERO
+
+
+def _to_date(value) -> Optional[date]:
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+def covered_month(invoice_date) -> Tuple[date, date]:
+    """First and last day of the month an invoice dated `invoice_date` covers"""
+    invoice_date = _to_date(invoice_date)
+    year, month = (invoice_date.year - 1, 12) if invoice_date.month == 1 else (invoice_date.year, invoice_date.month - 1)
+    return date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1])
+
+
+def prorate_role(role: str, groups: Dict[str, List[Record]], invoice_date) -> Dict[str, InvoiceLines]:
+    """
+    Compute line items and totals for every entity of a role
+
+    Args:
+        role: 'client', 'investor', or 'capinvestor'
+        groups: {name: records}, as returned by DatabaseManager.get_all_role_records
+        invoice_date: Invoice date (the 1st of the month after the covered month)
+
+    Returns:
+        {name: InvoiceLines}
+    """
+    rule = ROLE_RULES[role]
+    period_start, period_end = covered_month(invoice_date)
+    month_days = period_end.day
+    first_of, second_of = map(attrgetter, rule.identifier_fields)
+
+    # Flatten once; `owners` maps each row back to its entity
+    owners, rows = [], []
+    for name, records in groups.items():
+        owners.extend([name] * len(records))
+        rows.extend(records)
+
+    # Input columns
+    amount_of, start_of = attrgetter(rule.amount_field), attrgetter(rule.start_field)
+    amounts = [_to_decimal(amount_of(r)) for r in rows]
+    principals = [_to_decimal(r.loan_amount) for r in rows]
+    starts = [_to_date(start_of(r)) for r in rows]
+    if rule.end_field:
+        end_of = attrgetter(rule.end_field)
+        ends = [_to_date(end_of(r)) for r in rows]
+    else:
+        ends = [None] * len(rows)
+    invoiced_before = [r.first_invoice_generated_at is not None for r in rows]
+
+    # Which rows fall in the first or last month of their loan; the last month wins
+    is_first = [s is not None and not seen and period_start <= s <= period_end
+                for s, seen in zip(starts, invoiced_before)]
+    is_last = [e is not None and period_start <= e <= period_end for e in ends]
+    types = [LAST_MONTH if last else FIRST_MONTH if first else None for first, last in zip(is_first, is_last)]
+    # Proration needs a non-zero monthly amount, as in the Node generator
+    prorated_flags = [rule.prorates and t is not None and bool(a) for t, a in zip(types, amounts)]
+
+    days = [
+        (e.day if t == LAST_MONTH else month_days - s.day + 1) if p else month_days
+        for t, p, s, e in zip(types, prorated_flags, starts, ends)
+    ]
+    invoiced = [
+        (a / PRORATION_DAYS * d).quantize(CENT, rounding=ROUND_HALF_UP) if p and rule.prorate_amount else a
+        for a, p, d in zip(amounts, prorated_flags, days)
+    ]
+    # A last-month row runs from the 1st, even if the loan was also funded this
+    # month, so its stored period agrees with the payoff day's count of days
+    period_starts = [s if first and not last else period_start for s, first, last in zip(starts, is_first, is_last)]
+    period_ends = [e if last else period_end for e, last in zip(ends, is_last)]
+
+    # Split back into per-entity columns, accumulating totals in the same pass
+    result = {name: InvoiceLines(rule.loan_table) for name in groups}
+    for i, owner in enumerate(owners):
+        lines = result[owner]
+        row = rows[i]
+        lines.loan_ids.append(row.id)
+        lines.identifiers.append(f"{first_of(row) or 'Unknown'} - {second_of(row)}")
+        lines.original_amounts.append(amounts[i])
+        lines.prorated_amounts.append(invoiced[i])
+        lines.is_prorated.append(prorated_flags[i])
+        lines.proration_types.append(types[i] if prorated_flags[i] else None)
+        lines.period_starts.append(period_starts[i])
+        lines.period_ends.append(period_ends[i])
+        lines.days_in_period.append(days[i])
+        lines.total_days_in_month.append(PRORATION_DAYS if prorated_flags[i] else month_days)
+        lines.total += invoiced[i]
+        lines.principal += principals[i]
+    return result
+
+
+def prorate(role: str, name: str, records: List[Record], invoice_date) -> InvoiceLines:
+    """Line items and totals for a single entity"""
+    return prorate_role(role, {name: records}, invoice_date)[name]
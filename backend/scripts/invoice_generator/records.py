@@ -0,0 +1,62 @@
+"""
+Compact row types for invoice source records
+
+Each role's records are read with just the columns an invoice is built from
+(proration, line items and the template), into a named tuple per row. Contact
+details, emails and sync timestamps never leave the database.
+"""
+from datetime import datetime
+from decimal import Decimal
+from typing import NamedTuple, Optional, Union
+
+
+class BusinessRecord(NamedTuple):
+    """A funded loan, invoiced to its borrower"""
+    id: str
+    business_name: str
+    project_address: Optional[str]
+    loan_amount: Optional[Decimal]
+    interest_payment: Optional[Decimal]
+    closing_date: Optional[datetime]
+    first_invoice_generated_at: Optional[datetime]
+
+
+class InvestorRecord(NamedTuple):
+    """A promissory note, invoiced to its investor"""
+    id: str
+    investor_name: str
+    asset_id: Optional[str]
+    fund_date: Optional[datetime]
+    payoff_date: Optional[datetime]
+    loan_amount: Optional[Decimal]
+    interest_rate: Optional[Decimal]
+    capital_pay: Optional[Decimal]
+    first_invoice_generated_at: Optional[datetime]
+
+
+class CapInvestorRecord(NamedTuple):
+    """A capital investment, invoiced to its cap investor"""
+    id: str
+    investor_name: str
+    property_address: Optional[str]
+    fund_date: Optional[datetime]
+    payoff_date: Optional[datetime]
+    loan_amount: Optional[Decimal]
+    interest_rate: Optional[Decimal]
+    payment: Optional[Decimal]
+    first_invoice_generated_at: Optional[datetime]
+
+
+Record = Union[BusinessRecord, InvestorRecord, CapInvestorRecord]
+
+# Role -> row type
+ROLE_RECORD_TYPES = {
+    'client': BusinessRecord,
+    'investor': InvestorRecord,
+    'capinvestor': CapInvestorRecord
+}
+
+
+def select_list(record_type) -> str:
+    """SELECT list for a row type's columns, in field order"""
+    return ', '.join(record_type._fields)
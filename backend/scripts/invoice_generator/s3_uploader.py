@@ -1,74 +1,125 @@
 """
 S3 upload operations for invoice PDFs
+
+boto3 is imported when an uploader is created, so runs that never upload
+(local exports, merge-shards, argument errors) start without loading botocore.
+The retry and URL helpers are plain functions, shared with the --async
+engine's AsyncS3Uploader.
 """
-import boto3
-from botocore.exceptions import ClientError
+import time
+import random
 import logging
+from .metrics import metrics
+from .storage import StorageBackend
 
 logger = logging.getLogger(__name__)
 
+# S3 error codes worth retrying with backoff
+RETRYABLE_ERROR_CODES = {
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'RequestTimeout',
+    'ServiceUnavailable',
+    'InternalError',
+    '503'
+}
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Full-jitter exponential backoff for the given (1-based) attempt"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def object_url(bucket_name: str, s3_key: str, endpoint_url: str = None) -> str:
+    """URL of an uploaded object, path-style on an S3-compatible endpoint"""
+    if endpoint_url:
+        return f"{endpoint_url.rstrip('/')}/{bucket_name}/{s3_key}"
+    return f"https://{bucket_name}.s3.amazonaws.com/{s3_key}"
 
-class S3Uploader:
+
+class S3Uploader(StorageBackend):
     def __init__(self, aws_access_key_id: str, aws_secret_access_key: str,
-                 region: str, bucket_name: str):
+                 region: str, bucket_name: str, max_pool_connections: int = 10,
+                 endpoint_url: str = None, max_attempts: int = 5, backoff_base: float = 0.5,
+                 backoff_cap: float = 20.0):
+        """
+        Args:
+            max_pool_connections: Size of botocore's HTTP connection pool; should be at
+                least the number of threads sharing this uploader
+            endpoint_url: Optional S3-compatible endpoint (MinIO, moto server) for local runs
+            max_attempts: Upload attempts before giving up on throttling errors
+            backoff_base: Base delay in seconds for jittered exponential backoff
+            backoff_cap: Maximum delay in seconds between attempts
+        """
+        import boto3
+        from botocore.config import Config
+
         self.bucket_name = bucket_name
+        self.endpoint_url = endpoint_url
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
         self.s3_client = boto3.client(
             's3',
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
-            region_name=region
+            region_name=region,
+            endpoint_url=endpoint_url,
+            # Retries are handled in upload_pdf so throttling backs off with jitter
+            config=Config(max_pool_connections=max_pool_connections,
+                          retries={'max_attempts': 1, 'mode': 'standard'})
         )
 
-    def upload_pdf(self, pdf_content: bytes, s3_key: str) -> str:
+    def upload_pdf(self, pdf_content: bytes, s3_key: str, record_count: int = None) -> str:
         """
         Upload PDF to S3 and return the URL
 
+        Throttling and transient server errors are retried up to `max_attempts`
+        times with jittered exponential backoff.
+
         Args:
             pdf_content: PDF file content as bytes
             s3_key: S3 object key (path within bucket)
+            record_count: Unused; S3 keeps no manifest
 
         Returns:
             str: S3 URL of uploaded file
         """
-        try:
-            self.s3_client.put_object(
-                Bucket=self.bucket_name,
-                Key=s3_key,
-                Body=pdf_content,
-                ContentType='application/pdf',
-                ServerSideEncryption='AES256'  # Encrypt at rest
-            )
-
-            # Generate the S3 URL
-            url = f"https://{self.bucket_name}.s3.amazonaws.com/{s3_key}"
-            logger.info(f"Successfully uploaded PDF to {url}")
-            return url
-
-        except ClientError as e:
-            logger.error(f"Failed to upload PDF to S3: {e}")
-            raise
-
-    def generate_s3_key(self, role: str, business_name: str, file_name: str) -> str:
-        """
-        Generate S3 key (path) for the invoice
+        from botocore.exceptions import ClientError
 
-        Args:
-            role: 'client', 'investor', or 'capinvestor'
-            business_name: Name of business/investor
-            file_name: Name of the PDF file
+        attempt = 1
+        while True:
+            try:
+                with metrics.stage('s3_upload'):
+                    self.s3_client.put_object(
+                        Bucket=self.bucket_name,
+                        Key=s3_key,
+                        Body=pdf_content,
+                        ContentType='application/pdf',
+                        ServerSideEncryption='AES256'  # Encrypt at rest
+                    )
+                metrics.increment('bytes_uploaded', len(pdf_content))
+                break
 
-        Returns:
-            str: S3 key path
-        """
-        # Map roles to folder names
-        folder_map = {
-            'client': 'clients',
-            'investor': 'investors',
-            'capinvestor': 'capinvestors'
-        }
-
-        folder = folder_map.get(role, role)
-        # Clean business name for folder path
-        clean_business_name = business_name.replace('/', '_').replace('\\', '_')
-
-        return f"invoices/{folder}/{clean_business_name}/{file_name}"
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code in RETRYABLE_ERROR_CODES and attempt < self.max_attempts:
+                    delay = backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+                    logger.warning(f"S3 upload of {s3_key} throttled ({code}), retrying in {delay:.2f}s "
+                                   f"(attempt {attempt}/{self.max_attempts})")
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+
+                logger.error(f"Failed to upload PDF to S3: {e}")
+                raise
+
+        url = self.object_url(s3_key)
+        logger.info(f"Successfully uploaded PDF to {url}")
+        return url
+
+    def object_url(self, s3_key: str) -> str:
+        """URL of an uploaded object"""
+        return object_url(self.bucket_name, s3_key, self.endpoint_url)
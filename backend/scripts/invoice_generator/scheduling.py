@@ -0,0 +1,82 @@
+"""
+Cost-based ordering of a run's invoices (largest predicted render time first)
+
+An invoice's cost is predicted from its record count, the pages those records
+fill, and how long it (or the rest of its role) took to render in earlier
+runs, as kept in the run journal. Handing the largest jobs out first to a pool
+whose idle workers take the next job (longest processing time first, with
+greedy list scheduling) keeps one big borrower from starting last and
+stretching the run: the makespan stays close to the total work divided by the
+workers, or the single largest invoice if that is longer.
+"""
+import math
+from typing import Callable, Dict, List, Tuple, TypeVar
+
+from .pdf_generator import FIRST_PAGE_ROWS, SUBSEQUENT_PAGE_ROWS
+from .sharding import INVOICE_OVERHEAD_RECORDS
+
+# Layout cost of each page (header, table head, page break) in record-equivalents
+PAGE_OVERHEAD_RECORDS = 4
+
+# Render seconds per record-equivalent before any history exists, roughly
+# WeasyPrint's; with no history only the order matters, not the scale
+DEFAULT_SECONDS_PER_UNIT = 0.01
+
+Job = TypeVar('Job')
+
+
+def estimate_pages(record_count: int) -> int:
+    """Pages an invoice with this many records fills (see PDFGenerator.split_records_into_pages)"""
+    if record_count <= FIRST_PAGE_ROWS:
+        return 1
+    return 1 + math.ceil((record_count - FIRST_PAGE_ROWS) / SUBSEQUENT_PAGE_ROWS)
+
+
+def work_units(record_count: int) -> int:
+    """Size of an invoice in record-equivalents: its rows, pages and fixed overhead"""
+    return record_count + PAGE_OVERHEAD_RECORDS * estimate_pages(record_count) + INVOICE_OVERHEAD_RECORDS
+
+
+class CostModel:
+    """Predicts render seconds per invoice from its size and the run journal's history"""
+
+    def __init__(self, history: Dict[str, Dict[str, Tuple[int, float]]] = None):
+        """
+        Args:
+            history: {role: {name: (record count, render seconds)}} from
+                RunJournal.render_costs; entities without history are predicted
+                from their role's average seconds per work unit
+        """
+        self.history = history or {}
+        self.rates = {}
+        for role, costs in self.history.items():
+            units = sum(work_units(record_count) for record_count, _ in costs.values())
+            if units:
+                self.rates[role] = sum(seconds for _, seconds in costs.values()) / units
+
+    def predict(self, role: str, name: str, record_count: int) -> float:
+        """Predicted render seconds for one invoice"""
+        past = self.history.get(role, {}).get(name)
+        if past is not None:
+            # Its own last render, scaled to its current size
+            past_record_count, seconds = past
+            return seconds * work_units(record_count) / work_units(past_record_count)
+        return self.rates.get(role, DEFAULT_SECONDS_PER_UNIT) * work_units(record_count)
+
+
+def largest_first(jobs: List[Job], cost: Callable[[Job], float]) -> Tuple[List[Job], List[float]]:
+    """
+    Order jobs by predicted cost, largest first
+
+    Returns:
+        (jobs, their predicted costs), in the order to hand them out
+    """
+    costed = sorted(((cost(job), index) for index, job in enumerate(jobs)), key=lambda pair: (-pair[0], pair[1]))
+    return [jobs[index] for _, index in costed], [predicted for predicted, _ in costed]
+
+
+def makespan_bound(costs: List[float], workers: int) -> float:
+    """Shortest possible run for these costs on `workers` workers: even split, or the largest job"""
+    if not costs:
+        return 0.0
+    return max(sum(costs) / max(workers, 1), max(costs))
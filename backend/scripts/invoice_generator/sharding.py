@@ -0,0 +1,177 @@
+"""
+Splitting a monthly run across nodes (--shard i/N) and checking the result
+"""
+import json
+import hashlib
+import argparse
+from dataclasses import dataclass
+from typing import Dict, List, Set, Tuple
+
+# Fixed cost of one invoice (header, PDF setup, upload) in record-equivalents,
+# so many tiny entities don't pile onto one shard
+INVOICE_OVERHEAD_RECORDS = 5
+
+
+def stable_hash(name: str) -> int:
+    """Hash of an entity name that is the same on every node and Python process"""
+    return int.from_bytes(hashlib.sha256(name.encode('utf-8')).digest()[:8], 'big')
+
+
+@dataclass(frozen=True)
+class Shard:
+    """Shard `index` (1-based) of `count`"""
+    index: int
+    count: int
+
+    def __str__(self):
+        return f'{self.index}/{self.count}'
+
+    def select(self, record_counts: Dict[str, int]) -> Set[str]:
+        """Names from {name: record count} that belong to this shard"""
+        assignment = assign_shards(record_counts, self.count)
+        return {name for name, shard in assignment.items() if shard == self.index}
+
+
+def parse_shard(value: str) -> Shard:
+    """argparse type for --shard i/N"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, e.g. 2/4, got '{value}'")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 1 and N, got '{value}'")
+    return Shard(index, count)
+
+
+def assign_shards(record_counts: Dict[str, int], count: int) -> Dict[str, int]:
+    """
+    Deterministically assign every entity to a shard (1..count), balancing records
+
+    Entities are taken largest first (ties in stable-hash order) and each goes to
+    the currently lightest shard, so large borrowers spread across shards. The
+    result depends only on the names and their record counts, so every node
+    computes the same split from the same data.
+    """
+    loads = [0] * count
+    assignment = {}
+    for name in sorted(record_counts, key=lambda n: (-record_counts[n], stable_hash(n), n)):
+        shard = min(range(count), key=lambda s: (loads[s], s))
+        loads[shard] += record_counts[name] + INVOICE_OVERHEAD_RECORDS
+        assignment[name] = shard + 1
+    return assignment
+
+
+def merge_shard_reports(reports: List[Dict]) -> Tuple[Dict, List[str]]:
+    """
+    Combine per-shard run reports and check every entity was invoiced exactly once
+
+    An entity counts as invoiced when its shard processed it or found it
+    unchanged. Problems reported: missing or duplicate shards, shards that saw a
+    different number of entities, entities assigned to several shards or to
+    none, and entities that failed or were never reached.
+
+    Returns:
+        (merged report, list of problems; empty when the run is complete)
+    """
+    problems = []
+    shards = [report.get('shard') for report in reports]
+    if None in shards:
+        problems.append('Some reports are not from a sharded run (no --shard)')
+        return {}, problems
+
+    counts = {Shard(**shard).count for shard in shards}
+    if len(counts) != 1:
+        problems.append(f"Reports disagree on the number of shards: {sorted(counts)}")
+    expected = max(counts)
+    seen = sorted(shard['index'] for shard in shards)
+    if seen != list(range(1, expected + 1)):
+        problems.append(f"Expected shards 1..{expected}, got {seen}")
+    dates = {report.get('invoice_date') for report in reports}
+    if len(dates) != 1:
+        problems.append(f"Reports are for different invoice dates: {sorted(dates)}")
+
+    merged_stats = {}
+    merged_entities = {}
+    for report in reports:
+        for key, outcomes in report.get('stats', {}).items():
+            totals = merged_stats.setdefault(key, {})
+            for outcome, value in outcomes.items():
+                totals[outcome] = totals.get(outcome, 0) + value
+
+    roles = sorted({role for report in reports for role in report.get('entities', {})})
+    for role in roles:
+        owner = {}
+        invoiced = {}
+        failed = set()
+        role_totals = set()
+        for report in reports:
+            label = str(Shard(**report['shard']))
+            entities = report.get('entities', {}).get(role, {})
+            role_totals.add(entities.get('role_total'))
+            for name in entities.get('assigned', []):
+                if name in owner:
+                    problems.append(f"{role} '{name}' assigned to shards {owner[name]} and {label}")
+                owner.setdefault(name, label)
+            for name in entities.get('processed', []) + entities.get('skipped', []):
+                invoiced[name] = invoiced.get(name, 0) + 1
+            failed.update(entities.get('failed', []))
+
+        if len(role_totals) != 1:
+            problems.append(f"Shards saw different numbers of {role} entities: {sorted(map(str, role_totals))}")
+        elif None not in role_totals and len(owner) != next(iter(role_totals)):
+            problems.append(f"{len(owner)} {role} entities assigned across shards, "
+                            f"but {next(iter(role_totals))} exist")
+
+        for name in sorted(owner):
+            times = invoiced.get(name, 0)
+            if times > 1:
+                problems.append(f"{role} '{name}' invoiced {times} times")
+            elif times == 0:
+                reason = 'failed' if name in failed else 'never processed'
+                problems.append(f"{role} '{name}' not invoiced ({reason}, shard {owner[name]})")
+
+        merged_entities[role] = {'assigned': len(owner), 'invoiced': sum(1 for n in owner if invoiced.get(n))}
+
+    merged = {
+        'invoice_date': next(iter(dates)) if len(dates) == 1 else sorted(dates),
+        'shards': len(reports),
+        'started_at': min(report.get('started_at', '') for report in reports),
+        'finished_at': max(report.get('finished_at', '') for report in reports),
+        'stats': merged_stats,
+        'entities': merged_entities,
+        'stages': _merge_stages(reports),
+        'counters': _merge_counters(reports),
+        'peak_rss_bytes': max(report.get('peak_rss_bytes', 0) for report in reports),
+        'complete': not problems,
+        'problems': problems
+    }
+    return merged, problems
+
+
+def _merge_stages(reports: List[Dict]) -> Dict:
+    """Combine stage counts, sums and maxima (percentiles can't be merged from summaries)"""
+    stages = {}
+    for report in reports:
+        for name, values in report.get('stages', {}).items():
+            merged = stages.setdefault(name, {'count': 0, 'sum': 0.0, 'max': 0.0})
+            merged['count'] += values.get('count', 0)
+            merged['sum'] += values.get('sum', 0.0)
+            merged['max'] = max(merged['max'], values.get('max', 0.0))
+    return stages
+
+
+def _merge_counters(reports: List[Dict]) -> Dict:
+    counters = {}
+    for report in reports:
+        for name, value in report.get('counters', {}).items():
+            counters[name] = counters.get(name, 0) + value
+    return counters
+
+
+def load_reports(paths: List[str]) -> List[Dict]:
+    """Read shard run reports from disk"""
+    reports = []
+    for path in paths:
+        with open(path) as f:
+            reports.append(json.load(f))
+    return reports
@@ -0,0 +1,63 @@
+"""
+Per-run invoice outcome tracking
+"""
+import threading
+from typing import Dict, Iterable, List
+
+OUTCOMES = ('processed', 'failed', 'skipped')
+
+
+class RunStats:
+    """
+    Counts each entity's outcome per role and remembers the names
+
+    The names back the run report, so sharded runs can be checked for every
+    entity being invoiced exactly once. Thread-safe: the render loop and the
+    store threads record outcomes concurrently.
+    """
+
+    def __init__(self, stats_keys: Dict[str, str]):
+        """
+        Args:
+            stats_keys: role -> key used in summaries ('client' -> 'clients')
+        """
+        self.stats_keys = stats_keys
+        self._lock = threading.Lock()
+        self._names = {role: {outcome: [] for outcome in OUTCOMES} for role in stats_keys}
+        self._assigned = {}
+        self._role_totals = {}
+
+    def record(self, role: str, outcome: str, name: str):
+        """Record one entity's outcome"""
+        with self._lock:
+            self._names[role][outcome].append(name)
+
+    def assign(self, role: str, names: Iterable[str], role_total: int):
+        """Record which entities this run (shard) is responsible for, out of `role_total`"""
+        with self._lock:
+            self._assigned[role] = sorted(names)
+            self._role_totals[role] = role_total
+
+    def count(self, role: str, outcome: str) -> int:
+        with self._lock:
+            return len(self._names[role][outcome])
+
+    def total(self, outcome: str) -> int:
+        with self._lock:
+            return sum(len(names[outcome]) for names in self._names.values())
+
+    def as_dict(self) -> Dict[str, Dict[str, int]]:
+        """{stats_key: {outcome: count}}, e.g. {'clients': {'processed': 3, ...}}"""
+        with self._lock:
+            return {self.stats_keys[role]: {outcome: len(names) for outcome, names in outcomes.items()}
+                    for role, outcomes in self._names.items()}
+
+    def entities(self) -> Dict[str, Dict[str, List[str]]]:
+        """{role: {outcome: sorted names}}, plus 'assigned' when the run was sharded"""
+        with self._lock:
+            result = {role: {outcome: sorted(names) for outcome, names in outcomes.items()}
+                      for role, outcomes in self._names.items()}
+            for role, names in self._assigned.items():
+                result[role]['assigned'] = list(names)
+                result[role]['role_total'] = self._role_totals[role]
+        return result
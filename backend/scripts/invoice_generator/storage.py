@@ -0,0 +1,174 @@
+"""
+Where rendered invoice PDFs are stored
+
+S3Uploader is the production backend. LocalDirectoryStorage and
+ArchiveStorage keep a full month on local disk instead, for dry runs, audits
+and disaster-recovery exports.
+"""
+import io
+import os
+import json
+import time
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+import threading
+import logging
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import List, Dict
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Role -> top-level folder for its invoices
+ROLE_FOLDERS = {
+    'client': 'clients',
+    'investor': 'investors',
+    'capinvestor': 'capinvestors'
+}
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+
+def invoice_key(role: str, business_name: str, file_name: str) -> str:
+    """
+    Generate S3 key (path) for the invoice
+
+    Args:
+        role: 'client', 'investor', or 'capinvestor'
+        business_name: Name of business/investor
+        file_name: Name of the PDF file
+
+    Returns:
+        str: S3 key path
+    """
+    folder = ROLE_FOLDERS.get(role, role)
+    # Clean business name for folder path
+    clean_business_name = business_name.replace('/', '_').replace('\\', '_')
+
+    return f"invoices/{folder}/{clean_business_name}/{file_name}"
+
+
+class StorageBackend(ABC):
+    """
+    Stores invoice PDFs under keys like invoices/clients/Business_Name/<file>.pdf
+
+    Subclasses implement upload_pdf; it may be called from several threads.
+    """
+
+    def generate_s3_key(self, role: str, business_name: str, file_name: str) -> str:
+        """S3 key (path) for the invoice; see invoice_key"""
+        return invoice_key(role, business_name, file_name)
+
+    @abstractmethod
+    def upload_pdf(self, pdf_content: bytes, s3_key: str, record_count: int = None) -> str:
+        """
+        Store a PDF under `s3_key` and return its URL
+
+        Args:
+            record_count: Records on the invoice, for backends that keep a manifest
+        """
+
+    def close(self):
+        """Finish writing; called once every upload is done"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class LocalDirectoryStorage(StorageBackend):
+    """
+    Writes each PDF to <root>/<key>; safe to call from many upload threads at once
+
+    Keys that would land outside the root (absolute, or climbing out with
+    `..`) are rejected with ValueError.
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, s3_key: str) -> Path:
+        """Where `s3_key` is written, which must be inside the root"""
+        path = (self.root / s3_key).resolve()
+        if self.root not in path.parents:
+            raise ValueError(f"Key is outside {self.root}: {s3_key}")
+        return path
+
+    def upload_pdf(self, pdf_content: bytes, s3_key: str, record_count: int = None) -> str:
+        path = self._path(s3_key)
+        with metrics.stage('s3_upload'):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first so a crash never leaves a truncated PDF
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(pdf_content)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        metrics.increment('bytes_uploaded', len(pdf_content))
+        return path.as_uri()
+
+
+class ArchiveStorage(StorageBackend):
+    """
+    Streams every PDF into one archive, plus a manifest.json of
+    {key, sha256, size, record_count} written last
+
+    The format follows the file name: .zip, .tar, .tar.gz/.tgz. PDFs are
+    already compressed, so zip members are stored rather than deflated.
+    Writes are serialized into one sequential stream.
+    """
+
+    MANIFEST_NAME = 'manifest.json'
+
+    def __init__(self, path: str):
+        self.path = Path(path).resolve()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._manifest: List[Dict] = []
+        name = self.path.name.lower()
+        if name.endswith('.zip'):
+            self._zip = zipfile.ZipFile(self.path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+            self._tar = None
+        elif name.endswith(ARCHIVE_SUFFIXES):
+            self._zip = None
+            self._tar = tarfile.open(self.path, 'w' if name.endswith('.tar') else 'w:gz')
+        else:
+            raise ValueError(f"Archive must end in {', '.join(ARCHIVE_SUFFIXES)}: {path}")
+
+    def _add(self, name: str, content: bytes):
+        if self._zip is not None:
+            self._zip.writestr(zipfile.ZipInfo(name, time.localtime()[:6]), content)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = int(time.time())
+            self._tar.addfile(info, io.BytesIO(content))
+
+    def upload_pdf(self, pdf_content: bytes, s3_key: str, record_count: int = None) -> str:
+        digest = hashlib.sha256(pdf_content).hexdigest()
+        with metrics.stage('s3_upload'), self._lock:
+            self._add(s3_key, pdf_content)
+            self._manifest.append({'key': s3_key, 'sha256': digest, 'size': len(pdf_content),
+                                   'record_count': record_count})
+        metrics.increment('bytes_uploaded', len(pdf_content))
+        return f"{self.path.as_uri()}#{s3_key}"
+
+    def close(self):
+        """Write the manifest and close the archive"""
+        with self._lock:
+            if self._zip is None and self._tar is None:
+                return
+            self._add(self.MANIFEST_NAME, json.dumps(self._manifest, indent=2).encode('utf-8'))
+            (self._zip or self._tar).close()
+            self._zip = self._tar = None
+        logger.info(f"Wrote {len(self._manifest)} invoices to {self.path}")
@@ -0,0 +1,106 @@
+"""
+Caching URL fetcher for WeasyPrint resources (logo, images, fonts)
+"""
+import os
+import json
+import hashlib
+import threading
+import logging
+from typing import Dict
+
+from .pdf_optimizer import downscale_image
+
+logger = logging.getLogger(__name__)
+
+
+def default_url_fetcher(url: str, **kwargs) -> Dict:
+    """WeasyPrint's own fetcher, imported on first use"""
+    from weasyprint import default_url_fetcher as weasyprint_url_fetcher
+    return weasyprint_url_fetcher(url, **kwargs)
+
+
+class CachingURLFetcher:
+    """
+    WeasyPrint url_fetcher that fetches each URL once per process
+
+    Fetched resources are kept in memory and, when `cache_dir` is set, on disk
+    as well, so later runs (and worker processes) don't hit the network and a
+    run can complete while a remote LOGO_URL is unreachable. Failed fetches
+    are not cached. Thread-safe.
+    """
+
+    def __init__(self, cache_dir: str = None, timeout: int = 10, image_max_height: int = None):
+        """
+        Args:
+            cache_dir: Optional directory for the on-disk cache, created if missing
+            timeout: Seconds to wait on a remote fetch
+            image_max_height: Downscale raster images taller than this many pixels
+                once, when first fetched; the cache keeps the downscaled copy
+        """
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.image_max_height = image_max_height
+        self._cache = {}
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __call__(self, url: str, timeout: int = None, ssl_context=None) -> Dict:
+        # Inline data: URLs cost nothing to decode
+        if url.startswith('data:'):
+            return default_url_fetcher(url, timeout=timeout or self.timeout, ssl_context=ssl_context)
+
+        with self._lock:
+            resource = self._cache.get(url)
+            if resource is None:
+                resource = self._read_disk(url)
+                if resource is None:
+                    resource = self._fetch(url, timeout or self.timeout, ssl_context)
+                    self._write_disk(url, resource)
+                self._cache[url] = resource
+        return dict(resource)
+
+    def _fetch(self, url: str, timeout: int, ssl_context) -> Dict:
+        result = default_url_fetcher(url, timeout=timeout, ssl_context=ssl_context)
+        if 'file_obj' in result:
+            file_obj = result.pop('file_obj')
+            try:
+                result['string'] = file_obj.read()
+            finally:
+                file_obj.close()
+        logger.info(f"Fetched {url} ({len(result['string'])} bytes)")
+        if self.image_max_height:
+            result = downscale_image(result, self.image_max_height)
+        return result
+
+    def _disk_path(self, url: str) -> str:
+        # Downscaled copies are cached apart from the originals
+        key = f'{url}#max-height={self.image_max_height}' if self.image_max_height else url
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def _read_disk(self, url: str):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(url)
+        try:
+            with open(f'{path}.json') as f:
+                resource = json.load(f)
+            with open(path, 'rb') as f:
+                resource['string'] = f.read()
+        except (OSError, ValueError):
+            return None
+        return resource
+
+    def _write_disk(self, url: str, resource: Dict):
+        if not self.cache_dir or url.startswith('file:'):
+            return
+        path = self._disk_path(url)
+        meta = {key: value for key, value in resource.items() if key != 'string' and isinstance(value, str)}
+        try:
+            # Body first, metadata last: a cache entry only counts once its .json exists
+            with open(path, 'wb') as f:
+                f.write(resource['string'])
+            with open(f'{path}.json', 'w') as f:
+                json.dump(meta, f)
+        except OSError as e:
+            logger.warning(f"Could not write {url} to the asset cache: {e}")
@@ -0,0 +1,104 @@
+"""
+Scratch Postgres schemas for the tests that need a real database
+
+Set TEST_DATABASE_URL to a database the tests may create schemas in, e.g.
+
+    TEST_DATABASE_URL=postgresql://postgres@localhost:5432/postgres python3 -m unittest discover tests
+
+Without it, or without psycopg2, those tests are skipped. Each test gets its
+own schema with empty invoices and invoice_line_items tables, as the
+migrations create them, and the schema is dropped afterwards; nothing outside
+it is touched.
+"""
+import os
+import unittest
+import uuid
+
+INVOICE_TABLES = """
+    CREATE TABLE invoices (
+        id SERIAL PRIMARY KEY,
+        business_name VARCHAR(255) NOT NULL,
+        role VARCHAR(50) NOT NULL,
+        invoice_date DATE NOT NULL,
+        file_name VARCHAR(255) NOT NULL,
+        s3_key VARCHAR(500) NOT NULL,
+        s3_url TEXT NOT NULL,
+        total_amount NUMERIC(15, 2),
+        record_count INTEGER,
+        source_fingerprint VARCHAR(64),
+        created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        CONSTRAINT unique_invoice_per_business_date UNIQUE (business_name, role, invoice_date)
+    );
+    CREATE TABLE invoice_line_items (
+        id UUID PRIMARY KEY,
+        invoice_id INTEGER NOT NULL REFERENCES invoices (id) ON DELETE CASCADE,
+        loan_table VARCHAR(50) NOT NULL,
+        loan_id UUID NOT NULL,
+        loan_identifier VARCHAR(500),
+        original_amount NUMERIC(15, 2) NOT NULL,
+        prorated_amount NUMERIC(15, 2) NOT NULL,
+        is_prorated BOOLEAN NOT NULL DEFAULT FALSE,
+        proration_type VARCHAR(20),
+        period_start_date DATE NOT NULL,
+        period_end_date DATE NOT NULL,
+        days_in_period INTEGER NOT NULL,
+        total_days_in_month INTEGER NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL
+    );
+"""
+
+
+def _create_schema(test: unittest.TestCase):
+    """Create a schema holding INVOICE_TABLES, dropped when `test` finishes; returns (database_url, schema)"""
+    database_url = os.getenv('TEST_DATABASE_URL')
+    if not database_url:
+        raise unittest.SkipTest('TEST_DATABASE_URL is not set')
+    try:
+        import psycopg2
+    except ImportError as e:
+        raise unittest.SkipTest(f"psycopg2 unavailable: {e}")
+    try:
+        admin = psycopg2.connect(database_url)
+    except psycopg2.Error as e:
+        raise unittest.SkipTest(f"Postgres unavailable: {e}")
+
+    schema = f'invoice_test_{uuid.uuid4().hex[:12]}'
+    admin.autocommit = True
+    with admin.cursor() as cursor:
+        cursor.execute(f'CREATE SCHEMA {schema}')
+        cursor.execute(f'SET search_path TO {schema}')
+        cursor.execute(INVOICE_TABLES)
+
+    def drop():
+        with admin.cursor() as cursor:
+            cursor.execute(f'DROP SCHEMA {schema} CASCADE')
+        admin.close()
+
+    test.addCleanup(drop)
+    return database_url, schema
+
+
+def scratch_schema(test: unittest.TestCase) -> str:
+    """
+    Create a schema holding INVOICE_TABLES, dropped when `test` finishes
+
+    Returns a psycopg2 connection string whose search_path is that schema.
+    Skips `test` when TEST_DATABASE_URL isn't set or can't be reached.
+    """
+    from psycopg2.extensions import make_dsn
+
+    database_url, schema = _create_schema(test)
+    return make_dsn(database_url, options=f'-c search_path={schema}')
+
+
+def scratch_schema_url(test: unittest.TestCase) -> str:
+    """
+    scratch_schema for asyncpg, which takes only URLs
+
+    asyncpg sends query parameters it doesn't know as server settings, so the
+    search_path is passed as one.
+    """
+    database_url, schema = _create_schema(test)
+    return f"{database_url}{'&' if '?' in database_url else '?'}search_path={schema}"
@@ -0,0 +1,127 @@
+"""
+The --async engine's upload and save against a real S3 endpoint and Postgres
+
+Needs TEST_DATABASE_URL (see tests/postgres.py) and TEST_S3_ENDPOINT_URL, an
+S3-compatible endpoint such as moto's server or MinIO:
+
+    moto_server -p 5055 &
+    TEST_S3_ENDPOINT_URL=http://127.0.0.1:5055 TEST_DATABASE_URL=... python3 -m unittest tests.test_async_store
+
+Credentials come from AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY (any value
+works with moto). Each test creates a bucket of its own and empties and
+deletes it afterwards. Without either service, or without the packages in
+requirements-async.txt, the tests are skipped.
+"""
+import os
+import sys
+import uuid
+import asyncio
+import importlib
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.postgres import scratch_schema_url
+from benchmarks.fixtures import FIXTURES, FIXTURE_INVOICE_DATE
+from generate_invoices import store_invoice_async
+from invoice_generator.async_engine import AsyncDatabaseManager, AsyncS3Uploader
+from invoice_generator.pipeline import RenderedInvoice
+from invoice_generator.proration import prorate
+
+REGION = 'us-east-1'
+
+
+def fixture_invoice(fixture, file_name: str, pdf_content: bytes) -> RenderedInvoice:
+    """A fixture as render_invoice would return it; loan ids are made UUIDs, as the line items table stores"""
+    records = [record._replace(id=str(uuid.uuid5(uuid.NAMESPACE_URL, record.id))) for record in fixture.records]
+    lines = prorate(fixture.role, fixture.name, records, FIXTURE_INVOICE_DATE)
+    return RenderedInvoice(role=fixture.role, business_name=fixture.name, invoice_date=FIXTURE_INVOICE_DATE,
+                           file_name=file_name, pdf_content=pdf_content, total_amount=lines.total,
+                           record_count=len(records), line_items=lines)
+
+
+def s3_endpoint(test: unittest.TestCase):
+    """(endpoint_url, credentials) of a reachable TEST_S3_ENDPOINT_URL, or skip `test`"""
+    endpoint_url = os.getenv('TEST_S3_ENDPOINT_URL')
+    if not endpoint_url:
+        raise unittest.SkipTest('TEST_S3_ENDPOINT_URL is not set')
+    for module in ('asyncpg', 'aioboto3', 'boto3'):
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            raise unittest.SkipTest(f"{module} unavailable: {e}")
+    credentials = dict(aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID', 'test'),
+                       aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY', 'test'))
+    return endpoint_url, credentials
+
+
+class AsyncStoreTest(unittest.TestCase):
+    """store_invoice_async uploads each PDF and saves its invoice row and line items"""
+
+    def setUp(self):
+        import boto3
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        endpoint_url, credentials = s3_endpoint(self)
+        self.s3 = boto3.client('s3', region_name=REGION, endpoint_url=endpoint_url, **credentials)
+        self.bucket = f'invoice-test-{uuid.uuid4().hex[:12]}'
+        try:
+            self.s3.create_bucket(Bucket=self.bucket)
+        except (BotoCoreError, ClientError) as e:
+            raise unittest.SkipTest(f"S3 endpoint unavailable: {e}")
+        self.addCleanup(self.delete_bucket)
+        self.uploader = AsyncS3Uploader(credentials['aws_access_key_id'], credentials['aws_secret_access_key'],
+                                        REGION, self.bucket, endpoint_url=endpoint_url)
+
+        self.database_url = scratch_schema_url(self)
+
+    def delete_bucket(self):
+        for item in self.s3.list_objects_v2(Bucket=self.bucket).get('Contents', []):
+            self.s3.delete_object(Bucket=self.bucket, Key=item['Key'])
+        self.s3.delete_bucket(Bucket=self.bucket)
+
+    def store(self, invoices, query: str):
+        """Store `invoices` concurrently, then return the rows of `query`"""
+        async def run():
+            db = AsyncDatabaseManager(self.database_url, pool_size=4)
+            await db.connect()
+            try:
+                async with self.uploader as s3:
+                    await asyncio.gather(*(store_invoice_async(db, s3, invoice) for invoice in invoices))
+                return [tuple(row) for row in await db.pool.fetch(query)]
+            finally:
+                await db.close()
+        return asyncio.run(run())
+
+    def test_store(self):
+        invoices = [fixture_invoice(fixture, f'{uuid.uuid4().hex}.pdf', f'%PDF {fixture.name}'.encode())
+                    for fixture in FIXTURES]
+        rows = {row[0]: row[1:] for row in self.store(invoices, """
+            SELECT business_name, s3_key, s3_url, total_amount, record_count,
+                   (SELECT COUNT(*) FROM invoice_line_items WHERE invoice_id = invoices.id)
+            FROM invoices
+        """)}
+        self.assertEqual(set(rows), {invoice.business_name for invoice in invoices})
+        for invoice in invoices:
+            with self.subTest(invoice.business_name):
+                s3_key, s3_url, total_amount, record_count, line_items = rows[invoice.business_name]
+                self.assertEqual(s3_key, self.uploader.generate_s3_key(invoice.role, invoice.business_name,
+                                                                       invoice.file_name))
+                self.assertEqual(s3_url, self.uploader.object_url(s3_key))
+                self.assertEqual((total_amount, record_count, line_items),
+                                 (invoice.total_amount, invoice.record_count, invoice.record_count))
+                stored = self.s3.get_object(Bucket=self.bucket, Key=s3_key)
+                self.assertEqual(stored['Body'].read(), invoice.pdf_content)
+                self.assertEqual(stored['ContentType'], 'application/pdf')
+
+    def test_store_again(self):
+        """A second run over the same month replaces the row and its line items"""
+        fixture = FIXTURES[0]
+        for run in range(2):
+            rows = self.store([fixture_invoice(fixture, f'run-{run}.pdf', b'%PDF')],
+                              "SELECT file_name, (SELECT COUNT(*) FROM invoice_line_items) FROM invoices")
+        self.assertEqual(rows, [('run-1.pdf', len(fixture.records))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+Render engine parity against the hand-built invoices in benchmarks/fixtures.py
+
+Run from backend/scripts:
+
+    python3 -m unittest discover tests
+
+Totals are checked without rendering. An engine whose packages aren't
+installed (WeasyPrint's system libraries, ReportLab, or pypdf to read the
+PDFs back) is skipped rather than failed.
+"""
+import os
+import sys
+import importlib
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fixtures import FIXTURES, FIXTURE_INVOICE_DATE
+from benchmarks.parity import check_fixtures, check_invoice, compare_invoices
+from generate_invoices import render_invoice, render_invoice_batch
+from invoice_generator.pdf_generator import ENGINES, PDFGenerator
+from invoice_generator.proration import prorate
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'invoice_generator', 'templates')
+
+
+def render_fixtures(engine: str, batch: bool = False):
+    """
+    Each fixture's RenderedInvoice with `engine`, or skip the test if the engine can't run here
+
+    With `batch`, each role's fixtures are rendered together by render_invoice_batch.
+    """
+    try:
+        importlib.import_module('pypdf')
+        pdf_gen = PDFGenerator(TEMPLATE_DIR, engine=engine)
+        if not batch:
+            return [render_invoice(pdf_gen, fixture.role, fixture.name, fixture.records, FIXTURE_INVOICE_DATE)
+                    for fixture in FIXTURES]
+        rendered = {}
+        for role in dict.fromkeys(fixture.role for fixture in FIXTURES):
+            fixtures = [fixture for fixture in FIXTURES if fixture.role == role]
+            invoices = render_invoice_batch(pdf_gen, role, [(fixture.name, fixture.records, None, None)
+                                                            for fixture in fixtures], FIXTURE_INVOICE_DATE)
+            rendered.update(zip((fixture.name for fixture in fixtures), invoices))
+        return [rendered[fixture.name] for fixture in FIXTURES]
+    except (ImportError, OSError, RuntimeError) as e:
+        raise unittest.SkipTest(f"{engine} unavailable: {e}")
+
+
+class FixtureTotalsTest(unittest.TestCase):
+    """The proration engine gives every fixture its hand-worked total, prorated days and periods"""
+
+    def test_totals(self):
+        for fixture in FIXTURES:
+            with self.subTest(fixture.name):
+                lines = prorate(fixture.role, fixture.name, fixture.records, FIXTURE_INVOICE_DATE)
+                self.assertEqual(lines.total, fixture.total)
+                self.assertEqual(len(lines), len(fixture.records))
+                prorated_days = tuple(days for days, prorated in zip(lines.days_in_period, lines.is_prorated)
+                                      if prorated)
+                self.assertEqual(prorated_days, fixture.prorated_days)
+                # A prorated line item's stored period spans exactly the days it is charged for
+                for start, end, days, prorated in zip(lines.period_starts, lines.period_ends,
+                                                      lines.days_in_period, lines.is_prorated):
+                    if prorated:
+                        self.assertEqual((end - start).days + 1, days)
+
+
+class EngineFixturesTest(unittest.TestCase):
+    """Each engine's PDFs show the fixtures' totals, line items and page counts"""
+
+    def test_engines(self):
+        for engine in ENGINES:
+            with self.subTest(engine):
+                for fixture, invoice in zip(FIXTURES, render_fixtures(engine)):
+                    self.assertEqual(check_invoice(invoice, fixture), [], f"{engine}: {fixture.name}")
+
+    def test_batches(self):
+        """Rendered in one batch document per role, multi-page invoices included, each PDF keeps its own pages"""
+        for engine in ENGINES:
+            with self.subTest(engine):
+                for fixture, invoice in zip(FIXTURES, render_fixtures(engine, batch=True)):
+                    self.assertEqual(check_invoice(invoice, fixture), [], f"{engine}: {fixture.name}")
+
+
+class EngineAgreementTest(unittest.TestCase):
+    """Every engine renders the fixtures as WeasyPrint, the reference engine, does"""
+
+    def test_agreement(self):
+        reference = render_fixtures('weasyprint')
+        for engine in ENGINES:
+            if engine == 'weasyprint':
+                continue
+            with self.subTest(engine):
+                for fixture, expected, invoice in zip(FIXTURES, reference, render_fixtures(engine)):
+                    self.assertEqual(compare_invoices(expected, invoice, fixture.records), [],
+                                     f"{engine}: {fixture.name}")
+
+    def test_check_fixtures(self):
+        render_fixtures('weasyprint')
+        generators = {engine: PDFGenerator(TEMPLATE_DIR, engine=engine) for engine in ENGINES}
+        self.assertEqual(check_fixtures(generators), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
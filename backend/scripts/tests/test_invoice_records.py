@@ -0,0 +1,61 @@
+"""
+Invoice metadata saves against Postgres (see tests/postgres.py for TEST_DATABASE_URL)
+"""
+import os
+import sys
+import unittest
+from datetime import datetime
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.postgres import scratch_schema
+from generate_invoices import ROLES, confirm_recorded
+from invoice_generator.database import DatabaseManager, InvoiceRecordWriter
+from invoice_generator.stats import RunStats
+
+INVOICE_DATE = datetime(2026, 2, 1)
+
+
+class ConfirmRecordedTest(unittest.TestCase):
+    """confirm_recorded only counts invoices whose rows this run saved"""
+
+    def setUp(self):
+        database_url = scratch_schema(self)
+        # The parent's connection, and a worker's with its buffered writer
+        self.db = DatabaseManager(database_url)
+        self.db.connect()
+        self.addCleanup(self.db.close)
+        self.worker_db = DatabaseManager(database_url)
+        self.worker_db.connect()
+        self.addCleanup(self.worker_db.close)
+
+    def save(self, writer: InvoiceRecordWriter, name: str, fingerprint: str):
+        writer.save_invoice_record(name, 'client', INVOICE_DATE.date(), f'{name}.pdf', f'invoices/{name}.pdf',
+                                   f'https://bucket/invoices/{name}.pdf', 100, 1, fingerprint)
+        writer.flush()
+
+    def test_failed_flush_over_an_earlier_row(self):
+        # An earlier run saved both invoices with the fingerprints this run renders again
+        with InvoiceRecordWriter(self.worker_db) as writer:
+            self.save(writer, 'Acme Holdings LLC', 'a' * 64)
+            self.save(writer, 'Bayside Partners', 'b' * 64)
+
+        started = self.db.current_timestamp()
+        failed = []
+        writer = InvoiceRecordWriter(self.worker_db, on_error=failed.extend)
+        self.save(writer, 'Bayside Partners', 'b' * 64)
+        with mock.patch('invoice_generator.database.copy_line_items',
+                        side_effect=RuntimeError('simulated COPY failure')):
+            self.save(writer, 'Acme Holdings LLC', 'a' * 64)
+        self.assertEqual(failed, [('Acme Holdings LLC', 'client', INVOICE_DATE.date())])
+
+        stats = RunStats({role: settings['stats_key'] for role, settings in ROLES.items()})
+        confirm_recorded(self.db, [('client', 'Acme Holdings LLC', [], 'a' * 64),
+                                   ('client', 'Bayside Partners', [], 'b' * 64)], stats, INVOICE_DATE, started)
+        self.assertEqual(stats.entities()['client']['processed'], ['Bayside Partners'])
+        self.assertEqual(stats.entities()['client']['failed'], ['Acme Holdings LLC'])
+
+
+if __name__ == '__main__':
+    unittest.main()
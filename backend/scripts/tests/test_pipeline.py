@@ -0,0 +1,49 @@
+"""
+InvoicePipeline's store threads, and storing inline with none
+"""
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from invoice_generator.pipeline import InvoicePipeline, RenderedInvoice
+
+
+def invoice(name: str) -> RenderedInvoice:
+    return RenderedInvoice(role='client', business_name=name, invoice_date=None, file_name=f'{name}.pdf',
+                           pdf_content=b'%PDF', total_amount=None, record_count=1)
+
+
+class InvoicePipelineTest(unittest.TestCase):
+
+    def run_pipeline(self, workers: int):
+        """Submit three invoices, the second failing; returns (storing threads, results)"""
+        threads, results = set(), []
+
+        def store(rendered):
+            threads.add(threading.current_thread())
+            if rendered.business_name == 'B':
+                raise RuntimeError('upload failed')
+
+        with InvoicePipeline(store, lambda rendered, ok: results.append((rendered.business_name, ok)),
+                             workers=workers) as pipeline:
+            for name in 'ABC':
+                pipeline.submit(invoice(name))
+        return threads, sorted(results)
+
+    def test_store_threads(self):
+        threads, results = self.run_pipeline(workers=2)
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(results, [('A', True), ('B', False), ('C', True)])
+
+    def test_inline(self):
+        """With no store threads, each invoice is stored by submit() itself"""
+        threads, results = self.run_pipeline(workers=0)
+        self.assertEqual(threads, {threading.current_thread()})
+        self.assertEqual(results, [('A', True), ('B', False), ('C', True)])
+
+
+if __name__ == '__main__':
+    unittest.main()
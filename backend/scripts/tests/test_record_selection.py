@@ -0,0 +1,50 @@
+"""
+Which rows the records queries invoice, against the fixtures in benchmarks/fixtures.py
+
+Runs the production queries on the SQLite stand-in. Every fixture's invoiced
+records must be selected for FIXTURE_INVOICE_DATE and its excluded rows left
+out, as the Node generator selects them.
+"""
+import os
+import sys
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fixtures import FIXTURES, FIXTURE_INVOICE_DATE, fixture_tables
+from benchmarks.standins import SQLiteDatabaseManager
+
+
+class RecordSelectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SQLiteDatabaseManager()
+        self.db.connect()
+        self.db.load(fixture_tables())
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_fixture_records(self):
+        for fixture in FIXTURES:
+            with self.subTest(fixture.name):
+                groups = self.db.get_all_role_records(fixture.role, FIXTURE_INVOICE_DATE)
+                selected = {record.id for record in groups.get(fixture.name, [])}
+                self.assertEqual(selected, {record.id for record in fixture.records})
+
+    def test_streamed_groups(self):
+        for fixture in FIXTURES:
+            with self.subTest(fixture.name):
+                groups = dict(self.db.iter_role_record_groups(fixture.role, FIXTURE_INVOICE_DATE))
+                self.assertEqual(groups.get(fixture.name), self.db.get_all_role_records(
+                    fixture.role, FIXTURE_INVOICE_DATE).get(fixture.name))
+
+    def test_next_month(self):
+        """A loan funded in February is first invoiced in March; loans paid off in January are gone"""
+        groups = self.db.get_all_role_records('investor', datetime(2026, 3, 1))
+        self.assertEqual([record.asset_id for record in groups['Parity Investor Payoffs']], ['PAY-1', 'PAY-3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
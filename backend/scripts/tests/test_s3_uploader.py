@@ -0,0 +1,108 @@
+"""
+S3Uploader's throttling retries and endpoint override, with a stubbed client
+
+Nothing is sent over the network; boto3 is only needed to build the client
+that the stub replaces, and the tests are skipped without it.
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from invoice_generator.s3_uploader import S3Uploader
+
+KEY = 'invoices/clients/Acme/invoice.pdf'
+
+
+class StubClient:
+    """put_object fails with each of `errors` in turn, then succeeds"""
+
+    def __init__(self, *errors: str):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def put_object(self, **kwargs):
+        from botocore.exceptions import ClientError
+
+        self.calls += 1
+        if self.errors:
+            raise ClientError({'Error': {'Code': self.errors.pop(0)}}, 'PutObject')
+
+
+def uploader(**kwargs) -> S3Uploader:
+    try:
+        return S3Uploader('key', 'secret', 'us-east-1', 'invoices-bucket', **kwargs)
+    except ImportError as e:
+        raise unittest.SkipTest(f"boto3 unavailable: {e}")
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.s3 = uploader(max_attempts=4, backoff_base=0.5, backoff_cap=3.0)
+        sleep = mock.patch('invoice_generator.s3_uploader.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def delays(self):
+        return [call.args[0] for call in self.sleep.call_args_list]
+
+    def test_retries_throttling(self):
+        self.s3.s3_client = StubClient('SlowDown', 'ThrottlingException', '503')
+        url = self.s3.upload_pdf(b'%PDF', KEY)
+        self.assertEqual(url, f'https://invoices-bucket.s3.amazonaws.com/{KEY}')
+        self.assertEqual(self.s3.s3_client.calls, 4)
+        self.assertEqual(len(self.delays()), 3)
+
+    def test_gives_up_after_max_attempts(self):
+        from botocore.exceptions import ClientError
+
+        self.s3.s3_client = StubClient(*['SlowDown'] * 10)
+        with self.assertRaises(ClientError):
+            self.s3.upload_pdf(b'%PDF', KEY)
+        self.assertEqual(self.s3.s3_client.calls, 4)
+        self.assertEqual(len(self.delays()), 3)
+
+    def test_other_errors_not_retried(self):
+        from botocore.exceptions import ClientError
+
+        self.s3.s3_client = StubClient('AccessDenied')
+        with self.assertRaises(ClientError):
+            self.s3.upload_pdf(b'%PDF', KEY)
+        self.assertEqual(self.s3.s3_client.calls, 1)
+        self.assertEqual(self.delays(), [])
+
+    def test_backoff_bound(self):
+        """Each delay is drawn from [0, min(cap, base * 2 ** attempt)]"""
+        self.s3.s3_client = StubClient(*['SlowDown'] * 3)
+        with mock.patch('invoice_generator.s3_uploader.random.uniform', side_effect=lambda low, high: high) as uniform:
+            self.s3.upload_pdf(b'%PDF', KEY)
+        self.assertTrue(all(call.args[0] == 0 for call in uniform.call_args_list))
+        self.assertEqual(self.delays(), [1.0, 2.0, 3.0])
+
+    def test_jittered_delays_within_bound(self):
+        self.s3.s3_client = StubClient(*['SlowDown'] * 3)
+        self.s3.upload_pdf(b'%PDF', KEY)
+        for delay, bound in zip(self.delays(), [1.0, 2.0, 3.0]):
+            self.assertTrue(0 <= delay <= bound, f"{delay} outside [0, {bound}]")
+
+
+class EndpointTest(unittest.TestCase):
+    """endpoint_url (S3_ENDPOINT_URL) points the client at an S3-compatible server, with path-style URLs"""
+
+    def test_endpoint_override(self):
+        s3 = uploader(endpoint_url='http://127.0.0.1:9000/')
+        self.assertEqual(s3.s3_client.meta.endpoint_url, 'http://127.0.0.1:9000/')
+        s3.s3_client = StubClient()
+        self.assertEqual(s3.upload_pdf(b'%PDF', KEY), f'http://127.0.0.1:9000/invoices-bucket/{KEY}')
+
+    def test_default_endpoint(self):
+        s3 = uploader()
+        self.assertEqual(s3.s3_client.meta.endpoint_url, 'https://s3.amazonaws.com')
+        self.assertEqual(s3.object_url(KEY), f'https://invoices-bucket.s3.amazonaws.com/{KEY}')
+
+
+if __name__ == '__main__':
+    unittest.main()
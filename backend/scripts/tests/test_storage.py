@@ -0,0 +1,59 @@
+"""
+Storage backends: the StorageBackend interface and LocalDirectoryStorage's keys
+"""
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from invoice_generator.storage import StorageBackend, LocalDirectoryStorage, invoice_key
+
+
+class StorageBackendTest(unittest.TestCase):
+
+    def test_upload_pdf_is_abstract(self):
+        class NoUpload(StorageBackend):
+            pass
+
+        with self.assertRaises(TypeError):
+            StorageBackend()
+        with self.assertRaises(TypeError):
+            NoUpload()
+
+
+class LocalDirectoryStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.parent = Path(tmp.name).resolve()
+        self.storage = LocalDirectoryStorage(str(self.parent / 'export'))
+
+    def test_writes_under_root(self):
+        key = invoice_key('client', 'Acme/Holdings', 'invoice.pdf')
+        url = self.storage.upload_pdf(b'%PDF', key)
+        path = self.parent / 'export' / 'invoices' / 'clients' / 'Acme_Holdings' / 'invoice.pdf'
+        self.assertEqual(url, path.as_uri())
+        self.assertEqual(path.read_bytes(), b'%PDF')
+
+    def test_rejects_keys_outside_root(self):
+        for key in ('../escaped.pdf', 'invoices/../../escaped.pdf', str(self.parent / 'escaped.pdf'),
+                    '/escaped.pdf', '', '.'):
+            with self.subTest(key):
+                with self.assertRaises(ValueError):
+                    self.storage.upload_pdf(b'%PDF', key)
+        self.assertEqual(sorted(path.name for path in self.parent.iterdir()), ['export'])
+
+    def test_rejects_symlinks_out_of_root(self):
+        (self.parent / 'outside').mkdir()
+        (self.parent / 'export' / 'invoices').symlink_to(self.parent / 'outside')
+        with self.assertRaises(ValueError):
+            self.storage.upload_pdf(b'%PDF', 'invoices/escaped.pdf')
+        self.assertEqual(list((self.parent / 'outside').iterdir()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
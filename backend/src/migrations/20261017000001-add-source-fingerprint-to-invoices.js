@@ -0,0 +1,17 @@
+'use strict';
+
+module.exports = {
+  up: async (queryInterface, Sequelize) => {
+    // Hash of the source records + template the invoice was rendered from,
+    // used by the Python generator to skip unchanged invoices on re-runs
+    await queryInterface.addColumn('invoices', 'source_fingerprint', {
+      type: Sequelize.STRING(64),
+      allowNull: true,
+      comment: 'SHA-256 of the ordered source records, role, invoice date and template version'
+    });
+  },
+
+  down: async (queryInterface, Sequelize) => {
+    await queryInterface.removeColumn('invoices', 'source_fingerprint');
+  }
+};
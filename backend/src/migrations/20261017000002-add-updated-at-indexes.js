@@ -0,0 +1,25 @@
+'use strict';
+
+module.exports = {
+  up: async (queryInterface, Sequelize) => {
+    // The Python generator's --since mode looks up entities whose rows
+    // changed after its last run's watermark by updated_at
+    await queryInterface.addIndex('funded', ['updated_at'], {
+      name: 'idx_funded_updated_at'
+    });
+
+    await queryInterface.addIndex('promissory', ['updated_at'], {
+      name: 'idx_promissory_updated_at'
+    });
+
+    await queryInterface.addIndex('capinvestor', ['updated_at'], {
+      name: 'idx_capinvestor_updated_at'
+    });
+  },
+
+  down: async (queryInterface, Sequelize) => {
+    await queryInterface.removeIndex('funded', 'idx_funded_updated_at');
+    await queryInterface.removeIndex('promissory', 'idx_promissory_updated_at');
+    await queryInterface.removeIndex('capinvestor', 'idx_capinvestor_updated_at');
+  }
+};
@@ -0,0 +1,36 @@
+'use strict';
+
+module.exports = {
+  up: async (queryInterface, Sequelize) => {
+    // Partial, covering indexes for the Python generator's active-record
+    // queries. Keyed like their ORDER BY, limited to rows that aren't closed,
+    // and carrying the summed amounts, so listing a role with its per-entity
+    // counts and totals is an index-only scan
+    await queryInterface.sequelize.query(`
+      CREATE INDEX IF NOT EXISTS idx_funded_active_business
+      ON funded (business_name, project_address)
+      INCLUDE (interest_payment, loan_amount)
+      WHERE business_name IS NOT NULL AND business_name != '';
+    `);
+
+    await queryInterface.sequelize.query(`
+      CREATE INDEX IF NOT EXISTS idx_promissory_active_investor
+      ON promissory (investor_name, fund_date)
+      INCLUDE (capital_pay, loan_amount)
+      WHERE status IS DISTINCT FROM 'closed';
+    `);
+
+    await queryInterface.sequelize.query(`
+      CREATE INDEX IF NOT EXISTS idx_capinvestor_active_investor
+      ON capinvestor (investor_name, property_address)
+      INCLUDE (payment, loan_amount)
+      WHERE loan_status IS DISTINCT FROM 'closed';
+    `);
+  },
+
+  down: async (queryInterface, Sequelize) => {
+    await queryInterface.removeIndex('funded', 'idx_funded_active_business');
+    await queryInterface.removeIndex('promissory', 'idx_promissory_active_investor');
+    await queryInterface.removeIndex('capinvestor', 'idx_capinvestor_active_investor');
+  }
+};
@@ -0,0 +1,63 @@
+'use strict';
+
+module.exports = {
+  up: async (queryInterface, Sequelize) => {
+    // The Python generator now selects rows by invoice month as the Node
+    // generator does: by closing date, fund date, payoff date and status. The
+    // partial indexes left closed loans out, but closed loans paid off in the
+    // covered month are invoiced too, so they are replaced with covering
+    // indexes that carry every filtered column; listing a role with its
+    // per-entity counts and totals stays an index-only scan
+    await queryInterface.removeIndex('funded', 'idx_funded_active_business');
+    await queryInterface.removeIndex('promissory', 'idx_promissory_active_investor');
+    await queryInterface.removeIndex('capinvestor', 'idx_capinvestor_active_investor');
+
+    await queryInterface.sequelize.query(`
+      CREATE INDEX IF NOT EXISTS idx_funded_invoiced_business
+      ON funded (business_name, project_address)
+      INCLUDE (closing_date, interest_payment, loan_amount)
+      WHERE business_name IS NOT NULL AND business_name != '';
+    `);
+
+    await queryInterface.sequelize.query(`
+      CREATE INDEX IF NOT EXISTS idx_promissory_invoiced_investor
+      ON promissory (investor_name, fund_date)
+      INCLUDE (status, payoff_date, capital_pay, loan_amount)
+      WHERE investor_name IS NOT NULL AND investor_name != '';
+    `);
+
+    await queryInterface.sequelize.query(`
+      CREATE INDEX IF NOT EXISTS idx_capinvestor_invoiced_investor
+      ON capinvestor (investor_name, property_address)
+      INCLUDE (loan_status, fund_date, payoff_date, payment, loan_amount)
+      WHERE investor_name IS NOT NULL AND investor_name != '';
+    `);
+  },
+
+  down: async (queryInterface, Sequelize) => {
+    await queryInterface.removeIndex('funded', 'idx_funded_invoiced_business');
+    await queryInterface.removeIndex('promissory', 'idx_promissory_invoiced_investor');
+    await queryInterface.removeIndex('capinvestor', 'idx_capinvestor_invoiced_investor');
+
+    await queryInterface.sequelize.query(`
+      CREATE INDEX IF NOT EXISTS idx_funded_active_business
+      ON funded (business_name, project_address)
+      INCLUDE (interest_payment, loan_amount)
+      WHERE business_name IS NOT NULL AND business_name != '';
+    `);
+
+    await queryInterface.sequelize.query(`
+      CREATE INDEX IF NOT EXISTS idx_promissory_active_investor
+      ON promissory (investor_name, fund_date)
+      INCLUDE (capital_pay, loan_amount)
+      WHERE status IS DISTINCT FROM 'closed';
+    `);
+
+    await queryInterface.sequelize.query(`
+      CREATE INDEX IF NOT EXISTS idx_capinvestor_active_investor
+      ON capinvestor (investor_name, property_address)
+      INCLUDE (payment, loan_amount)
+      WHERE loan_status IS DISTINCT FROM 'closed';
+    `);
+  }
+};
@@ -67,6 +67,11 @@ module.exports = (sequelize, DataTypes) => {
       type: DataTypes.TEXT,
       allowNull: true,
       field: 'email_error'
+    },
+    sourceFingerprint: {
+      type: DataTypes.STRING(64),
+      allowNull: true,
+      field: 'source_fingerprint'
     }
   }, {
     tableName: 'invoices',
@@ -0,0 +1,93 @@
+const { Sequelize, DataTypes } = require('sequelize');
+const googleSheetsService = require('../googleSheetsService');
+
+// Models are built from rows as Postgres returns them; nothing connects to a database
+const sequelize = new Sequelize('postgres://localhost:5432/unused', { logging: false });
+const Funded = require('../../models/Funded')(sequelize, DataTypes);
+const CapInvestor = require('../../models/CapInvestor')(sequelize, DataTypes);
+
+const lastSync = new Date(Date.UTC(2026, 9, 1, 6, 0, 0));
+const thisSync = new Date(Date.UTC(2026, 9, 15, 6, 0, 0));
+
+function storedRow(Model, values) {
+  const instance = Model.build(values, { isNewRecord: false, raw: true });
+  jest.spyOn(instance, 'save').mockResolvedValue(instance);
+  return instance;
+}
+
+describe('saveSyncedRecord', () => {
+  test('an unchanged funded row re-synced only moves lastSeenAt, silently', async () => {
+    const existing = storedRow(Funded, {
+      id: '6f1c3c1e-0000-4000-8000-000000000001',
+      businessName: 'Acme Holdings LLC',
+      projectAddress: '1 Harbor Way',
+      constructionCost: '120000.00',
+      constructionLeftInEscrow: null,
+      loanAmount: '250000.00',
+      interestRate: '10.00',
+      interestPayment: '2083.33',
+      closingDate: new Date(Date.UTC(2025, 5, 15, 12, 0, 0)),
+      maturityDate: null,
+      lastSeenAt: lastSync
+    });
+
+    // As parsed from the sheet by parseNumber and parseDate
+    await googleSheetsService.saveSyncedRecord(existing, {
+      businessName: 'Acme Holdings LLC',
+      projectAddress: '1 Harbor Way',
+      constructionCost: 120000,
+      constructionLeftInEscrow: null,
+      loanAmount: 250000,
+      interestRate: 10,
+      interestPayment: 2083.33,
+      closingDate: googleSheetsService.parseDate('6/15/2025'),
+      maturityDate: null,
+      lastSeenAt: thisSync
+    });
+
+    expect(existing.changed()).toEqual(['lastSeenAt']);
+    expect(existing.save).toHaveBeenCalledWith({ silent: true });
+  });
+
+  test('a changed cap investor row is saved with updated_at', async () => {
+    const existing = storedRow(CapInvestor, {
+      id: '6f1c3c1e-0000-4000-8000-000000000002',
+      propertyAddress: '10 Full Month Rd',
+      investorName: 'Jane Doe',
+      loanAmount: '180000.00',
+      interestRate: '10.00',
+      payment: '1500.00',
+      fundDate: new Date(Date.UTC(2025, 0, 5, 12, 0, 0)),
+      payoffDate: null,
+      lastSeenAt: lastSync
+    });
+
+    await googleSheetsService.saveSyncedRecord(existing, {
+      propertyAddress: '10 Full Month Rd',
+      investorName: 'Jane Doe',
+      loanAmount: 180000,
+      interestRate: 10,
+      payment: 1500,
+      fundDate: googleSheetsService.parseDate('1/5/2025'),
+      payoffDate: googleSheetsService.parseDate('1/12/2026'),
+      lastSeenAt: thisSync
+    });
+
+    expect(existing.changed().sort()).toEqual(['lastSeenAt', 'payoffDate']);
+    expect(existing.save).toHaveBeenCalledWith({ silent: false });
+  });
+});
+
+describe('isSameValue', () => {
+  test('compares DECIMAL columns at their scale and DATEONLY columns by day', () => {
+    const decimal = { type: DataTypes.DECIMAL(12, 2) };
+    const dateOnly = { type: DataTypes.DATEONLY };
+
+    expect(googleSheetsService.isSameValue(decimal, '2083.33', 2083.33)).toBe(true);
+    expect(googleSheetsService.isSameValue(decimal, '2083.33', 2083.334)).toBe(true);
+    expect(googleSheetsService.isSameValue(decimal, '2083.33', 2083.34)).toBe(false);
+    expect(googleSheetsService.isSameValue(decimal, null, 0)).toBe(false);
+    expect(googleSheetsService.isSameValue(dateOnly, '2026-01-25', new Date(Date.UTC(2026, 0, 25, 12)))).toBe(true);
+    expect(googleSheetsService.isSameValue(dateOnly, '2026-01-25', new Date(Date.UTC(2026, 0, 26, 12)))).toBe(false);
+  });
+});
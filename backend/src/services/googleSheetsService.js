@@ -178,6 +178,49 @@ class GoogleSheetsService {
     }
   }
 
+  /**
+   * Whether a synced value equals the value already stored in a column
+   * DECIMAL columns come back from Postgres as strings and DATEONLY columns as
+   * 'YYYY-MM-DD', while parseNumber and parseDate give numbers and Dates, so
+   * values are compared by what the column would store
+   */
+  isSameValue(attribute, stored, value) {
+    if (stored === null || stored === undefined || value === null || value === undefined) {
+      return (stored === null || stored === undefined) && (value === null || value === undefined);
+    }
+
+    const type = attribute && attribute.type ? attribute.type.key : null;
+    if (type === 'DECIMAL') {
+      const scale = attribute.type.options && attribute.type.options.scale;
+      const round = (number) => (scale === undefined ? Number(number) : Number(Number(number).toFixed(scale)));
+      return round(stored) === round(value);
+    }
+    if (type === 'DATEONLY') {
+      const day = (date) => (date instanceof Date ? date.toISOString().slice(0, 10) : String(date).slice(0, 10));
+      return day(stored) === day(value);
+    }
+    if (stored instanceof Date || value instanceof Date) {
+      return new Date(stored).getTime() === new Date(value).getTime();
+    }
+    return stored === value;
+  }
+
+  /**
+   * Save a synced sheet row over an existing record
+   * Only fields whose values differ are set, and the save is silent (updated_at
+   * is left alone) when lastSeenAt is the only change
+   */
+  async saveSyncedRecord(existing, record) {
+    const attributes = existing.constructor.rawAttributes || {};
+    for (const [field, value] of Object.entries(record)) {
+      if (!this.isSameValue(attributes[field], existing.get(field), value)) {
+        existing.set(field, value);
+      }
+    }
+    const changed = existing.changed() || [];
+    return existing.save({ silent: changed.every(field => field === 'lastSeenAt') });
+  }
+
   /**
    * Parse asset ID to extract S001 number
    * Example: "Promissory Note - S00162962" -> "S00162962"
@@ -370,8 +413,9 @@ class GoogleSheetsService {
           record.lastSeenAt = syncStartTime;
 
           if (existing) {
-            // Update existing record
-            await existing.update(record);
+            // Update existing record. updated_at only moves when something other than
+            // lastSeenAt changed, so invoice runs with --since skip unchanged rows
+            await this.saveSyncedRecord(existing, record);
             results.updated++;
             console.log(`Updated: ${record.businessName} - ${record.projectAddress}`);
           } else {
@@ -705,8 +749,9 @@ class GoogleSheetsService {
           record.lastSeenAt = syncStartTime;
 
           if (existing) {
-            // Update existing record
-            await existing.update(record);
+            // Update existing record. updated_at only moves when something other than
+            // lastSeenAt changed, so invoice runs with --since skip unchanged rows
+            await this.saveSyncedRecord(existing, record);
             results.updated++;
             console.log(`Updated: ${record.propertyAddress} - ${record.investorName}`);
           } else {